@@ -1,13 +1,56 @@
 '''API for the earthquake monitor.'''
-from datetime import datetime
-from flask import Flask, jsonify, request
-from database import (get_earthquake_by_id,
+import math
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from functools import wraps
+from itertools import chain, islice
+from typing import Callable, Iterator
+from flask import Flask, Response, abort, g, jsonify, make_response, request, stream_with_context, url_for
+from psycopg2.pool import PoolError
+from cache import (DEFAULT_CACHE_MAX_AGE,
+                   check_watermark,
+                   get_cache_key,
+                   get_cache_stats,
+                   get_entry,
+                   store_entry,
+                   record_request,
+                   get_page_window,
+                   get_date_window,
+                   narrow_window)
+from database import (init_db,
+                      decode_page_token,
+                      DEFAULT_PAGE_SIZE,
+                      MAX_PAGE_SIZE,
+                      FIELD_COLUMNS,
+                      SORT_ORDERS,
+                      DEFAULT_NEAR_COUNT,
+                      ROLLUP_DIMENSIONS,
+                      ROLLUP_PERIODS,
+                      get_rollups,
+                      get_earthquakes_near,
+                      search_earthquakes,
+                      export_search,
+                      get_earthquake_by_id,
                       get_earthquakes_by_magnitude,
                       get_earthquakes_by_date,
-                      get_earthquakes_by_alert_level)
+                      get_earthquakes_by_alert_level,
+                      export_earthquakes_by_magnitude,
+                      export_earthquakes_by_date,
+                      export_earthquakes_by_alert_level)
 from model import make_prediction
 
+NDJSON = "application/x-ndjson"
+# Earthquakes encoded into each chunk written to a streaming client.
+STREAM_CHUNK_ROWS = 500
+# Responses kept by the cache: results, and lookups that found nothing.
+CACHEABLE_STATUSES = (200, 404)
+# Days of summaries returned by default, and at most, per request to /stats/hourly and /stats/daily.
+STATS_DEFAULT_DAYS = {"hourly": 1, "daily": 30}
+STATS_MAX_DAYS = {"hourly": 31, "daily": 366}
+
 app = Flask(__name__)
+init_db(app)
 
 
 def valid_color(color: str) -> bool:
@@ -15,13 +58,208 @@ def valid_color(color: str) -> bool:
     return color in ('green', 'yellow', 'orange', 'red')
 
 
+def get_page_args() -> tuple[int, str]:
+    """Reads the limit and after parameters of a list endpoint, aborting with a 400 if either is invalid."""
+    limit = request.args.get("limit", str(DEFAULT_PAGE_SIZE))
+    if not limit.isdigit() or not 1 <= int(limit) <= MAX_PAGE_SIZE:
+        abort(400, f"limit must be a whole number from 1 to {MAX_PAGE_SIZE}")
+    return int(limit), get_after_arg()
+
+
+def get_after_arg() -> str:
+    """Reads the after parameter of a list endpoint, aborting with a 400 if it is not a valid token."""
+    after = request.args.get("after")
+    if after is not None:
+        try:
+            decode_page_token(after)
+        except ValueError:
+            abort(400, "Invalid after token")
+    return after
+
+
+def get_number_arg(name: str) -> float | None:
+    """Reads an optional numeric parameter, aborting with a 400 if it is not a finite number."""
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        number = float(value)
+    except ValueError:
+        number = math.nan
+    if not math.isfinite(number):
+        abort(400, f"{name} must be a number")
+    return number
+
+
+def get_bbox_arg() -> tuple[float, float, float, float] | None:
+    """
+    Reads an optional bbox of min_longitude,min_latitude,max_longitude,max_latitude, aborting with a 400 if it is invalid.
+    A min_longitude east of max_longitude is a box crossing the antimeridian.
+    """
+    bbox = request.args.get("bbox")
+    if bbox is None:
+        return None
+    try:
+        min_longitude, min_latitude, max_longitude, max_latitude = (float(value) for value in bbox.split(","))
+    except ValueError:
+        abort(400, "bbox must be min_longitude,min_latitude,max_longitude,max_latitude")
+    if not (-180.0 <= min_longitude <= 180.0 and -180.0 <= max_longitude <= 180.0
+            and -90.0 <= min_latitude <= max_latitude <= 90.0):
+        abort(400, "bbox longitudes must be between -180.0 and 180.0, and latitudes between -90.0 and 90.0 with min_latitude first")
+    return min_longitude, min_latitude, max_longitude, max_latitude
+
+
+def get_search_args() -> tuple[dict, tuple[str] | None, str]:
+    """Reads the filters, fields and sort order of a search, aborting with a 400 if any is invalid."""
+    filters = {name: get_number_arg(name)
+               for name in ("min_magnitude", "max_magnitude", "min_depth", "max_depth")}
+
+    for name in ("start_date", "end_date"):
+        date = request.args.get(name)
+        if date is not None:
+            try:
+                filters[name] = datetime.strptime(date, '%Y-%m-%d').strftime('%Y-%m-%d')
+            except ValueError:
+                abort(400, f"Invalid {name} format. Please use YYYY-MM-DD")
+
+    alert = request.args.get("alert")
+    if alert is not None:
+        if not valid_color(alert.lower()):
+            abort(400, "Invalid alert level")
+        filters["alert_level"] = alert.lower()
+
+    filters["network"] = request.args.get("network")
+    filters["bbox"] = get_bbox_arg()
+
+    fields = request.args.get("fields")
+    if fields is not None:
+        fields = tuple(fields.split(","))
+        unknown = sorted(set(fields) - FIELD_COLUMNS.keys())
+        if unknown:
+            abort(400, f"Unknown fields: {', '.join(unknown)}")
+
+    sort = request.args.get("sort", "asc").upper()
+    if sort not in SORT_ORDERS:
+        abort(400, "sort must be asc or desc")
+    return filters, fields, sort
+
+
+def get_stream_format() -> str | None:
+    """
+    Returns "ndjson" when the client accepts NDJSON over JSON, "json" when it asked for stream=1,
+    and None when it should get a page as usual.
+    """
+    if request.accept_mimetypes.best_match(["application/json", NDJSON]) == NDJSON:
+        return "ndjson"
+    if request.args.get("stream") == "1":
+        return "json"
+    return None
+
+
+def encode_earthquakes(earthquakes: Iterator[dict], stream_format: str) -> Iterator[str]:
+    """Yields the earthquakes as compact NDJSON lines, or as the pieces of one JSON array."""
+    if stream_format == "ndjson":
+        for earthquake in earthquakes:
+            yield app.json.dumps(earthquake, separators=(",", ":")) + "\n"
+        return
+
+    separator = "["
+    for earthquake in earthquakes:
+        yield separator + app.json.dumps(earthquake, separators=(",", ":"))
+        separator = ","
+    yield "]" if separator == "," else "[]"
+
+
+def stream_response(earthquakes: Iterator[dict], stream_format: str):
+    """
+    Writes every earthquake to the client as it is read from the database, STREAM_CHUNK_ROWS at a time,
+    instead of building the whole body first. The request's connection is returned once the last chunk is sent.
+    """
+    first = next(earthquakes, None)
+    if first is None:
+        return jsonify({"error": "No earthquakes found"}), 404
+
+    def generate_chunks() -> Iterator[str]:
+        pieces = encode_earthquakes(chain((first,), earthquakes), stream_format)
+        while chunk := "".join(islice(pieces, STREAM_CHUNK_ROWS)):
+            yield chunk
+
+    return Response(stream_with_context(generate_chunks()),
+                    mimetype=NDJSON if stream_format == "ndjson" else "application/json")
+
+
+def page_response(earthquakes: list[dict], next_page: str):
+    """Returns a page of earthquakes, with a Link header to the next page when there is one."""
+    response = jsonify(earthquakes)
+    if next_page:
+        query_args = {**request.args.to_dict(), "after": next_page}
+        next_url = url_for(request.endpoint, **request.view_args, **query_args)
+        response.headers["Link"] = f'<{next_url}>; rel="next"'
+    return response, 200
+
+
+def cached_response(view: Callable) -> Callable:
+    """
+    Serves a view from the response cache, filling it on a miss. The view sets g.cache_window to the span of
+    earthquake times its response was built from, so a load only expires the responses it could have changed.
+    Results carry an ETag and Cache-Control, so clients can revalidate with If-None-Match. Streamed exports skip the cache.
+    """
+    @wraps(view)
+    def serve(*args, **kwargs):
+        if get_stream_format():
+            return view(*args, **kwargs)
+
+        start = time.perf_counter()
+        check_watermark()
+        key = get_cache_key(request.path, request.args)
+        entry = get_entry(key)
+        hit = entry is not None
+        if not hit:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code not in CACHEABLE_STATUSES:
+                return response
+            headers = {name: value for name, value in response.headers.items()
+                       if name != "Content-Length"}
+            entry = store_entry(key, response.get_data(), response.status_code,
+                                headers, g.get("cache_window"))
+
+        response = Response(entry["body"], entry["status"], entry["headers"])
+        if response.status_code == 200:
+            response.set_etag(entry["etag"])
+            response.cache_control.public = True
+            response.cache_control.max_age = int(os.getenv("CACHE_MAX_AGE", str(DEFAULT_CACHE_MAX_AGE)))
+            response = response.make_conditional(request)
+        record_request(hit, time.perf_counter() - start, response.status_code == 304)
+        return response
+    return serve
+
+
+@app.errorhandler(400)
+def handle_bad_request(error):
+    """Returns bad requests as JSON, like the other errors."""
+    return jsonify({"error": error.description}), 400
+
+
+@app.errorhandler(PoolError)
+def handle_pool_exhausted(_error: PoolError):
+    """Returns a 503 when every pooled database connection stayed busy."""
+    return jsonify({"error": "Database is busy, please try again"}), 503
+
+
 @app.route("/", methods=["GET"])
 def endpoint_index():
     """Return the enpoint for the API home page."""
     return {"message": "Welcome to the Earthquake Monitor API homepage"}
 
 
+@app.route("/cache/stats", methods=["GET"])
+def endpoint_cache_stats():
+    """Returns the response cache's hit ratio, latency and size."""
+    return jsonify(get_cache_stats()), 200
+
+
 @app.route("/earthquakes/<int:earthquake_id>", methods=["GET"])
+@cached_response
 def endpoint_get_earthquake(earthquake_id: int):
     """Returns a specific earthquake"""
     earthquake = get_earthquake_by_id(earthquake_id)
@@ -29,10 +267,12 @@ def endpoint_get_earthquake(earthquake_id: int):
     if not earthquake:
         return jsonify({"error": "Earthquake not found"}), 404
 
+    g.cache_window = (earthquake[0]["time"], earthquake[0]["time"])
     return jsonify(earthquake), 200
 
 
 @app.route("/earthquakes/magnitude", methods=["GET"])
+@cached_response
 def endpoint_get_magnitude():
     """Returns all earthquakes within a magnitude range."""
     min_magnitude = request.args.get("min_magnitude")
@@ -50,15 +290,24 @@ def endpoint_get_magnitude():
     if min_magnitude >= max_magnitude:
         return jsonify({"error": "min_magnitude must be less than max_magnitude"}), 400
 
-    earthquakes = get_earthquakes_by_magnitude(min_magnitude, max_magnitude)
+    stream_format = get_stream_format()
+    if stream_format:
+        return stream_response(export_earthquakes_by_magnitude(
+            min_magnitude, max_magnitude, get_after_arg()), stream_format)
+
+    limit, after = get_page_args()
+    earthquakes, next_page = get_earthquakes_by_magnitude(
+        min_magnitude, max_magnitude, limit, after)
+    g.cache_window = get_page_window(earthquakes, "ASC", after, bool(next_page))
 
     if not earthquakes:
         return jsonify({"error": "No earthquakes found"}), 404
 
-    return jsonify(earthquakes), 200
+    return page_response(earthquakes, next_page)
 
 
 @app.route("/earthquakes/date", methods=["GET"])
+@cached_response
 def endpoint_get_earthquakes_between_date():
     """Returns all earthquakes between two dates."""
     start_date = request.args.get("start_date")
@@ -88,26 +337,133 @@ def endpoint_get_earthquakes_between_date():
     else:
         sort = "ASC"
 
-    earthquakes = get_earthquakes_by_date(start_date, end_date, sort)
+    stream_format = get_stream_format()
+    if stream_format:
+        return stream_response(export_earthquakes_by_date(
+            start_date, end_date, sort, get_after_arg()), stream_format)
+
+    limit, after = get_page_args()
+    earthquakes, next_page = get_earthquakes_by_date(
+        start_date, end_date, sort, limit, after)
+    g.cache_window = narrow_window(get_page_window(earthquakes, sort, after, bool(next_page)),
+                                   get_date_window(start_date, end_date))
 
     if not earthquakes:
         return jsonify({"error": "No earthquakes found"}), 404
-    return jsonify(earthquakes), 200
+    return page_response(earthquakes, next_page)
 
 
 @app.route("/earthquakes/alert/<string:colour>")
+@cached_response
 def endpoint_earthquakes_by_alert_colour(colour: str):
     """Returns all earthquakes with a certain alert level."""
     if not valid_color(colour.lower()):
         return jsonify({"error": "Invalid alert level"}), 404
 
-    earthquakes = get_earthquakes_by_alert_level(colour.lower())
+    stream_format = get_stream_format()
+    if stream_format:
+        return stream_response(export_earthquakes_by_alert_level(
+            colour.lower(), get_after_arg()), stream_format)
+
+    limit, after = get_page_args()
+    earthquakes, next_page = get_earthquakes_by_alert_level(
+        colour.lower(), limit, after)
+    g.cache_window = get_page_window(earthquakes, "ASC", after, bool(next_page))
+
+    if not earthquakes:
+        return jsonify({"error": "No earthquakes found"}), 404
+    return page_response(earthquakes, next_page)
+
+
+@app.route("/earthquakes/search", methods=["GET"])
+@cached_response
+def endpoint_search_earthquakes():
+    """Returns the earthquakes matching every given filter, found by one query."""
+    filters, fields, sort = get_search_args()
+
+    stream_format = get_stream_format()
+    if stream_format:
+        return stream_response(export_search(
+            filters, sort, get_after_arg(), fields), stream_format)
+
+    limit, after = get_page_args()
+    earthquakes, next_page = search_earthquakes(filters, sort, limit, after, fields)
+    g.cache_window = narrow_window(get_page_window(earthquakes, sort, after, bool(next_page)),
+                                   get_date_window(filters.get("start_date"), filters.get("end_date")))
 
+    if not earthquakes:
+        return jsonify({"error": "No earthquakes found"}), 404
+    return page_response(earthquakes, next_page)
+
+
+@app.route("/earthquakes/near", methods=["GET"])
+@cached_response
+def endpoint_earthquakes_near():
+    """Returns the k earthquakes nearest a point, closest first, optionally only those within radius_km."""
+    latitude = get_number_arg("lat")
+    longitude = get_number_arg("long")
+    if latitude is None or longitude is None:
+        abort(400, "both lat and long must be given")
+    if not -90.0 <= latitude <= 90.0:
+        abort(400, "lat must be between -90.0 and 90.0")
+    if not -180.0 <= longitude <= 180.0:
+        abort(400, "long must be between -180.0 and 180.0")
+
+    radius_km = get_number_arg("radius_km")
+    if radius_km is not None and radius_km <= 0:
+        abort(400, "radius_km must be greater than 0")
+    count = request.args.get("k", str(DEFAULT_NEAR_COUNT))
+    if not count.isdigit() or not 1 <= int(count) <= MAX_PAGE_SIZE:
+        abort(400, f"k must be a whole number from 1 to {MAX_PAGE_SIZE}")
+
+    # No cache window: an earthquake loaded anywhere in time could be nearer.
+    earthquakes = get_earthquakes_near(latitude, longitude, int(count), radius_km)
     if not earthquakes:
         return jsonify({"error": "No earthquakes found"}), 404
     return jsonify(earthquakes), 200
 
 
+@app.route("/stats/<string:period>", methods=["GET"])
+@cached_response
+def endpoint_earthquake_stats(period: str):
+    """
+    Returns the count, mean and max magnitude and the strongest earthquake per hour or day, from the rollups
+    the load step maintains. Defaults to the last STATS_DEFAULT_DAYS days, in total rather than by dimension.
+    """
+    if period not in ROLLUP_PERIODS:
+        return jsonify({"error": f"period must be one of {ROLLUP_PERIODS}"}), 404
+
+    dates = {}
+    for name in ("start_date", "end_date"):
+        value = request.args.get(name)
+        if value:
+            try:
+                dates[name] = datetime.strptime(value, '%Y-%m-%d').date()
+            except ValueError:
+                abort(400, f"Invalid {name} format. Please use YYYY-MM-DD")
+    end_date = dates.get("end_date", datetime.now(timezone.utc).date())
+    start_date = dates.get("start_date", end_date - timedelta(days=STATS_DEFAULT_DAYS[period] - 1))
+    if start_date > end_date:
+        abort(400, "start_date must not be after end_date")
+    if (end_date - start_date).days >= STATS_MAX_DAYS[period]:
+        abort(400, f"{period} stats cover at most {STATS_MAX_DAYS[period]} days per request")
+
+    dimension = request.args.get("dimension", "all").lower()
+    if dimension not in ROLLUP_DIMENSIONS:
+        abort(400, f"dimension must be one of {ROLLUP_DIMENSIONS}")
+    value = request.args.get("value")
+    if value is not None and dimension == "all":
+        abort(400, "value needs a dimension other than all")
+    if value is not None and dimension == "alert":
+        value = value.lower()
+
+    stats = get_rollups(period, start_date.isoformat(), end_date.isoformat(), dimension, value)
+    g.cache_window = get_date_window(start_date.isoformat(), end_date.isoformat())
+    if not stats:
+        return jsonify({"error": "No earthquakes found"}), 404
+    return jsonify(stats), 200
+
+
 def check_length_of_coordinates(coordiante: float):
     """Ensures that the coordinates are 6 decimal points"""
     if '.' in str(coordiante) and len(str(coordiante).split('.')[1]) > 6:
@@ -0,0 +1,130 @@
+# pylint: disable=line-too-long
+
+'''
+Load test of the API with many concurrent clients, reporting p50 and p99 latency and the most database
+connections open at once. The API runs in-process on a local port against the Postgres database configured
+through the DB_* environment variables, first with a new connection opened and closed on every request,
+then with the per-request connections checked out of the pool.
+
+Run from the api directory, with the shared database module on the path:
+    PYTHONPATH=../shared python -m benchmarks.bench_load [--clients 200] [--requests 4000] [--path /earthquakes/alert/green]
+'''
+
+import argparse
+import logging
+import os
+import statistics
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from werkzeug.serving import make_server
+import database
+from api import app
+from db import get_connection, checkout_connection, return_connection, close_pool
+
+CONNECTION_QUERY = """SELECT count(*) AS connections FROM pg_stat_activity
+                      WHERE datname = current_database() AND pid <> pg_backend_pid()"""
+
+
+def open_unpooled() -> object:
+    '''The previous behaviour: a new connection for every request.'''
+    return get_connection()
+
+
+def close_unpooled(db_conn, broken: bool = False) -> None:
+    '''Closes the request's connection instead of keeping it.'''
+    db_conn.close()
+
+
+MODES = (("unpooled", open_unpooled, close_unpooled),
+         ("pooled", checkout_connection, return_connection))
+
+
+def count_connections(monitor_cursor) -> int:
+    '''Connections open to the database, not counting the monitor's own.'''
+    monitor_cursor.execute(CONNECTION_QUERY)
+    return monitor_cursor.fetchone()[0]
+
+
+def watch_connections(stop: threading.Event, peak: list[int]) -> None:
+    '''Samples the connection count every 20 ms until stopped, keeping the highest.'''
+    monitor = get_connection()
+    monitor.autocommit = True
+    with monitor.cursor() as monitor_cursor:
+        while not stop.is_set():
+            peak[0] = max(peak[0], count_connections(monitor_cursor))
+            time.sleep(0.02)
+    monitor.close()
+
+
+def timed_get(url: str) -> tuple[float, bool]:
+    '''Returns the latency of one request in milliseconds and whether it succeeded.'''
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(url, timeout=60) as response:
+            response.read()
+            succeeded = response.status < 500
+    except urllib.error.HTTPError as e:
+        succeeded = e.code < 500
+    except OSError:
+        succeeded = False
+    return (time.perf_counter() - start) * 1000, succeeded
+
+
+def run_load(url: str, clients: int, requests: int) -> dict:
+    '''Sends the requests from the given number of concurrent clients and summarises them.'''
+    stop, peak = threading.Event(), [0]
+    watcher = threading.Thread(target=watch_connections, args=(stop, peak))
+    watcher.start()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        results = list(executor.map(timed_get, [url] * requests))
+    elapsed = time.perf_counter() - start
+
+    stop.set()
+    watcher.join()
+    latencies = [latency for latency, _ in results]
+    percentiles = statistics.quantiles(latencies, n=100)
+    return {"requests_per_second": requests / elapsed,
+            "p50_ms": percentiles[49],
+            "p99_ms": percentiles[98],
+            "errors": sum(not succeeded for _, succeeded in results),
+            "peak_connections": peak[0]}
+
+
+def main() -> None:
+    '''Serves the API locally and prints the throughput, latency and peak connections of each connection mode.'''
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--requests", type=int, default=4000)
+    parser.add_argument("--path", default="/earthquakes/alert/green")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    load_dotenv()
+    if not os.getenv("DB_HOST"):
+        sys.exit("Set DB_HOST, DB_PORT, DB_NAME, DB_USER and DB_PASSWORD to a Postgres database with the schema applied.")
+
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}{args.path}"
+
+    print(f"{args.clients} clients, {args.requests} requests to {args.path}")
+    print(f"{'mode':>10}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'errors':>10}{'peak conns':>12}")
+    for mode, checkout, give_back in MODES:
+        database.checkout_connection, database.return_connection = checkout, give_back
+        result = run_load(url, args.clients, args.requests)
+        print(f"{mode:>10}{result['requests_per_second']:>10,.0f}{result['p50_ms']:>10.1f}"
+              f"{result['p99_ms']:>10.1f}{result['errors']:>10}{result['peak_connections']:>12}")
+        close_pool()
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+# pylint: disable=line-too-long
+
+'''
+Benchmark of the near endpoint's queries against a naive Haversine scan, which measures the distance to every
+earthquake and sorts them. For random points it times the k nearest earthquakes and the earthquakes within
+a radius, reporting p50 and p99 latency per query.
+
+Needs a scratch Postgres database with the schema applied (including PostGIS), configured through the DB_*
+environment variables. The benchmark inserts earthquakes at random positions, with a magnitude no real
+earthquake has, and deletes them afterwards.
+
+Run from the api directory, with the shared database module on the path:
+    PYTHONPATH=../shared python -m benchmarks.bench_near [--rows 1000000] [--queries 200] [--k 10] [--radius-km 100]
+'''
+
+import argparse
+import logging
+import math
+import os
+import random
+import statistics
+import sys
+import time
+from dotenv import load_dotenv
+from api import app
+from database import EARTHQUAKE_JOINS, FIELD_COLUMNS, get_db, get_earthquakes_near
+from db import get_connection, get_cursor
+
+# The seeded rows, spread evenly over the globe.
+BENCH_MAGNITUDE = 99.5
+SEED_QUERY = """INSERT INTO earthquakes (time, felt_report_count, magnitude, cdi, latitude, longitude, depth,
+                                         detail_url, alert_id, magnitude_id, network_id, place)
+                SELECT now() - n * interval '1 second', 0, %s, 0,
+                       round(degrees(asin(2 * random() - 1))::numeric, 4),
+                       round((random() * 360 - 180)::numeric, 4), 10, 'https://example.com/bench',
+                       (SELECT min(alert_id) FROM alerts), (SELECT min(magnitude_id) FROM magnitude_types),
+                       (SELECT min(network_id) FROM networks), 'Benchmark'
+                FROM generate_series(1, %s) AS n"""
+HAVERSINE_KM = """2 * 6371 * asin(sqrt(power(sin(radians(e.latitude::float8 - %(lat)s) / 2), 2)
+                  + cos(radians(%(lat)s)) * cos(radians(e.latitude::float8))
+                  * power(sin(radians(e.longitude::float8 - %(lon)s) / 2), 2)))"""
+HAVERSINE_SELECT = f"SELECT {', '.join(FIELD_COLUMNS.values())}, {HAVERSINE_KM} AS distance_km {EARTHQUAKE_JOINS}"
+HAVERSINE_NEAREST = f"{HAVERSINE_SELECT} ORDER BY distance_km LIMIT %(k)s"
+HAVERSINE_WITHIN = f"{HAVERSINE_SELECT} WHERE {HAVERSINE_KM} <= %(radius_km)s ORDER BY distance_km LIMIT %(k)s"
+
+
+def haversine_scan(latitude: float, longitude: float, count: int, radius_km: float = None) -> list[dict]:
+    '''The naive query: the great-circle distance to every earthquake, then a sort.'''
+    with get_cursor(get_db()) as app_cursor:
+        app_cursor.execute(HAVERSINE_NEAREST if radius_km is None else HAVERSINE_WITHIN,
+                           {"lat": latitude, "lon": longitude, "k": count, "radius_km": radius_km})
+        return app_cursor.fetchall()
+
+
+METHODS = (("haversine", haversine_scan),
+           ("gist", get_earthquakes_near))
+
+
+def random_point() -> tuple[float, float]:
+    '''A point picked uniformly over the globe, like the seeded earthquakes.'''
+    return math.degrees(math.asin(random.uniform(-1.0, 1.0))), random.uniform(-180.0, 180.0)
+
+
+def time_queries(query, points: list[tuple[float, float]], count: int, radius_km: float) -> dict:
+    '''Runs the query once per point, returning p50 and p99 latency and the mean rows returned.'''
+    latencies, rows = [], 0
+    for latitude, longitude in points:
+        start = time.perf_counter()
+        rows += len(query(latitude, longitude, count, radius_km))
+        latencies.append((time.perf_counter() - start) * 1000)
+    percentiles = statistics.quantiles(latencies, n=100)
+    return {"p50_ms": percentiles[49], "p99_ms": percentiles[98], "rows": rows / len(points)}
+
+
+def seed_rows(rows: int) -> None:
+    '''Inserts earthquakes at random positions, failing if the lookup tables are empty.'''
+    db_conn = get_connection()
+    with db_conn, db_conn.cursor() as seed_cursor:
+        seed_cursor.execute("SELECT EXISTS (SELECT FROM alerts) AND EXISTS (SELECT FROM magnitude_types) AND EXISTS (SELECT FROM networks)")
+        if not seed_cursor.fetchone()[0]:
+            sys.exit("The alerts, magnitude_types and networks tables need at least one row each.")
+        seed_cursor.execute(SEED_QUERY, (BENCH_MAGNITUDE, rows))
+    db_conn.autocommit = True
+    with db_conn.cursor() as seed_cursor:
+        seed_cursor.execute("ANALYZE earthquakes")
+    db_conn.close()
+
+
+def delete_rows() -> None:
+    '''Removes the seeded rows.'''
+    db_conn = get_connection()
+    with db_conn, db_conn.cursor() as seed_cursor:
+        seed_cursor.execute("DELETE FROM earthquakes WHERE magnitude = %s", (BENCH_MAGNITUDE,))
+    db_conn.close()
+
+
+def main() -> None:
+    '''Seeds the earthquakes, prints the latency of each near query method and deletes them again.'''
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--radius-km", type=float, default=100.0)
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    load_dotenv()
+    if not os.getenv("DB_HOST"):
+        sys.exit("Set DB_HOST, DB_PORT, DB_NAME, DB_USER and DB_PASSWORD to a scratch Postgres database with the schema applied.")
+
+    seed_rows(args.rows)
+    try:
+        points = [random_point() for _ in range(args.queries)]
+        print(f"{args.queries} queries over {args.rows:,} seeded earthquakes, k={args.k}, radius {args.radius_km:g} km")
+        print(f"{'query':>10}{'method':>11}{'p50 ms':>10}{'p99 ms':>10}{'rows':>8}")
+        with app.app_context():
+            for label, radius_km in (("nearest", None), ("within", args.radius_km)):
+                for method, query in METHODS:
+                    result = time_queries(query, points, args.k, radius_km)
+                    print(f"{label:>10}{method:>11}{result['p50_ms']:>10.1f}{result['p99_ms']:>10.1f}{result['rows']:>8.1f}")
+    finally:
+        delete_rows()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+# pylint: disable=line-too-long
+
+'''
+Micro-benchmark of repeated earthquake id lookups, comparing the SQL the API used to build with f-strings,
+client-side parameters (which psycopg2 still splices into new SQL text, so the server re-plans every call)
+and the server-side prepared statement the API now uses.
+Needs a Postgres database with earthquakes in it, configured through the DB_* environment variables.
+
+Run from the api directory, with the shared database module on the path:
+    PYTHONPATH=../shared python -m benchmarks.bench_prepared [--lookups 5000]
+'''
+
+import argparse
+import logging
+import os
+import random
+import sys
+import time
+from dotenv import load_dotenv
+from database import JOINED_TABLES, EARTHQUAKE_BY_ID_QUERY
+from db import execute_prepared, get_connection, get_cursor
+
+
+def lookup_with_fstring(db_cursor, earthquake_id: int) -> None:
+    '''The previous query, with the id written into the SQL text.'''
+    db_cursor.execute(f"{JOINED_TABLES} WHERE earthquake_id={earthquake_id}")
+
+
+def lookup_with_parameters(db_cursor, earthquake_id: int) -> None:
+    '''A parameterised query, interpolated by psycopg2 before it is sent.'''
+    db_cursor.execute(f"{JOINED_TABLES} WHERE e.earthquake_id = %s", (earthquake_id,))
+
+
+def lookup_prepared(db_cursor, earthquake_id: int) -> None:
+    '''The prepared statement, planned once per connection.'''
+    execute_prepared(db_cursor, "earthquake_by_id", EARTHQUAKE_BY_ID_QUERY, (earthquake_id,))
+
+
+METHODS = (("f-string", lookup_with_fstring),
+           ("parameters", lookup_with_parameters),
+           ("prepared", lookup_prepared))
+
+
+def main() -> None:
+    '''Times random id lookups with each query method and prints lookups per second.'''
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lookups", type=int, default=5000)
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    load_dotenv()
+    if not os.getenv("DB_HOST"):
+        sys.exit("Set DB_HOST, DB_PORT, DB_NAME, DB_USER and DB_PASSWORD to a Postgres database with earthquakes loaded.")
+
+    conn = get_connection()
+    conn.autocommit = True
+    app_cursor = get_cursor(conn)
+    app_cursor.execute("SELECT earthquake_id FROM earthquakes LIMIT 1000")
+    earthquake_ids = [row["earthquake_id"] for row in app_cursor.fetchall()]
+    if not earthquake_ids:
+        sys.exit("The earthquakes table is empty.")
+    lookups = random.choices(earthquake_ids, k=args.lookups)
+
+    print(f"{args.lookups} id lookups")
+    print(f"{'method':>12}{'lookups/s':>12}{'mean us':>10}")
+    for name, lookup in METHODS:
+        start = time.perf_counter()
+        for earthquake_id in lookups:
+            lookup(app_cursor, earthquake_id)
+            app_cursor.fetchall()
+        seconds = time.perf_counter() - start
+        print(f"{name:>12}{args.lookups / seconds:>12,.0f}{seconds / args.lookups * 1e6:>10.0f}")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
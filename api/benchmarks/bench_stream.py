@@ -0,0 +1,145 @@
+# pylint: disable=line-too-long
+
+'''
+Benchmark of a large export through the API, reporting the time to the first byte, the total time and the
+peak RSS of the API process. The buffered mode is the previous behaviour, fetching every row into a
+RealDictCursor and building the whole jsonify body before sending any of it; the streamed modes read through
+a server-side cursor and write rows as they arrive, as NDJSON and as one JSON array.
+Each mode runs in its own process, so peak RSS is not carried over from the mode before.
+
+Needs a scratch Postgres database with the schema applied, configured through the DB_* environment variables.
+The benchmark inserts the rows it exports, with a magnitude no real earthquake has, and deletes them afterwards.
+
+Run from the api directory, with the shared database module on the path:
+    PYTHONPATH=../shared python -m benchmarks.bench_stream [--rows 1000000]
+'''
+
+import argparse
+import json
+import logging
+import os
+import re
+import resource
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+from dotenv import load_dotenv
+from flask import jsonify
+from werkzeug.serving import make_server
+from api import app
+from database import MAGNITUDE_FILTER, get_page_query
+from db import get_connection, get_cursor
+
+# The seeded rows, and the magnitude range the export asks for, which only they fall in.
+BENCH_MAGNITUDE = 99.5
+EXPORT_PATH = "/earthquakes/magnitude?min_magnitude=99&max_magnitude=100"
+SEED_QUERY = """INSERT INTO earthquakes (time, felt_report_count, magnitude, cdi, latitude, longitude, depth,
+                                         detail_url, alert_id, magnitude_id, network_id, place)
+                SELECT now() - n * interval '1 second', 0, %s, 0, 0, 0, 10, 'https://example.com/bench',
+                       (SELECT min(alert_id) FROM alerts), (SELECT min(magnitude_id) FROM magnitude_types),
+                       (SELECT min(network_id) FROM networks), 'Benchmark'
+                FROM generate_series(1, %s) AS n"""
+MODES = ("buffered", "ndjson", "json")
+
+
+def peak_rss_mb() -> float:
+    '''Highest resident set size of this process so far, in MB (ru_maxrss is in KB on Linux).'''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def export_buffered() -> tuple[float, float, int]:
+    '''The previous export: every row fetched, then the whole body built, before the first byte can be sent.'''
+    query = re.sub(r"\$\d+", "%s", get_page_query(MAGNITUDE_FILTER, 2, "ASC", False))
+    start = time.perf_counter()
+    with app.app_context():
+        db_conn = get_connection()
+        with get_cursor(db_conn) as app_cursor:
+            app_cursor.execute(query, (99, 100, None))
+            earthquakes = app_cursor.fetchall()
+        body = jsonify(earthquakes).get_data()
+        db_conn.close()
+    elapsed = time.perf_counter() - start
+    return elapsed, elapsed, len(body)
+
+
+def export_streamed(mode: str) -> tuple[float, float, int]:
+    '''Reads a streamed export from the API over HTTP, timing the first byte and the last.'''
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}{EXPORT_PATH}"
+    headers = {"Accept": "application/x-ndjson"} if mode == "ndjson" else {}
+    if mode == "json":
+        url += "&stream=1"
+
+    start = time.perf_counter()
+    with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=600) as response:
+        size = len(response.read(1))
+        first_byte = time.perf_counter() - start
+        while chunk := response.read(1 << 16):
+            size += len(chunk)
+    total = time.perf_counter() - start
+    server.shutdown()
+    return first_byte, total, size
+
+
+def run_mode(mode: str) -> None:
+    '''Runs one mode and prints its results as JSON, for the parent process to collect.'''
+    first_byte, total, size = export_buffered() if mode == "buffered" else export_streamed(mode)
+    print(json.dumps({"ttfb_ms": first_byte * 1000, "total_s": total,
+                      "mb_sent": size / 1e6, "peak_rss_mb": peak_rss_mb()}))
+
+
+def seed_rows(rows: int) -> None:
+    '''Inserts the rows to export, failing if the lookup tables are empty.'''
+    db_conn = get_connection()
+    with db_conn, db_conn.cursor() as seed_cursor:
+        seed_cursor.execute("SELECT EXISTS (SELECT FROM alerts) AND EXISTS (SELECT FROM magnitude_types) AND EXISTS (SELECT FROM networks)")
+        if not seed_cursor.fetchone()[0]:
+            sys.exit("The alerts, magnitude_types and networks tables need at least one row each.")
+        seed_cursor.execute(SEED_QUERY, (BENCH_MAGNITUDE, rows))
+    db_conn.close()
+
+
+def delete_rows() -> None:
+    '''Removes the seeded rows.'''
+    db_conn = get_connection()
+    with db_conn, db_conn.cursor() as seed_cursor:
+        seed_cursor.execute("DELETE FROM earthquakes WHERE magnitude = %s", (BENCH_MAGNITUDE,))
+    db_conn.close()
+
+
+def main() -> None:
+    '''Seeds the export, runs each mode in its own process and prints the results, or runs the one mode given.'''
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--mode", choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    load_dotenv()
+    if not os.getenv("DB_HOST"):
+        sys.exit("Set DB_HOST, DB_PORT, DB_NAME, DB_USER and DB_PASSWORD to a scratch Postgres database with the schema applied.")
+
+    if args.mode:
+        run_mode(args.mode)
+        sys.exit()
+
+    seed_rows(args.rows)
+    try:
+        print(f"Export of {args.rows:,} earthquakes")
+        print(f"{'mode':>10}{'TTFB ms':>12}{'total s':>10}{'MB sent':>10}{'peak RSS MB':>14}")
+        for mode in MODES:
+            output = subprocess.run([sys.executable, "-m", "benchmarks.bench_stream", "--mode", mode],
+                                    capture_output=True, text=True, check=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print(f"{mode:>10}{result['ttfb_ms']:>12,.0f}{result['total_s']:>10.1f}"
+                  f"{result['mb_sent']:>10.1f}{result['peak_rss_mb']:>14,.0f}")
+    finally:
+        delete_rows()
+
+
+if __name__ == "__main__":
+    main()
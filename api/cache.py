@@ -0,0 +1,164 @@
+"""In-process cache of the API's responses, expired by age and by the time windows new loads touch."""
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlencode
+from database import decode_page_token, get_changed_window, get_data_watermark
+
+DEFAULT_CACHE_TTL = 300
+DEFAULT_CACHE_MAX_ENTRIES = 1024
+DEFAULT_CACHE_CHECK_SECONDS = 5
+DEFAULT_CACHE_MAX_AGE = 60
+# Responses by normalized request, least recently used first.
+CACHE = OrderedDict()
+CACHE_LOCK = threading.Lock()
+# The last change the load step logged, as of the last check.
+WATERMARK = {"change_id": None, "checked_at": 0.0}
+WATERMARK_LOCK = threading.Lock()
+CACHE_STATS = {"hits": 0, "misses": 0, "not_modified": 0, "evictions": 0, "expired": 0,
+               "invalidated": 0, "hit_ms": 0.0, "miss_ms": 0.0}
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+def reset_cache() -> None:
+    """Empties the cache and forgets the watermark and the statistics."""
+    with CACHE_LOCK:
+        CACHE.clear()
+    WATERMARK.update(change_id=None, checked_at=0.0)
+    CACHE_STATS.update(hits=0, misses=0, not_modified=0, evictions=0, expired=0,
+                       invalidated=0, hit_ms=0.0, miss_ms=0.0)
+
+
+def get_cache_key(path: str, args) -> str:
+    """Normalizes a request, so the same query with its parameters in another order shares an entry."""
+    return f"{path.lower()}?{urlencode(sorted(args.items(multi=True)))}"
+
+
+def get_entry(key: str) -> dict | None:
+    """Returns the cached response for a key, or None if there is none or it is older than CACHE_TTL seconds."""
+    with CACHE_LOCK:
+        entry = CACHE.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry["stored_at"] > float(os.getenv("CACHE_TTL", str(DEFAULT_CACHE_TTL))):
+            del CACHE[key]
+            CACHE_STATS["expired"] += 1
+            return None
+        CACHE.move_to_end(key)
+        return entry
+
+
+def store_entry(key: str, body: bytes, status: int, headers: dict,
+                window: tuple[datetime | None, datetime | None] | None) -> dict:
+    """
+    Caches a response along with the span of earthquake times it was built from (None at either end for
+    unbounded, or no window at all to expire it on any load), evicting the least recently used past CACHE_MAX_ENTRIES.
+    """
+    entry = {"body": body, "status": status, "headers": headers, "window": window,
+             "etag": hashlib.sha1(body).hexdigest(), "stored_at": time.monotonic()}
+    max_entries = int(os.getenv("CACHE_MAX_ENTRIES", str(DEFAULT_CACHE_MAX_ENTRIES)))
+    with CACHE_LOCK:
+        CACHE[key] = entry
+        CACHE.move_to_end(key)
+        while len(CACHE) > max_entries:
+            CACHE.popitem(last=False)
+            CACHE_STATS["evictions"] += 1
+    return entry
+
+
+def overlaps(window: tuple[datetime | None, datetime | None] | None,
+             first_time: datetime, last_time: datetime) -> bool:
+    """Checks whether a cached window includes any time from first_time to last_time."""
+    if window is None:
+        return True
+    start, end = window
+    return (start is None or last_time >= start) and (end is None or first_time <= end)
+
+
+def invalidate_window(first_time: datetime, last_time: datetime) -> int:
+    """Drops the cached responses built from earthquakes between the two times, returning how many there were."""
+    with CACHE_LOCK:
+        stale = [key for key, entry in CACHE.items()
+                 if overlaps(entry["window"], first_time, last_time)]
+        for key in stale:
+            del CACHE[key]
+    CACHE_STATS["invalidated"] += len(stale)
+    logging.info("Invalidated %s cached responses between %s and %s",
+                 len(stale), first_time, last_time)
+    return len(stale)
+
+
+def check_watermark() -> None:
+    """
+    At most once every CACHE_CHECK_SECONDS, reads the last change logged by the load step. When it has moved,
+    only the responses whose windows include the hours changed since are dropped. Those hours include the ones
+    revised earthquakes moved out of, and revisions are logged whatever their updated timestamp.
+    """
+    with WATERMARK_LOCK:
+        now = time.monotonic()
+        if now - WATERMARK["checked_at"] < float(os.getenv("CACHE_CHECK_SECONDS", str(DEFAULT_CACHE_CHECK_SECONDS))):
+            return
+        WATERMARK["checked_at"] = now
+
+        change_id = get_data_watermark()
+        previous = WATERMARK["change_id"]
+        if previous is not None and previous != change_id:
+            first_time, last_time = get_changed_window(previous)
+            if first_time is not None:
+                invalidate_window(first_time, last_time)
+        WATERMARK["change_id"] = change_id
+
+
+def get_page_window(earthquakes: list[dict], sort: str, after: str,
+                    has_next: bool) -> tuple[datetime | None, datetime | None]:
+    """
+    Returns the span of times a page depends on: from the position it starts after to its last row,
+    or onwards without end on the last page, where a new earthquake would be added.
+    """
+    start = datetime.fromisoformat(decode_page_token(after)[0]) if after else None
+    end = earthquakes[-1]["time"] if has_next and earthquakes else None
+    return (start, end) if sort == "ASC" else (end, start)
+
+
+def get_date_window(start_date: str | None, end_date: str | None) -> tuple[datetime | None, datetime | None]:
+    """Returns the span of times in a date range, from the start of the first day to the end of the last. Either may be open."""
+    return (datetime.fromisoformat(start_date).replace(tzinfo=timezone.utc) if start_date else None,
+            datetime.fromisoformat(end_date).replace(tzinfo=timezone.utc) + timedelta(days=1) if end_date else None)
+
+
+def narrow_window(window: tuple[datetime | None, datetime | None],
+                  bounds: tuple[datetime | None, datetime | None]) -> tuple[datetime | None, datetime | None]:
+    """Returns the part of a window inside the given bounds, where None is unbounded."""
+    starts = [bound for bound in (window[0], bounds[0]) if bound is not None]
+    ends = [bound for bound in (window[1], bounds[1]) if bound is not None]
+    return (max(starts) if starts else None, min(ends) if ends else None)
+
+
+def record_request(hit: bool, seconds: float, not_modified: bool = False) -> None:
+    """Adds a cached request to the statistics."""
+    CACHE_STATS["hits" if hit else "misses"] += 1
+    CACHE_STATS["hit_ms" if hit else "miss_ms"] += seconds * 1000
+    if not_modified:
+        CACHE_STATS["not_modified"] += 1
+
+
+def get_cache_stats() -> dict:
+    """Returns the hit ratio and mean latency of hits and misses, and the cache's size and watermark."""
+    hits, misses = CACHE_STATS["hits"], CACHE_STATS["misses"]
+    return {"entries": len(CACHE),
+            "hits": hits,
+            "misses": misses,
+            "hit_ratio": hits / (hits + misses) if hits + misses else 0.0,
+            "mean_hit_ms": CACHE_STATS["hit_ms"] / hits if hits else 0.0,
+            "mean_miss_ms": CACHE_STATS["miss_ms"] / misses if misses else 0.0,
+            "not_modified": CACHE_STATS["not_modified"],
+            "evictions": CACHE_STATS["evictions"],
+            "expired": CACHE_STATS["expired"],
+            "invalidated": CACHE_STATS["invalidated"],
+            "watermark": WATERMARK["change_id"]}
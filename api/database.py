@@ -1,105 +1,333 @@
 """File that connects API to RDS."""
-import os
+import base64
+import json
 import logging
-from typing import Any
+import re
+from datetime import datetime
+from typing import Any, Iterator
 import psycopg2
-from psycopg2.extensions import connection, cursor
-from psycopg2.extras import RealDictCursor, RealDictRow
+from psycopg2.extensions import connection
+from flask import Flask, g
 from dotenv import load_dotenv
+from db import checkout_connection, execute_prepared, get_cursor, return_connection
 
 load_dotenv()
 
-JOINED_TABLES = """SELECT  a.alert_type AS alert_level,
-                e.earthquake_id,
-                e.magnitude,
-                e.cdi,
-                e.felt_report_count,
-                e.place,
-                e.longitude,
-                e.latitude,
-                e.depth,
-                e.detail_url,
-                e.time,
-                m.magnitude_type,
-                n.network_name
-                FROM earthquakes e
+# The fields of an earthquake the API returns, and the column each is read from.
+FIELD_COLUMNS = {"alert_level": "a.alert_type AS alert_level",
+                 "earthquake_id": "e.earthquake_id",
+                 "magnitude": "e.magnitude",
+                 "cdi": "e.cdi",
+                 "felt_report_count": "e.felt_report_count",
+                 "place": "e.place",
+                 "longitude": "e.longitude",
+                 "latitude": "e.latitude",
+                 "depth": "e.depth",
+                 "detail_url": "e.detail_url",
+                 "time": "e.time",
+                 "magnitude_type": "m.magnitude_type",
+                 "network_name": "n.network_name"}
+EARTHQUAKE_JOINS = """FROM earthquakes e
                 JOIN alerts a ON e.alert_id = a.alert_id
                 JOIN magnitude_types m ON e.magnitude_id = m.magnitude_id
                 JOIN networks n ON e.network_id = n.network_id"""
+JOINED_TABLES = f"SELECT {', '.join(FIELD_COLUMNS.values())} {EARTHQUAKE_JOINS}"
+# Prepared once per pooled connection, so repeated lookups skip parsing and planning.
+EARTHQUAKE_BY_ID_QUERY = f"{JOINED_TABLES} WHERE e.earthquake_id = $1"
+# Filters of the list endpoints, which are returned a page at a time in (time, earthquake_id) order.
+# Each compares the bare earthquakes column, so it can be answered from an index on it.
+MAGNITUDE_FILTER = "e.magnitude BETWEEN $1 AND $2"
+# Half-open, from the start of the first day up to the start of the day after the last.
+DATE_FILTER = "e.time >= $1::date AND e.time < $2::date + 1"
+ALERT_LEVEL_FILTER = "e.alert_id = (SELECT alert_id FROM alerts WHERE alert_type = $1)"
+# Conditions of the search endpoint, in the order they are compiled into its query. {} is the parameter number.
+SEARCH_FILTERS = {"min_magnitude": "e.magnitude >= ${}",
+                  "max_magnitude": "e.magnitude <= ${}",
+                  "start_date": "e.time >= ${}::date",
+                  "end_date": "e.time < ${}::date + 1",
+                  "alert_level": "e.alert_id = (SELECT alert_id FROM alerts WHERE alert_type = ${})",
+                  "network": "e.network_id = (SELECT network_id FROM networks WHERE network_name = ${})",
+                  "min_depth": "e.depth >= ${}",
+                  "max_depth": "e.depth <= ${}"}
+# The search's bounding box of min_longitude, min_latitude, max_longitude and max_latitude.
+BBOX_FILTER = "e.latitude >= ${1} AND e.latitude <= ${3} AND (e.longitude >= ${0} {join} e.longitude <= ${2})"
+# Earthquakes nearest a point ($1 latitude, $2 longitude), closest first by distance on the spheroid.
+# Ordering by <-> reads them in order from the GiST index on location instead of measuring every row.
+NEAR_POINT = "ST_SetSRID(ST_MakePoint($2, $1), 4326)::geography"
+NEAR_SELECT = f"SELECT {', '.join(FIELD_COLUMNS.values())}, ST_Distance(e.location, {NEAR_POINT}) / 1000 AS distance_km {EARTHQUAKE_JOINS}"
+NEAREST_QUERY = f"{NEAR_SELECT} ORDER BY e.location <-> {NEAR_POINT} LIMIT $3"
+WITHIN_QUERY = f"""{NEAR_SELECT} WHERE ST_DWithin(e.location, {NEAR_POINT}, $3::float8 * 1000)
+                   ORDER BY e.location <-> {NEAR_POINT} LIMIT $4"""
+DEFAULT_NEAR_COUNT = 10
+# Summaries kept by the load step per UTC hour and day: in total ('all') and per alert level, network and region.
+# Rows are read by their primary key on the period, so a range costs the same however much history is stored.
+ROLLUP_PERIODS = ("hourly", "daily")
+ROLLUP_DIMENSIONS = ("all", "alert", "network", "region")
+ROLLUP_QUERY = """SELECT r.{bucket}, r.dimension, r.dimension_value AS value, r.earthquake_count,
+                         round(r.magnitude_sum / r.earthquake_count, 2) AS mean_magnitude, r.max_magnitude,
+                         r.max_earthquake_id, m.time AS max_earthquake_time, m.place AS max_earthquake_place
+                  FROM earthquake_rollups_{period} r
+                  LEFT JOIN earthquakes m ON m.earthquake_id = r.max_earthquake_id
+                  WHERE r.{bucket} >= $1::date::timestamp AT TIME ZONE 'UTC'
+                  AND r.{bucket} < ($2::date + 1)::timestamp AT TIME ZONE 'UTC'
+                  AND r.dimension = $3 AND ($4::varchar IS NULL OR r.dimension_value = $4)
+                  ORDER BY r.{bucket}, r.dimension_value"""
+SORT_ORDERS = ("ASC", "DESC")
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# Rows fetched per round trip by the server-side cursor of a streamed export.
+STREAM_BATCH_SIZE = 2000
+# The last change logged by the load step, and the span of the hours changed since then. The log holds the hours
+# of every earthquake loaded or revised, including the hours revised earthquakes moved out of.
+DATA_WATERMARK_QUERY = "SELECT COALESCE(max(change_id), 0) AS change_id FROM earthquake_changes"
+CHANGED_WINDOW_QUERY = """SELECT min(hour) AS first_time, max(hour) + interval '1 hour' AS last_time
+                          FROM earthquake_changes WHERE change_id > $1"""
 
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
 
-def get_connection() -> connection:
-    """ Establishes a connection with database. """
-    logging.info("Attempting to connect to the database")
-    try:
-        conn = psycopg2.connect(dbname=os.getenv("DB_NAME"),
-                                user=os.getenv("DB_USER"),
-                                password=os.getenv("DB_PASSWORD"),
-                                host=os.getenv("DB_HOST"),
-                                port=os.getenv("DB_PORT"))
-        logging.info("Database connection successful.")
-        return conn
-    except KeyError as e:
-        logging.error("%s missing from environment variables.", e)
-        raise
-    except psycopg2.OperationalError as e:
-        logging.error("Error connecting to database: %s", e)
-        raise
-    except Exception as e:
-        logging.error("Unexpected error while connecting to database: %s", e)
-        raise
-
-
-def get_cursor(connect: connection) -> cursor:
-    """ Create a cursor to send and receive data. """
-    logging.info("Creating database cursor")
+def get_db() -> connection:
+    """Returns the current request's connection, checking one out of the pool on first use."""
+    if "db_conn" not in g:
+        g.db_conn = checkout_connection()
+        # The API only reads, so autocommit saves a BEGIN and a ROLLBACK round trip per request.
+        g.db_conn.autocommit = True
+    return g.db_conn
+
+
+def close_db(exception: BaseException = None) -> None:
+    """Returns the request's connection to the pool, discarding it if the request failed on a connection error."""
+    db_conn = g.pop("db_conn", None)
+    if db_conn is not None:
+        return_connection(db_conn, isinstance(exception, (psycopg2.OperationalError,
+                                                          psycopg2.InterfaceError)))
+
+
+def init_db(app: Flask) -> None:
+    """Registers close_db, so every request gives its connection back when it ends, even if it failed."""
+    app.teardown_appcontext(close_db)
+
+
+def get_select(fields: tuple[str] = None) -> str:
+    """Returns the SELECT of the given fields of earthquakes, or of every field. Pages always need the time and id."""
+    if fields is None:
+        return JOINED_TABLES
+    columns = [column for field, column in FIELD_COLUMNS.items()
+               if field in fields or field in ("earthquake_id", "time")]
+    return f"SELECT {', '.join(columns)} {EARTHQUAKE_JOINS}"
+
+
+def get_page_query(where: str, param_count: int, sort: str, after: bool,
+                   fields: tuple[str] = None) -> str:
+    """
+    Turns a filter into a query for one page in (time, earthquake_id) order. The filter's parameters come first,
+    then the time and id of the last row already returned, when there is one, then the page size.
+    """
+    query = f"{get_select(fields)} WHERE {where}"
+    if after:
+        comparison = ">" if sort == "ASC" else "<"
+        query += f" AND (e.time, e.earthquake_id) {comparison} (${param_count + 1}::timestamptz, ${param_count + 2}::bigint)"
+        param_count += 2
+    return query + f" ORDER BY e.time {sort}, e.earthquake_id {sort} LIMIT ${param_count + 1}"
+
+
+def encode_page_token(row: dict) -> str:
+    """Returns the after token of the page that starts just past the given row."""
+    position = json.dumps([row["time"].isoformat(), row["earthquake_id"]])
+    return base64.urlsafe_b64encode(position.encode()).decode().rstrip("=")
+
+
+def decode_page_token(token: str) -> tuple[str, int]:
+    """Returns the time and earthquake id in an after token, raising ValueError if it is not a valid token."""
     try:
-        return connect.cursor(cursor_factory=RealDictCursor)
-    except Exception as e:
-        logging.error("Failed to create cursor: %s", e)
-        raise
+        time, earthquake_id = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+        datetime.fromisoformat(time)
+    except (ValueError, TypeError) as e:
+        raise ValueError("Invalid after token") from e
+    if not isinstance(earthquake_id, int):
+        raise ValueError("Invalid after token")
+    return time, earthquake_id
+
+
+def bind_numbered(query: str, values: tuple) -> tuple[str, dict]:
+    """
+    Rewrites a query's $1, $2... placeholders for psycopg2 to bind, by number, as filters such as
+    BBOX_FILTER do not write their placeholders in order.
+    """
+    return (re.sub(r"\$(\d+)", r"%(p\1)s", query),
+            {f"p{number}": value for number, value in enumerate(values, start=1)})
+
+
+def get_page(name: str | None, where: str, params: tuple, sort: str = "ASC",
+             limit: int = DEFAULT_PAGE_SIZE, after: str = None,
+             fields: tuple[str] = None) -> tuple[list[dict], str | None]:
+    """
+    Returns a page of the earthquakes matching a filter, and the after token of the next page (None on the last).
+    Each page seeks straight past the previous one instead of skipping rows, so deep pages cost the same as the first.
+    Pages of a named filter run as prepared statements; without a name, the query is bound and planned each time.
+    """
+    if sort not in SORT_ORDERS:
+        raise ValueError(f"sort must be one of {SORT_ORDERS}")
+
+    query = get_page_query(where, len(params), sort, bool(after), fields)
+    values = params + (decode_page_token(after) if after else ()) + (limit + 1,)
+    with get_cursor(get_db()) as app_cursor:
+        if name is None:
+            app_cursor.execute(*bind_numbered(query, values))
+        else:
+            execute_prepared(app_cursor, f"{name}_{sort.lower()}{'_after' if after else ''}", query, values)
+        earthquakes = app_cursor.fetchall()
+
+    if len(earthquakes) > limit:
+        return earthquakes[:limit], encode_page_token(earthquakes[limit - 1])
+    return earthquakes, None
+
+
+def stream_earthquakes(name: str, where: str, params: tuple, sort: str = "ASC",
+                       after: str = None, fields: tuple[str] = None) -> Iterator[dict]:
+    """
+    Yields every earthquake matching a filter, in page order, through a server-side cursor that fetches
+    STREAM_BATCH_SIZE rows at a time, so neither psycopg2 nor the API ever holds the whole result.
+    The cursor lives in a transaction on the request's connection, which is rolled back when the pool gets it back.
+    """
+    if sort not in SORT_ORDERS:
+        raise ValueError(f"sort must be one of {SORT_ORDERS}")
+
+    # A DECLAREd cursor cannot run a prepared statement, so psycopg2 binds the parameters instead.
+    query, values = bind_numbered(get_page_query(where, len(params), sort, bool(after), fields),
+                                  params + (decode_page_token(after) if after else ()) + (None,))
+    db_conn = get_db()
+    db_conn.autocommit = False
+    export_cursor = get_cursor(db_conn, f"{name}_export")
+    export_cursor.itersize = STREAM_BATCH_SIZE
+    export_cursor.execute(query, values)
+    yield from export_cursor
 
 
 def get_earthquake_by_id(earthquake_id: int) -> dict[str, Any]:
-    conn = get_connection()
-    app_cursor = get_cursor(conn)
+    """Returns the earthquake with the given id."""
+    with get_cursor(get_db()) as app_cursor:
+        execute_prepared(app_cursor, "earthquake_by_id",
+                         EARTHQUAKE_BY_ID_QUERY, (earthquake_id,))
+        return app_cursor.fetchall()
+
+
+def get_earthquakes_by_magnitude(min_magnitude: float = -1.0, max_magnitude: float = 10.0,
+                                 limit: int = DEFAULT_PAGE_SIZE, after: str = None) -> tuple[list[dict], str | None]:
+    """Returns a page of earthquakes based on the parameters, and the after token of the next page."""
+    return get_page("earthquakes_by_magnitude", MAGNITUDE_FILTER,
+                    (min_magnitude, max_magnitude), "ASC", limit, after)
+
+
+def get_earthquakes_by_date(start_date: str, end_date: str, sort: str,
+                            limit: int = DEFAULT_PAGE_SIZE, after: str = None) -> tuple[list[dict], str | None]:
+    """Returns a page of earthquakes within a date range, and the after token of the next page."""
+    return get_page("earthquakes_by_date", DATE_FILTER,
+                    (start_date, end_date), sort, limit, after)
+
+
+def get_earthquakes_by_alert_level(color: str, limit: int = DEFAULT_PAGE_SIZE,
+                                   after: str = None) -> tuple[list[dict], str | None]:
+    """Returns a page of earthquakes with a certain alert level, and the after token of the next page."""
+    return get_page("earthquakes_by_alert_level", ALERT_LEVEL_FILTER,
+                    (color,), "ASC", limit, after)
+
+
+def export_earthquakes_by_magnitude(min_magnitude: float = -1.0, max_magnitude: float = 10.0,
+                                    after: str = None) -> Iterator[dict]:
+    """Yields every earthquake in a magnitude range, without paging."""
+    return stream_earthquakes("earthquakes_by_magnitude", MAGNITUDE_FILTER,
+                              (min_magnitude, max_magnitude), "ASC", after)
+
+
+def export_earthquakes_by_date(start_date: str, end_date: str, sort: str,
+                               after: str = None) -> Iterator[dict]:
+    """Yields every earthquake within a date range, without paging."""
+    return stream_earthquakes("earthquakes_by_date", DATE_FILTER,
+                              (start_date, end_date), sort, after)
+
+
+def export_earthquakes_by_alert_level(color: str, after: str = None) -> Iterator[dict]:
+    """Yields every earthquake with a certain alert level, without paging."""
+    return stream_earthquakes("earthquakes_by_alert_level", ALERT_LEVEL_FILTER,
+                              (color,), "ASC", after)
+
 
-    app_cursor.execute(f"{JOINED_TABLES} WHERE earthquake_id={earthquake_id}")
-    return app_cursor.fetchall()
+def compile_search(filters: dict) -> tuple[str, tuple]:
+    """Compiles the given search filters into one condition and its parameters, in a fixed order."""
+    conditions, params = [], []
+    for key, condition in SEARCH_FILTERS.items():
+        if filters.get(key) is not None:
+            params.append(filters[key])
+            conditions.append(condition.format(len(params)))
 
+    if filters.get("bbox"):
+        min_longitude, _, max_longitude, _ = filters["bbox"]
+        # A box crossing the antimeridian runs east from min_longitude, past 180, to max_longitude.
+        longitude_join = "OR" if min_longitude > max_longitude else "AND"
+        conditions.append(BBOX_FILTER.format(*range(len(params) + 1, len(params) + 5),
+                                             join=longitude_join))
+        params.extend(filters["bbox"])
+    return " AND ".join(conditions) or "TRUE", tuple(params)
 
-def get_earthquakes_by_magnitude(min_magnitude: float = -1.0, max_magnitude: float = 10.0) -> list[dict]:
-    """Returns all earthquakes based on the parameters."""
 
-    conn = get_connection()
-    app_cursor = get_cursor(conn)
+def search_earthquakes(filters: dict, sort: str = "ASC", limit: int = DEFAULT_PAGE_SIZE,
+                       after: str = None, fields: tuple[str] = None) -> tuple[list[dict], str | None]:
+    """
+    Returns a page of the earthquakes matching every given filter, and the after token of the next page.
+    Not prepared: each combination of filters and fields would leave its own statement on every pooled connection.
+    """
+    where, params = compile_search(filters)
+    return get_page(None, where, params, sort, limit, after, fields)
 
-    app_cursor.execute(
-        f"{JOINED_TABLES} WHERE e.magnitude BETWEEN {min_magnitude} AND {max_magnitude}")
-    return app_cursor.fetchall()
 
+def export_search(filters: dict, sort: str = "ASC", after: str = None,
+                  fields: tuple[str] = None) -> Iterator[dict]:
+    """Yields every earthquake matching every given filter, without paging."""
+    where, params = compile_search(filters)
+    return stream_earthquakes("search", where, params, sort, after, fields)
 
-def get_earthquakes_by_date(start_date: str, end_date: str, sort: str) -> list[dict]:
-    """Returns all earthquakes within a date range."""
 
-    conn = get_connection()
-    app_cursor = get_cursor(conn)
+def get_earthquakes_near(latitude: float, longitude: float, count: int = DEFAULT_NEAR_COUNT,
+                         radius_km: float = None) -> list[dict]:
+    """Returns the earthquakes nearest a point, closest first with their distance in km, only those within radius_km if given."""
+    with get_cursor(get_db()) as app_cursor:
+        if radius_km is None:
+            execute_prepared(app_cursor, "earthquakes_nearest", NEAREST_QUERY,
+                             (latitude, longitude, count))
+        else:
+            execute_prepared(app_cursor, "earthquakes_within", WITHIN_QUERY,
+                             (latitude, longitude, radius_km, count))
+        return app_cursor.fetchall()
 
-    query = f"""{JOINED_TABLES} WHERE e.time::date BETWEEN %s AND %s 
-            ORDER BY time {sort}"""
 
-    app_cursor.execute(query, (start_date, end_date))
-    return app_cursor.fetchall()
+def get_rollups(period: str, start_date: str, end_date: str, dimension: str = "all",
+                value: str = None) -> list[dict]:
+    """
+    Returns the hourly or daily summaries from start_date to end_date (UTC) for one dimension, oldest first,
+    with the mean magnitude and the strongest earthquake of each. A value limits them to one alert level, network or region.
+    """
+    if period not in ROLLUP_PERIODS:
+        raise ValueError(f"period must be one of {ROLLUP_PERIODS}")
+    bucket = "hour" if period == "hourly" else "day"
+    with get_cursor(get_db()) as app_cursor:
+        execute_prepared(app_cursor, f"rollups_{period}",
+                         ROLLUP_QUERY.format(bucket=bucket, period=period),
+                         (start_date, end_date, dimension, value))
+        return app_cursor.fetchall()
 
 
-def get_earthquakes_by_alert_level(color: str):
-    """Returns all earthquakes with a certain alert level."""
-    conn = get_connection()
-    app_cursor = get_cursor(conn)
+def get_data_watermark() -> int:
+    """Returns the id of the last change the load step logged."""
+    with get_cursor(get_db()) as app_cursor:
+        execute_prepared(app_cursor, "data_watermark", DATA_WATERMARK_QUERY)
+        return app_cursor.fetchone()["change_id"]
 
-    app_cursor.execute(f"{JOINED_TABLES} WHERE a.alert_type = '{color}'")
 
-    return app_cursor.fetchall()
+def get_changed_window(change_id: int) -> tuple[datetime | None, datetime | None]:
+    """Returns the start of the first and the end of the last hour changed after the given watermark."""
+    with get_cursor(get_db()) as app_cursor:
+        execute_prepared(app_cursor, "changed_window", CHANGED_WINDOW_QUERY, (change_id,))
+        row = app_cursor.fetchone()
+    return row["first_time"], row["last_time"]
@@ -1,8 +1,40 @@
 # pylint: skip-file
+import json
+import os
+import re
 import requests
 from unittest.mock import patch
 import pytest
+import psycopg2
+from psycopg2 import sql
+from psycopg2.pool import PoolError
 from api import app
+from cache import reset_cache, get_cache_stats, invalidate_window
+from datetime import datetime, timezone
+from database import *
+from db import get_connection
+
+SEEDED_ROWS = 1_000_000
+SEED_QUERY = """INSERT INTO earthquakes (time, felt_report_count, magnitude, cdi, latitude, longitude, depth,
+                                         detail_url, alert_id, magnitude_id, network_id)
+                SELECT timestamptz '2020-01-01' + n * interval '1 minute', 0, (n % 90) / 10.0, 0,
+                       n % 179 - 89, n % 359 - 179, 10,
+                       'https://example.com', CASE WHEN n % 100 = 0 THEN red.alert_id ELSE green.alert_id END,
+                       m.magnitude_id, nw.network_id
+                FROM generate_series(1, %s) AS n,
+                     (SELECT alert_id FROM alerts WHERE alert_type = 'red') AS red,
+                     (SELECT alert_id FROM alerts WHERE alert_type = 'green') AS green,
+                     (SELECT min(magnitude_id) AS magnitude_id FROM magnitude_types) AS m,
+                     (SELECT min(network_id) AS network_id FROM networks) AS nw"""
+
+
+@pytest.fixture(autouse=True)
+def empty_cache():
+    '''Starts every test with an empty response cache and no watermark checks'''
+    reset_cache()
+    with patch("api.check_watermark"):
+        yield
+    reset_cache()
 
 
 @pytest.fixture
@@ -24,10 +56,10 @@ def test_endpoint_index(client):
 @patch("api.get_earthquake_by_id")
 def test_get_earthquake_by_id_endpoint(mock_db_query, client):
     '''Test the endpoint for getting earthquakes by id'''
-    mock_db_query.return_value = {"id": 1, "test": "test"}
+    mock_db_query.return_value = [{"id": 1, "time": datetime(2024, 12, 3, tzinfo=timezone.utc)}]
     response = client.get("/earthquakes/1")
     assert response.status_code == 200
-    assert response.json == {"id": 1, "test": "test"}
+    assert response.json[0]["id"] == 1
 
 
 @patch("api.get_earthquake_by_id")
@@ -42,7 +74,7 @@ def test_invalid_earthquake_id(mock_db_query, client):
 @patch("api.get_earthquakes_by_magnitude")
 def test_magnitude_endpoint(mock_db_query, client):
     '''Test the magnitude endpoint'''
-    mock_db_query.return_value = [{"test": "1"}, {"test": "2"}]
+    mock_db_query.return_value = ([{"test": "1"}, {"test": "2"}], None)
     response = client.get(
         "/earthquakes/magnitude?min_magnitude=1.0&max_magnitude=8.0")
     assert response.status_code == 200
@@ -52,7 +84,7 @@ def test_magnitude_endpoint(mock_db_query, client):
 @patch("api.get_earthquakes_by_magnitude")
 def test_magnitude_endpoint_no_minmax(mock_db_query, client):
     '''Test correct handling of endpoint calls without query parameters'''
-    mock_db_query.return_value = [{"test": "1"}, {"test": "2"}, {"test": "3"}]
+    mock_db_query.return_value = ([{"test": "1"}, {"test": "2"}, {"test": "3"}], None)
     response = client.get("/earthquakes/magnitude")
     assert response.status_code == 200
     assert response.json == [{"test": "1"}, {"test": "2"}, {"test": "3"}]
@@ -61,7 +93,7 @@ def test_magnitude_endpoint_no_minmax(mock_db_query, client):
 @patch("api.get_earthquakes_by_magnitude")
 def test_magnitude_endpoint_no_earthquakes(mock_db_query, client):
     '''Test the error handling for when no earthquakes are found'''
-    mock_db_query.return_value = None
+    mock_db_query.return_value = ([], None)
     response = client.get("/earthquakes/magnitude")
     assert response.status_code == 404
     assert response.json == {"error": "No earthquakes found"}
@@ -70,7 +102,7 @@ def test_magnitude_endpoint_no_earthquakes(mock_db_query, client):
 @patch("api.get_earthquakes_by_date")
 def test_date_endpoint(mock_db_query, client):
     '''Test the data endpoint'''
-    mock_db_query.return_value = {"test": "test"}
+    mock_db_query.return_value = ({"test": "test"}, None)
     response = client.get(
         "/earthquakes/date?start_date=2024-10-01&end_date=2024-10-10")
     assert response.status_code == 200
@@ -114,7 +146,7 @@ def test_date_endpoint_no_enddate(client):
 @patch("api.get_earthquakes_by_date")
 def test_date_endpoint_no_earthquakes(mock_db_query, client):
     '''Test error handling when no earthquakes are found'''
-    mock_db_query.return_value = None
+    mock_db_query.return_value = ([], None)
     response = client.get(
         "/earthquakes/date?start_date=2024-10-01&end_date=2024-10-10")
     assert response.status_code == 404
@@ -124,7 +156,7 @@ def test_date_endpoint_no_earthquakes(mock_db_query, client):
 @patch("api.get_earthquakes_by_alert_level")
 def test_alert_endpoint(mock_db_query, client):
     '''Test alert endpoint'''
-    mock_db_query.return_value = {"test": "test"}
+    mock_db_query.return_value = ({"test": "test"}, None)
     response = client.get("/earthquakes/alert/green")
     assert response.status_code == 200
     assert response.json == {"test": "test"}
@@ -140,7 +172,534 @@ def test_alert_endpoint_invalid_alert(client):
 @patch("api.get_earthquakes_by_alert_level")
 def test_alert_endpoint_no_earthquakes(mock_db_query, client):
     '''Test the error handling for no earthquakes found'''
-    mock_db_query.return_value = None
+    mock_db_query.return_value = ([], None)
     response = client.get("/earthquakes/alert/red")
     assert response.status_code == 404
     assert response.json == {"error": "No earthquakes found"}
+
+
+@patch("api.get_earthquakes_by_alert_level")
+def test_busy_pool_returns_503(mock_db_query, client):
+    '''Test a request that cannot get a pooled connection is told to retry'''
+    mock_db_query.side_effect = PoolError("No database connection became free in time")
+    response = client.get("/earthquakes/alert/red")
+    assert response.status_code == 503
+
+
+@patch("database.return_connection")
+@patch("database.checkout_connection")
+def test_request_connection_returned_on_teardown(mock_checkout, mock_return):
+    '''Test a request checks out one connection and returns it when it ends'''
+    with app.app_context():
+        assert get_db() is get_db()
+        assert get_db().autocommit is True
+
+    mock_checkout.assert_called_once()
+    mock_return.assert_called_once_with(mock_checkout.return_value, False)
+
+
+@patch("database.return_connection")
+@patch("database.checkout_connection")
+def test_broken_request_connection_discarded(mock_checkout, mock_return):
+    '''Test a connection that failed during the request is not put back for reuse'''
+    with pytest.raises(psycopg2.OperationalError):
+        with app.app_context():
+            get_db()
+            raise psycopg2.OperationalError("server closed the connection")
+
+    mock_return.assert_called_once_with(mock_checkout.return_value, True)
+
+
+@patch("database.checkout_connection")
+def test_request_without_queries_skips_pool(mock_checkout, client):
+    '''Test requests that never query do not take a connection'''
+    client.get("/")
+    mock_checkout.assert_not_called()
+
+
+@patch("database.return_connection")
+@patch("database.checkout_connection")
+def test_query_closes_its_cursor(mock_checkout, mock_return):
+    '''Test the query functions run on the request connection and close their cursor'''
+    cursor = mock_checkout.return_value.cursor.return_value
+    cursor.__enter__.return_value.fetchall.return_value = [{"alert_level": "red"}]
+
+    with app.app_context():
+        assert get_earthquakes_by_alert_level("red") == ([{"alert_level": "red"}], None)
+
+    cursor.__exit__.assert_called_once()
+
+
+@patch("database.return_connection")
+@patch("database.checkout_connection")
+def test_queries_are_prepared_with_parameters(mock_checkout, mock_return):
+    '''Test values are sent as parameters of a prepared statement, never spliced into the SQL'''
+    app_cursor = mock_checkout.return_value.cursor.return_value.__enter__.return_value
+    app_cursor.connection.prepared_statements = set()
+
+    with app.app_context():
+        get_earthquake_by_id("1 OR 1=1")
+        get_earthquake_by_id(2)
+
+    prepare, first, second = app_cursor.execute.call_args_list
+    assert "PREPARE" in repr(prepare.args[0])
+    assert "1 OR 1=1" not in repr(prepare.args[0])
+    assert first.args[1] == ("1 OR 1=1",)
+    assert second.args[1] == (2,)
+
+
+@patch("database.return_connection")
+@patch("database.checkout_connection")
+def test_date_query_rejects_unknown_sort(mock_checkout, mock_return):
+    '''Test the sort order, which cannot be a parameter, is checked before it reaches the SQL'''
+    with app.app_context():
+        with pytest.raises(ValueError):
+            get_earthquakes_by_date("2024-10-01", "2024-10-10", "ASC; DROP TABLE earthquakes")
+
+
+@patch("api.get_earthquakes_by_magnitude")
+def test_list_endpoint_links_next_page(mock_db_query, client):
+    '''Test a page with more after it links to the next page, keeping the filters'''
+    mock_db_query.return_value = ([{"time": datetime(2024, 12, 3, tzinfo=timezone.utc)}], "next-token")
+    response = client.get("/earthquakes/magnitude?min_magnitude=1.0&limit=1")
+    assert response.status_code == 200
+    mock_db_query.assert_called_once_with(1.0, 10.0, 1, None)
+    assert response.headers["Link"] == '</earthquakes/magnitude?min_magnitude=1.0&limit=1&after=next-token>; rel="next"'
+
+
+@patch("api.get_earthquakes_by_alert_level")
+def test_last_page_has_no_link(mock_db_query, client):
+    '''Test the last page has no next link'''
+    mock_db_query.return_value = ([{"test": "1"}], None)
+    response = client.get("/earthquakes/alert/red")
+    assert response.status_code == 200
+    mock_db_query.assert_called_once_with("red", DEFAULT_PAGE_SIZE, None)
+    assert "Link" not in response.headers
+
+
+@pytest.mark.parametrize("query", ["limit=0", "limit=abc", f"limit={MAX_PAGE_SIZE + 1}", "after=not-a-token"])
+def test_list_endpoint_rejects_bad_page_args(query, client):
+    '''Test invalid limit and after parameters are rejected'''
+    response = client.get(f"/earthquakes/alert/red?{query}")
+    assert response.status_code == 400
+    assert "error" in response.json
+
+
+def test_page_token_round_trip():
+    '''Test an after token carries the time and id of the row it was made from'''
+    row = {"time": datetime(2024, 12, 3, 12, 30, 1, 500, tzinfo=timezone.utc), "earthquake_id": 42}
+    assert decode_page_token(encode_page_token(row)) == ("2024-12-03T12:30:01.000500+00:00", 42)
+
+
+def test_get_page_query_seeks_past_last_row():
+    '''Test later pages seek past the last row in the page order instead of skipping rows'''
+    first = get_page_query(ALERT_LEVEL_FILTER, 1, "ASC", False)
+    later = get_page_query(ALERT_LEVEL_FILTER, 1, "DESC", True)
+    assert first.endswith("ORDER BY e.time ASC, e.earthquake_id ASC LIMIT $2")
+    assert "(e.time, e.earthquake_id) < ($2::timestamptz, $3::bigint)" in later
+    assert later.endswith("ORDER BY e.time DESC, e.earthquake_id DESC LIMIT $4")
+    assert "OFFSET" not in later
+
+
+@patch("database.return_connection")
+@patch("database.checkout_connection")
+def test_get_page_fetches_one_extra_row(mock_checkout, mock_return):
+    '''Test one more row than the page is fetched, to tell whether another page follows'''
+    app_cursor = mock_checkout.return_value.cursor.return_value.__enter__.return_value
+    app_cursor.connection.prepared_statements = set()
+    rows = [{"time": datetime(2024, 12, 3, tzinfo=timezone.utc), "earthquake_id": earthquake_id}
+            for earthquake_id in (1, 2, 3)]
+    app_cursor.fetchall.return_value = rows
+
+    with app.app_context():
+        earthquakes, next_page = get_earthquakes_by_alert_level("red", 2)
+
+    assert earthquakes == rows[:2]
+    assert decode_page_token(next_page)[1] == 2
+    assert app_cursor.execute.call_args.args[1] == ("red", 3)
+
+
+
+@patch("api.export_earthquakes_by_alert_level")
+def test_ndjson_accept_streams_lines(mock_export, client):
+    '''Test clients accepting NDJSON get one earthquake per line instead of a page'''
+    mock_export.return_value = iter([{"earthquake_id": 1}, {"earthquake_id": 2}])
+    response = client.get("/earthquakes/alert/red", headers={"Accept": "application/x-ndjson"})
+    assert response.status_code == 200
+    assert response.mimetype == "application/x-ndjson"
+    assert response.get_data(as_text=True) == '{"earthquake_id":1}\n{"earthquake_id":2}\n'
+    mock_export.assert_called_once_with("red", None)
+
+
+@patch("api.export_earthquakes_by_magnitude")
+def test_stream_parameter_streams_json_array(mock_export, client):
+    '''Test stream=1 writes one JSON array as the rows arrive'''
+    mock_export.return_value = iter([{"earthquake_id": 1}, {"earthquake_id": 2}])
+    response = client.get("/earthquakes/magnitude?min_magnitude=1.0&stream=1")
+    assert response.status_code == 200
+    assert response.json == [{"earthquake_id": 1}, {"earthquake_id": 2}]
+    mock_export.assert_called_once_with(1.0, 10.0, None)
+
+
+@patch("api.export_earthquakes_by_date")
+def test_empty_stream_returns_404(mock_export, client):
+    '''Test a streamed export that matches nothing still returns a 404'''
+    mock_export.return_value = iter([])
+    response = client.get("/earthquakes/date?start_date=2024-10-01&end_date=2024-10-10&stream=1")
+    assert response.status_code == 404
+
+
+@patch("api.get_earthquakes_by_alert_level")
+def test_default_accept_gets_a_page(mock_db_query, client):
+    '''Test clients accepting anything are not switched to NDJSON'''
+    mock_db_query.return_value = ([{"test": "1"}], None)
+    response = client.get("/earthquakes/alert/red", headers={"Accept": "*/*"})
+    assert response.mimetype == "application/json"
+    mock_db_query.assert_called_once()
+
+
+@patch("api.STREAM_CHUNK_ROWS", 2)
+@patch("api.export_earthquakes_by_alert_level")
+def test_stream_writes_rows_in_chunks(mock_export, client):
+    '''Test rows are written a chunk at a time rather than all at once'''
+    mock_export.return_value = iter([{"earthquake_id": i} for i in range(5)])
+    response = client.get("/earthquakes/alert/red?stream=1")
+    chunks = list(response.response)
+    assert len(chunks) == 3
+    assert [row["earthquake_id"] for row in json.loads(b"".join(chunks))] == [0, 1, 2, 3, 4]
+
+
+@patch("database.return_connection")
+@patch("database.checkout_connection")
+def test_stream_reads_through_server_side_cursor(mock_checkout, mock_return, client):
+    '''Test exports read from a named cursor in batches inside a transaction, and return the connection when done'''
+    db_conn = mock_checkout.return_value
+    db_conn.cursor.return_value.__iter__.return_value = iter([{"earthquake_id": 1}])
+
+    response = client.get("/earthquakes/alert/red", headers={"Accept": "application/x-ndjson"})
+    assert response.get_data(as_text=True) == '{"earthquake_id":1}\n'
+
+    assert db_conn.cursor.call_args.kwargs["name"] == "earthquakes_by_alert_level_export"
+    assert db_conn.autocommit is False
+    export_cursor = db_conn.cursor.return_value
+    assert export_cursor.itersize == STREAM_BATCH_SIZE
+    query, values = export_cursor.execute.call_args.args
+    assert "$" not in query and query.endswith("LIMIT %(p2)s")
+    assert values == {"p1": "red", "p2": None}
+    mock_return.assert_called_once_with(db_conn, False)
+
+
+@patch("database.return_connection")
+@patch("database.checkout_connection")
+def test_streamed_search_binds_bbox_by_number(mock_checkout, mock_return, client):
+    '''Test a streamed search binds each bbox bound to its own column, though BBOX_FILTER numbers them out of order'''
+    db_conn = mock_checkout.return_value
+    db_conn.cursor.return_value.__iter__.return_value = iter([{"earthquake_id": 1}])
+
+    response = client.get("/earthquakes/search?bbox=-125,32,-114,42", headers={"Accept": "application/x-ndjson"})
+    assert response.status_code == 200
+
+    query, values = db_conn.cursor.return_value.execute.call_args.args
+    bound = re.sub(r"%\((p\d+)\)s", lambda match: repr(values[match.group(1)]), query)
+    assert "e.latitude >= 32.0 AND e.latitude <= 42.0" in bound
+    assert "e.longitude >= -125.0 AND e.longitude <= -114.0" in bound
+
+
+@patch("api.get_earthquakes_by_alert_level")
+def test_repeated_request_served_from_cache(mock_db_query, client):
+    '''Test the same query, with its parameters in any order, only reaches the database once'''
+    mock_db_query.return_value = ([{"test": "1"}], None)
+    first = client.get("/earthquakes/alert/red?limit=5&after=WyIyMDI0LTEyLTAzVDAwOjAwOjAwKzAwOjAwIiwgMV0")
+    second = client.get("/earthquakes/alert/red?after=WyIyMDI0LTEyLTAzVDAwOjAwOjAwKzAwOjAwIiwgMV0&limit=5")
+    assert first.json == second.json == [{"test": "1"}]
+    mock_db_query.assert_called_once()
+    assert get_cache_stats()["hits"] == 1
+
+
+@patch("api.get_earthquakes_by_alert_level")
+def test_conditional_get_returns_304(mock_db_query, client):
+    '''Test results carry an ETag and Cache-Control, and a matching If-None-Match gets an empty 304'''
+    mock_db_query.return_value = ([{"test": "1"}], None)
+    response = client.get("/earthquakes/alert/red")
+    assert response.headers["ETag"]
+    assert "public" in response.headers["Cache-Control"]
+    assert "max-age" in response.headers["Cache-Control"]
+
+    revalidated = client.get("/earthquakes/alert/red", headers={"If-None-Match": response.headers["ETag"]})
+    assert revalidated.status_code == 304
+    assert revalidated.data == b""
+    assert get_cache_stats()["not_modified"] == 1
+
+
+def test_bad_requests_are_not_cached(client):
+    '''Test rejected requests are not kept in the cache'''
+    client.get("/earthquakes/alert/red?limit=0")
+    assert get_cache_stats()["entries"] == 0
+
+
+@patch("api.get_earthquakes_by_alert_level")
+def test_cache_stats_endpoint(mock_db_query, client):
+    '''Test the stats endpoint reports the hit ratio'''
+    mock_db_query.return_value = ([{"test": "1"}], None)
+    client.get("/earthquakes/alert/red")
+    client.get("/earthquakes/alert/red")
+    response = client.get("/cache/stats")
+    assert response.status_code == 200
+    assert response.json["hits"] == 1
+    assert response.json["misses"] == 1
+    assert response.json["hit_ratio"] == 0.5
+
+
+@patch("api.get_earthquakes_by_date")
+def test_date_response_cached_with_its_window(mock_db_query, client):
+    '''Test a date range response remembers the days it covers, so loads elsewhere leave it cached'''
+    mock_db_query.return_value = ([{"time": datetime(2024, 10, 2, tzinfo=timezone.utc)}], None)
+    client.get("/earthquakes/date?start_date=2024-10-01&end_date=2024-10-10")
+
+    assert invalidate_window(datetime(2024, 11, 1, tzinfo=timezone.utc), datetime(2024, 11, 2, tzinfo=timezone.utc)) == 0
+    assert invalidate_window(datetime(2024, 10, 10, 12, tzinfo=timezone.utc), datetime(2024, 10, 10, 13, tzinfo=timezone.utc)) == 1
+
+
+@patch("api.search_earthquakes")
+def test_search_endpoint_combines_filters(mock_search, client):
+    '''Test every filter of a search is passed to one query'''
+    mock_search.return_value = ([{"time": datetime(2024, 3, 2, tzinfo=timezone.utc)}], None)
+    response = client.get("/earthquakes/search?min_magnitude=4&start_date=2024-03-01&end_date=2024-03-31"
+                          "&alert=Orange&network=us&max_depth=70&bbox=-125,32,-114,42&fields=place,magnitude&sort=desc")
+    assert response.status_code == 200
+    filters, sort, limit, after, fields = mock_search.call_args.args
+    assert filters == {"min_magnitude": 4.0, "max_magnitude": None, "min_depth": None, "max_depth": 70.0,
+                       "start_date": "2024-03-01", "end_date": "2024-03-31", "alert_level": "orange",
+                       "network": "us", "bbox": (-125.0, 32.0, -114.0, 42.0)}
+    assert (sort, limit, after, fields) == ("DESC", DEFAULT_PAGE_SIZE, None, ("place", "magnitude"))
+
+
+@patch("api.search_earthquakes")
+def test_search_without_matches_returns_404(mock_search, client):
+    '''Test a search that matches nothing returns a 404'''
+    mock_search.return_value = ([], None)
+    response = client.get("/earthquakes/search?min_magnitude=9.5")
+    assert response.status_code == 404
+
+
+@patch("api.export_search")
+def test_search_can_stream(mock_export, client):
+    '''Test a search can be exported as NDJSON like the other list endpoints'''
+    mock_export.return_value = iter([{"earthquake_id": 1}])
+    response = client.get("/earthquakes/search?network=us", headers={"Accept": "application/x-ndjson"})
+    assert response.get_data(as_text=True) == '{"earthquake_id":1}\n'
+
+
+@pytest.mark.parametrize("query", ["min_magnitude=abc", "max_depth=nan", "start_date=2024/03/01", "alert=pink",
+                                   "bbox=1,2,3", "bbox=-125,42,-114,32", "bbox=-190,32,-114,42",
+                                   "fields=place,secret", "sort=sideways"])
+def test_search_rejects_bad_args(query, client):
+    '''Test invalid search parameters are rejected before any query'''
+    response = client.get(f"/earthquakes/search?{query}")
+    assert response.status_code == 400
+    assert "error" in response.json
+
+
+def test_compile_search_numbers_parameters_in_order():
+    '''Test only the given filters are compiled, each with the next parameter number'''
+    where, params = compile_search({"min_magnitude": 4.0, "max_magnitude": None, "alert_level": "orange",
+                                    "bbox": (-125.0, 32.0, -114.0, 42.0)})
+    assert where == ("e.magnitude >= $1 AND e.alert_id = (SELECT alert_id FROM alerts WHERE alert_type = $2)"
+                     " AND e.latitude >= $4 AND e.latitude <= $6 AND (e.longitude >= $3 AND e.longitude <= $5)")
+    assert params == (4.0, "orange", -125.0, 32.0, -114.0, 42.0)
+    assert compile_search({}) == ("TRUE", ())
+
+
+def test_compile_search_bbox_across_antimeridian():
+    '''Test a box from 170 east to 170 west takes either side of the antimeridian'''
+    where, _ = compile_search({"bbox": (170.0, -10.0, -170.0, 10.0)})
+    assert "(e.longitude >= $1 OR e.longitude <= $3)" in where
+
+
+@patch("database.return_connection")
+@patch("database.checkout_connection")
+def test_search_runs_unprepared(mock_checkout, mock_return):
+    '''Test searches bind their values by number in a plain query, leaving no prepared statement behind'''
+    app_cursor = mock_checkout.return_value.cursor.return_value.__enter__.return_value
+    app_cursor.connection.prepared_statements = set()
+    app_cursor.fetchall.return_value = []
+
+    with app.app_context():
+        search_earthquakes({"network": "us", "bbox": (-125.0, 32.0, -114.0, 42.0)}, fields=("place",))
+
+    (query, values), = [call.args for call in app_cursor.execute.call_args_list]
+    assert "PREPARE" not in query and "$" not in query
+    assert values == {"p1": "us", "p2": -125.0, "p3": 32.0, "p4": -114.0, "p5": 42.0, "p6": DEFAULT_PAGE_SIZE + 1}
+    assert app_cursor.connection.prepared_statements == set()
+
+
+def test_projection_keeps_page_order_columns():
+    '''Test a field projection selects only those fields, plus the time and id pages are ordered by'''
+    query = get_page_query("TRUE", 0, "ASC", False, ("place",))
+    assert query.startswith("SELECT e.earthquake_id, e.place, e.time FROM earthquakes e")
+
+@patch("api.get_earthquakes_near")
+def test_near_endpoint(mock_near, client):
+    '''Test the near endpoint passes the point, count and radius through'''
+    mock_near.return_value = [{"earthquake_id": 1, "distance_km": 12.5}]
+    response = client.get("/earthquakes/near?lat=35.7&long=139.7&radius_km=100&k=5")
+    assert response.status_code == 200
+    assert response.json == [{"earthquake_id": 1, "distance_km": 12.5}]
+    mock_near.assert_called_once_with(35.7, 139.7, 5, 100.0)
+
+
+@patch("api.get_earthquakes_near")
+def test_near_endpoint_defaults_to_k_nearest(mock_near, client):
+    '''Test without a radius the nearest earthquakes are returned wherever they are'''
+    mock_near.return_value = []
+    response = client.get("/earthquakes/near?lat=0&long=0")
+    assert response.status_code == 404
+    mock_near.assert_called_once_with(0.0, 0.0, DEFAULT_NEAR_COUNT, None)
+
+
+@pytest.mark.parametrize("query", ["lat=1", "lat=91&long=0", "lat=0&long=181", "lat=a&long=0",
+                                   "lat=0&long=0&radius_km=0", "lat=0&long=0&k=0",
+                                   f"lat=0&long=0&k={MAX_PAGE_SIZE + 1}"])
+def test_near_endpoint_rejects_bad_args(query, client):
+    '''Test invalid points, radii and counts are rejected'''
+    response = client.get(f"/earthquakes/near?{query}")
+    assert response.status_code == 400
+
+
+@patch("database.return_connection")
+@patch("database.checkout_connection")
+def test_near_query_chosen_by_radius(mock_checkout, mock_return):
+    '''Test the radius query is only used when a radius is given, and both order by the indexed distance'''
+    app_cursor = mock_checkout.return_value.cursor.return_value.__enter__.return_value
+    app_cursor.connection.prepared_statements = set()
+
+    with app.app_context():
+        get_earthquakes_near(35.7, 139.7, 5)
+        get_earthquakes_near(35.7, 139.7, 5, 100.0)
+
+    prepare_nearest, nearest, prepare_within, within = app_cursor.execute.call_args_list
+    assert "ST_DWithin" not in repr(prepare_nearest.args[0])
+    assert "ST_DWithin" in repr(prepare_within.args[0])
+    assert "<->" in repr(prepare_nearest.args[0]) and "<->" in repr(prepare_within.args[0])
+    assert nearest.args[1] == (35.7, 139.7, 5)
+    assert within.args[1] == (35.7, 139.7, 100.0, 5)
+
+@pytest.fixture(scope="module")
+def seeded_cursor():
+    '''A cursor on a transaction holding a million seeded earthquakes, rolled back afterwards'''
+    conn = get_connection()
+    with conn.cursor() as seed_cursor:
+        seed_cursor.execute(SEED_QUERY, (SEEDED_ROWS,))
+        seed_cursor.execute("ANALYZE earthquakes")
+        yield seed_cursor
+    conn.rollback()
+    conn.close()
+
+
+@pytest.mark.skipif(not os.getenv("DB_HOST"), reason="Needs a Postgres database")
+@pytest.mark.parametrize("name, where, params, index", [
+    ("explain_date", DATE_FILTER, ("2020-06-01", "2020-06-02"), "earthquakes_time_id_idx"),
+    ("explain_alert", ALERT_LEVEL_FILTER, ("red",), "earthquakes_alert_time_idx"),
+    ("explain_magnitude", MAGNITUDE_FILTER, (8.5, 8.9), None),
+    ("explain_search", *compile_search({"min_magnitude": 4.0, "start_date": "2020-06-01",
+                                        "end_date": "2020-06-30", "alert_level": "red"}), None),
+])
+def test_filters_use_indexes(seeded_cursor, name, where, params, index):
+    '''Test the page queries of the list endpoints are answered from indexes, not by scanning the table'''
+    seeded_cursor.execute(sql.SQL("PREPARE {} AS ").format(sql.Identifier(name))
+                          + sql.SQL(get_page_query(where, len(params), "ASC", False)))
+    seeded_cursor.execute(sql.SQL("EXPLAIN EXECUTE {} ({})").format(
+        sql.Identifier(name), sql.SQL(", ").join(sql.Placeholder() * (len(params) + 1))),
+        params + (DEFAULT_PAGE_SIZE + 1,))
+    plan = "\n".join(row[0] for row in seeded_cursor.fetchall())
+
+    assert "Seq Scan on earthquakes" not in plan
+    assert "Index" in plan
+    if index:
+        assert index in plan
+
+
+@pytest.mark.skipif(not os.getenv("DB_HOST"), reason="Needs a Postgres database")
+@pytest.mark.parametrize("name, query, params", [
+    ("explain_nearest", NEAREST_QUERY, (35.7, 139.7, 10)),
+    ("explain_within", WITHIN_QUERY, (35.7, 139.7, 100.0, 10)),
+])
+def test_near_queries_use_location_index(seeded_cursor, name, query, params):
+    '''Test nearest and radius queries are answered from the GiST index on location'''
+    seeded_cursor.execute(sql.SQL("PREPARE {} AS ").format(sql.Identifier(name)) + sql.SQL(query))
+    seeded_cursor.execute(sql.SQL("EXPLAIN EXECUTE {} ({})").format(
+        sql.Identifier(name), sql.SQL(", ").join(sql.Placeholder() * len(params))), params)
+    plan = "\n".join(row[0] for row in seeded_cursor.fetchall())
+
+    assert "earthquakes_location_idx" in plan
+    assert "Seq Scan on earthquakes" not in plan
+
+
+@patch("api.get_rollups")
+def test_stats_endpoint(mock_rollups, client):
+    '''Test the stats endpoint reads the rollups of the requested period, dimension and dates'''
+    mock_rollups.return_value = [{"day": "2024-12-03", "dimension": "alert", "value": "red", "earthquake_count": 2}]
+    response = client.get("/stats/daily?start_date=2024-12-01&end_date=2024-12-31&dimension=alert&value=RED")
+    assert response.status_code == 200
+    assert response.json == mock_rollups.return_value
+    mock_rollups.assert_called_once_with("daily", "2024-12-01", "2024-12-31", "alert", "red")
+
+
+@patch("api.get_rollups")
+@patch("api.datetime")
+def test_stats_endpoint_defaults(mock_datetime, mock_rollups, client):
+    '''Test without dates the last day of hours, or the last 30 days, are returned in total'''
+    mock_datetime.now.return_value = datetime(2024, 12, 31, 12, tzinfo=timezone.utc)
+    mock_rollups.return_value = []
+    assert client.get("/stats/hourly").status_code == 404
+    assert client.get("/stats/daily").status_code == 404
+    assert mock_rollups.call_args_list[0].args == ("hourly", "2024-12-31", "2024-12-31", "all", None)
+    assert mock_rollups.call_args_list[1].args == ("daily", "2024-12-02", "2024-12-31", "all", None)
+
+
+@pytest.mark.parametrize("path", ["/stats/daily?start_date=2024-13-01",
+                                  "/stats/daily?start_date=2024-12-02&end_date=2024-12-01",
+                                  "/stats/daily?start_date=2023-01-01&end_date=2024-12-31",
+                                  "/stats/hourly?start_date=2024-01-01&end_date=2024-03-01",
+                                  "/stats/daily?dimension=country",
+                                  "/stats/daily?value=red"])
+def test_stats_endpoint_rejects_bad_args(path, client):
+    '''Test invalid dates, ranges longer than the period allows and unknown dimensions are rejected'''
+    assert client.get(path).status_code == 400
+
+
+def test_stats_endpoint_rejects_unknown_period(client):
+    '''Test only hourly and daily rollups are served'''
+    assert client.get("/stats/weekly").status_code == 404
+
+
+@patch("database.return_connection")
+@patch("database.checkout_connection")
+def test_rollup_queries_read_by_period(mock_checkout, mock_return):
+    '''Test each period is read from its own rollup table through its own prepared statement'''
+    app_cursor = mock_checkout.return_value.cursor.return_value.__enter__.return_value
+    app_cursor.connection.prepared_statements = set()
+
+    with app.app_context():
+        get_rollups("hourly", "2024-12-01", "2024-12-01")
+        get_rollups("daily", "2024-12-01", "2024-12-31", "network", "us")
+        with pytest.raises(ValueError):
+            get_rollups("weekly", "2024-12-01", "2024-12-31")
+
+    prepare_hourly, hourly, prepare_daily, daily = app_cursor.execute.call_args_list
+    assert "earthquake_rollups_hourly" in repr(prepare_hourly.args[0])
+    assert "earthquake_rollups_daily" in repr(prepare_daily.args[0])
+    assert hourly.args[1] == ("2024-12-01", "2024-12-01", "all", None)
+    assert daily.args[1] == ("2024-12-01", "2024-12-31", "network", "us")
+
+
+@pytest.mark.skipif(not os.getenv("DB_HOST"), reason="Needs a Postgres database")
+def test_rollup_query_reads_by_primary_key(seeded_cursor):
+    '''Test a year of daily stats is read from the rollups, without scanning the earthquakes they summarise'''
+    seeded_cursor.execute(sql.SQL("PREPARE explain_rollups AS ")
+                          + sql.SQL(ROLLUP_QUERY.format(bucket="day", period="daily")))
+    seeded_cursor.execute("EXPLAIN EXECUTE explain_rollups ('2020-01-01', '2020-12-31', 'alert', NULL)")
+    plan = "\n".join(row[0] for row in seeded_cursor.fetchall())
+
+    assert "earthquake_rollups_daily" in plan
+    assert "Seq Scan on earthquakes" not in plan
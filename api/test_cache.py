@@ -0,0 +1,153 @@
+# pylint: skip-file
+from unittest.mock import patch
+from datetime import datetime, timezone
+import pytest
+from werkzeug.datastructures import MultiDict
+from cache import *
+from database import encode_page_token
+
+DAY_1 = datetime(2024, 12, 1, tzinfo=timezone.utc)
+DAY_2 = datetime(2024, 12, 2, tzinfo=timezone.utc)
+DAY_3 = datetime(2024, 12, 3, tzinfo=timezone.utc)
+
+
+@pytest.fixture(autouse=True)
+def empty_cache():
+    '''Starts every test with an empty cache'''
+    reset_cache()
+    yield
+    reset_cache()
+
+
+def test_cache_key_ignores_parameter_order():
+    '''Test the same query with its parameters in another order shares a key'''
+    first = get_cache_key("/earthquakes/alert/Red", MultiDict([("limit", "5"), ("after", "x")]))
+    second = get_cache_key("/earthquakes/alert/red", MultiDict([("after", "x"), ("limit", "5")]))
+    assert first == second
+
+
+def test_store_and_get_entry():
+    '''Test a stored response is returned with an ETag of its body'''
+    store_entry("key", b"[]", 200, {}, None)
+    entry = get_entry("key")
+    assert entry["body"] == b"[]"
+    assert entry["etag"] == hashlib.sha1(b"[]").hexdigest()
+
+
+def test_entry_expires_after_ttl(monkeypatch):
+    '''Test entries older than CACHE_TTL are dropped'''
+    monkeypatch.setenv("CACHE_TTL", "0")
+    store_entry("key", b"[]", 200, {}, None)
+    time.sleep(0.01)
+    assert get_entry("key") is None
+    assert CACHE_STATS["expired"] == 1
+
+
+def test_least_recently_used_entry_evicted(monkeypatch):
+    '''Test the cache holds at most CACHE_MAX_ENTRIES, dropping the least recently used'''
+    monkeypatch.setenv("CACHE_MAX_ENTRIES", "2")
+    store_entry("a", b"a", 200, {}, None)
+    store_entry("b", b"b", 200, {}, None)
+    get_entry("a")
+    store_entry("c", b"c", 200, {}, None)
+    assert list(CACHE) == ["a", "c"]
+    assert CACHE_STATS["evictions"] == 1
+
+
+@pytest.mark.parametrize("window, expected", [
+    (None, True),
+    ((DAY_1, DAY_1), False),
+    ((DAY_1, DAY_2), True),
+    ((DAY_3, None), True),
+    ((None, DAY_1), False),
+])
+def test_overlaps(window, expected):
+    '''Test a window overlaps a change only if it includes one of its times'''
+    assert overlaps(window, DAY_2, DAY_3) == expected
+
+
+@patch("cache.get_changed_window")
+@patch("cache.get_data_watermark")
+def test_load_only_invalidates_touched_windows(mock_watermark, mock_window, monkeypatch):
+    '''Test a new watermark drops only the responses built from the times that were loaded or revised'''
+    monkeypatch.setenv("CACHE_CHECK_SECONDS", "0")
+    mock_watermark.return_value = 10
+    check_watermark()
+    store_entry("old", b"[]", 200, {}, (DAY_1, DAY_1))
+    store_entry("new", b"[]", 200, {}, (DAY_2, None))
+
+    mock_watermark.return_value = 11
+    mock_window.return_value = (DAY_3, DAY_3)
+    check_watermark()
+
+    mock_window.assert_called_once_with(10)
+    assert list(CACHE) == ["old"]
+    assert CACHE_STATS["invalidated"] == 1
+
+
+@patch("cache.get_changed_window")
+@patch("cache.get_data_watermark")
+def test_revision_moving_an_earthquake_expires_its_old_time(mock_watermark, mock_window, monkeypatch):
+    '''Test a lookup cached at an earthquake's old time is dropped when a revision moves it to another day'''
+    monkeypatch.setenv("CACHE_CHECK_SECONDS", "0")
+    mock_watermark.return_value = 10
+    check_watermark()
+    old_time = DAY_1.replace(hour=13, minute=42)
+    store_entry("/earthquakes/1?", b"[]", 200, {}, (old_time, old_time))
+
+    # The load logs the hour the earthquake left as well as the hour it moved to.
+    mock_watermark.return_value = 11
+    mock_window.return_value = (DAY_1.replace(hour=13), DAY_3.replace(hour=1))
+    check_watermark()
+
+    assert "/earthquakes/1?" not in CACHE
+
+
+@patch("cache.get_changed_window")
+@patch("cache.get_data_watermark")
+def test_unchanged_watermark_keeps_cache(mock_watermark, mock_window, monkeypatch):
+    '''Test nothing is invalidated while no new data is loaded'''
+    monkeypatch.setenv("CACHE_CHECK_SECONDS", "0")
+    mock_watermark.return_value = 10
+    check_watermark()
+    store_entry("key", b"[]", 200, {}, None)
+    check_watermark()
+    mock_window.assert_not_called()
+    assert "key" in CACHE
+
+
+@patch("cache.get_data_watermark")
+def test_watermark_checked_at_most_every_interval(mock_watermark):
+    '''Test the watermark is not read on every request'''
+    mock_watermark.return_value = 10
+    check_watermark()
+    check_watermark()
+    mock_watermark.assert_called_once()
+
+
+def test_page_window():
+    '''Test a page depends on the times from its start to its last row, or onwards on the last page'''
+    after = encode_page_token({"time": DAY_1, "earthquake_id": 1})
+    rows = [{"time": DAY_2}, {"time": DAY_3}]
+    assert get_page_window(rows, "ASC", after, True) == (DAY_1, DAY_3)
+    assert get_page_window(rows, "ASC", None, False) == (None, None)
+    assert get_page_window(rows, "DESC", after, True) == (DAY_3, DAY_1)
+
+
+def test_date_window_narrows_page_window():
+    '''Test a date range response only depends on the days in the range'''
+    bounds = get_date_window("2024-12-01", "2024-12-02")
+    assert bounds == (DAY_1, DAY_3)
+    assert narrow_window((None, DAY_2), bounds) == (DAY_1, DAY_2)
+
+
+def test_cache_stats():
+    '''Test the hit ratio and mean latencies'''
+    record_request(True, 0.001)
+    record_request(False, 0.003)
+    record_request(True, 0.001, not_modified=True)
+    stats = get_cache_stats()
+    assert stats["hit_ratio"] == pytest.approx(2 / 3)
+    assert stats["mean_hit_ms"] == pytest.approx(1.0)
+    assert stats["mean_miss_ms"] == pytest.approx(3.0)
+    assert stats["not_modified"] == 1
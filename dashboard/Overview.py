@@ -7,7 +7,8 @@ import pydeck as pdk
 import boto3
 from botocore.exceptions import NoCredentialsError, PartialCredentialsError
 from dotenv import load_dotenv
-from db_queries import get_connection, get_cursor, get_data_from_range
+from db import get_connection, get_cursor
+from db_queries import get_data_from_range
 
 BUCKET_NAME = "c14-earthquake-monitor-storage"
 
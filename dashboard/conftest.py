@@ -0,0 +1,7 @@
+# pylint: skip-file
+
+import os
+import sys
+
+# Each image copies shared/db.py next to the component's modules; tests import it from shared/ instead.
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "shared"))
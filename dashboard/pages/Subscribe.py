@@ -6,7 +6,8 @@ import streamlit as st
 import boto3
 from botocore.exceptions import NoCredentialsError, PartialCredentialsError
 from dotenv import load_dotenv
-from db_queries import get_connection, get_cursor, get_regions, get_topic_arns
+from db import get_connection, get_cursor
+from db_queries import get_regions, get_topic_arns
 
 BUCKET_NAME = "c14-earthquake-monitor-storage"
 
@@ -21,55 +21,6 @@ def mock_cursor():
     return mock_cur
 
 
-@patch('psycopg2.connect')
-def test_get_connection_success(mock_connect):
-    """Test get_connection with a successful connection."""
-
-    mock_conn = MagicMock()
-    mock_connect.return_value = mock_conn
-
-    conn = get_connection()
-
-    assert conn == mock_conn
-
-    mock_connect.assert_called_once_with(
-        dbname=os.getenv("DB_NAME"),
-        user=os.getenv("DB_USER"),
-        password=os.getenv("DB_PASSWORD"),
-        host=os.getenv("DB_HOST"),
-        port=os.getenv("DB_PORT")
-    )
-
-
-@patch('psycopg2.connect')
-def test_get_connection_db_error(mock_connect):
-    """Test get_connection with a database error (OperationalError)."""
-
-    mock_connect.side_effect = psycopg2.OperationalError("Connection error")
-
-    with pytest.raises(psycopg2.OperationalError):
-        get_connection()
-
-
-@patch('psycopg2.connect')
-def test_get_connection_missing_env(mock_connect):
-    """Test get_connection with missing environment variables."""
-
-    mock_connect.side_effect = KeyError('DB_NAME')
-
-    with pytest.raises(KeyError):
-        get_connection()
-
-
-@patch('db_queries.logging.error')
-def test_get_cursor_creation_error(mock_connection):
-    """Test get_cursor when cursor creation fails"""
-    mock_connection.cursor.side_effect = Exception("Cursor creation failed")
-
-    with pytest.raises(Exception):
-        get_cursor(mock_connection)
-
-
 def test_get_data_from_range_success(mock_cursor):
     """Test get_data_from_range with a successful query."""
     mock_cursor.fetchall.return_value = [
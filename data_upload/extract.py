@@ -6,9 +6,6 @@ import re
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 import boto3
-import psycopg2
-import psycopg2.extras
-from psycopg2.extensions import connection
 import pandas as pd
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import letter, landscape
@@ -16,6 +13,7 @@ from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, Image
 from reportlab.lib.units import inch
 from reportlab.pdfgen import canvas
+from db import get_connection
 
 
 logging.basicConfig(level=logging.INFO,
@@ -63,17 +61,6 @@ COLUMN_NAME_MAP = {
 }
 
 
-def get_connection() -> connection:
-    """Gets connection to database"""
-    return psycopg2.connect(
-        user=os.getenv("DB_USER"),
-        password=os.getenv("DB_PASSWORD"),
-        host=os.getenv("DB_HOST"),
-        port=os.getenv("DB_PORT"),
-        database=os.getenv("DB_NAME")
-    )
-
-
 def normalise_text(text: str) -> str:
     """Converts special Unicode characters to plain ASCII equivalents"""
     if not isinstance(text, str):
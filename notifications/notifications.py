@@ -5,46 +5,13 @@ from dotenv import load_dotenv
 import re
 import boto3
 from boto3 import client
-from psycopg2 import connect, OperationalError
-from psycopg2.extensions import connection, cursor
-from psycopg2.extras import RealDictCursor
+from psycopg2.extensions import cursor
+from db import get_cursor, get_shared_connection, transaction
 
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
 
-def get_connection() -> connection:
-    '''Function to get the connection to the RDS'''
-    logging.info("Attempting to connect to the database")
-    try:
-        conn = connect(dbname=os.getenv("DB_NAME"),
-                       user=os.getenv("DB_USER"),
-                       password=os.getenv("DB_PASSWORD"),
-                       host=os.getenv("DB_HOST"),
-                       port=os.getenv("DB_PORT"))
-        logging.info("Database connection successful.")
-        return conn
-    except KeyError as e:
-        logging.error("%s missing from environment variables.", e)
-        raise
-    except OperationalError as e:
-        logging.error("Error connecting to database: %s", e)
-        raise
-    except Exception as e:
-        logging.error("Unexpected error while connecting to database: %s", e)
-        raise
-
-
-def get_cursor(conn: connection) -> cursor:
-    '''Function to get the cursor for the RDS connection'''
-    logging.info("Creating database cursor")
-    try:
-        return conn.cursor(cursor_factory=RealDictCursor)
-    except Exception as e:
-        logging.error("Failed to create cursor: %s", e)
-        raise
-
-
 def get_client() -> client:
     '''Function to get a client for the SNS service'''
     return boto3.client('sns',
@@ -94,24 +61,25 @@ def get_topic_arn(topic_name: str, curs: cursor) -> str:
 def lambda_handler(event, context):
     '''Lambda handler function to be executed within the lambda function on the cloud'''
     load_dotenv()
-    rds_connection = get_connection()
+    rds_connection = get_shared_connection()
     rds_cursor = get_cursor(rds_connection)
-    for earthquake in event:
-        topics = get_topics(earthquake, rds_cursor)
-        sns_client = get_client()
-        logging.info("Notifying subscribers")
-        for topic in topics:
-            topic_arn = get_topic_arn(topic, rds_cursor)
-            try:
-                sns_client.publish(TopicArn=topic_arn,
-                                   Subject=f"Earthquake Warning",
-                                   Message=f"""Warning! Alert Level {earthquake['alert'].title()}
+    with transaction(rds_connection):
+        for earthquake in event:
+            topics = get_topics(earthquake, rds_cursor)
+            sns_client = get_client()
+            logging.info("Notifying subscribers")
+            for topic in topics:
+                topic_arn = get_topic_arn(topic, rds_cursor)
+                try:
+                    sns_client.publish(TopicArn=topic_arn,
+                                       Subject=f"Earthquake Warning",
+                                       Message=f"""Warning! Alert Level {earthquake['alert'].title()}
 Earthquake of magnitude {earthquake['magnitude']} {earthquake['location']} ({earthquake['latitude']:.2f},\
 {earthquake['longitude']:.2f}) at {earthquake['at']}
 More information can be found at: {earthquake['event_url']}""")
-            except Exception as e:
-                logging.error(
-                    f"Could not send notifications to topic: {topic}. Error: {e}")
+                except Exception as e:
+                    logging.error(
+                        f"Could not send notifications to topic: {topic}. Error: {e}")
 
 
 if __name__ == "__main__":
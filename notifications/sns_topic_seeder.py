@@ -1,51 +1,17 @@
 """Creates SNS topics based of region and magnitude, then seeds those topics into RDS."""
 
-import os
 import logging
 import psycopg2
 from psycopg2.extensions import connection, cursor
-from psycopg2.extras import RealDictCursor
 import boto3
 from dotenv import load_dotenv
+from db import get_connection, get_cursor
 
 
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
 
-def get_connection() -> connection:
-    """ Establishes a connection with database. """
-
-    logging.info("Attempting to connect to the database")
-    try:
-        conn = psycopg2.connect(dbname=os.getenv("DB_NAME"),
-                                user=os.getenv("DB_USER"),
-                                password=os.getenv("DB_PASSWORD"),
-                                host=os.getenv("DB_HOST"),
-                                port=os.getenv("DB_PORT"))
-        logging.info("Database connection successful.")
-        return conn
-    except KeyError as e:
-        logging.error("%s missing from environment variables.", e)
-        raise
-    except psycopg2.OperationalError as e:
-        logging.error("Error connecting to database: %s", e)
-        raise
-    except Exception as e:
-        logging.error("Unexpected error while connecting to database: %s", e)
-        raise
-
-
-def get_cursor(connect: connection) -> cursor:
-    """ Create a cursor to send and receive data. """
-    logging.info("Creating database cursor")
-    try:
-        return connect.cursor(cursor_factory=RealDictCursor)
-    except Exception as e:
-        logging.error("Failed to create cursor: %s", e)
-        raise
-
-
 def get_regions(cursor: cursor) -> list[str]:
     """Gets all the region names"""
 
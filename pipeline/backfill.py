@@ -0,0 +1,143 @@
+# pylint: disable=line-too-long
+
+'''
+Module that rebuilds the earthquakes table for a historical date range.
+Uses the USGS FDSN event query API, as the summary feeds only cover the last month.
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from datetime import datetime, timedelta
+from itertools import islice
+from typing import Iterator
+from urllib.parse import urlencode
+import argparse
+import logging
+from dotenv import load_dotenv
+from extract import stream_data, deduplicate
+from transform import clean_data
+from db import get_connection
+from load import load_data
+from batch import EarthquakeBatch
+
+FDSN_URL = "https://earthquake.usgs.gov/fdsnws/event/1/query"
+WINDOW = timedelta(days=1)
+MAX_WORKERS = 4
+PAGE_LIMIT = 20000
+LOAD_CHUNK_SIZE = 1000
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+def split_windows(start: datetime, end: datetime, window: timedelta = WINDOW) -> list[tuple[datetime, datetime]]:
+    '''Splits [start, end) into consecutive windows no longer than window.'''
+    if start >= end:
+        raise ValueError("Backfill start must be before end.")
+
+    windows = []
+    while start < end:
+        windows.append((start, min(start + window, end)))
+        start += window
+    return windows
+
+
+def build_query_url(start: datetime, end: datetime, offset: int = 1,
+                    limit: int = PAGE_LIMIT, base_url: str = FDSN_URL) -> str:
+    '''Builds an FDSN event query for one page of a time window.'''
+    return f"{base_url}?" + urlencode({"format": "geojson",
+                                       "starttime": start.isoformat(),
+                                       "endtime": end.isoformat(),
+                                       "orderby": "time-asc",
+                                       "offset": offset,
+                                       "limit": limit})
+
+
+def fetch_window(start: datetime, end: datetime, limit: int = PAGE_LIMIT,
+                 base_url: str = FDSN_URL) -> list[dict]:
+    '''
+    Fetches every page of one time window. Pages are followed until one holds fewer than limit features,
+    counting the features stream_data skipped, so a malformed feature does not end the window early.
+    '''
+    records = []
+    offset = 1
+    while True:
+        counts = {}
+        page = list(stream_data(build_query_url(
+            start, end, offset, limit, base_url), counts=counts))
+        records.extend(page)
+        if counts["features"] > len(page):
+            logging.warning("Skipped %s malformed earthquakes between %s and %s at offset %s",
+                            counts["features"] - len(page), start, end, offset)
+        if counts["features"] < limit:
+            break
+        offset += limit
+
+    logging.info("Fetched %s earthquakes between %s and %s",
+                 len(records), start, end)
+    return records
+
+
+def iter_backfill(start: datetime, end: datetime, window: timedelta = WINDOW,
+                  max_workers: int = MAX_WORKERS, limit: int = PAGE_LIMIT,
+                  base_url: str = FDSN_URL) -> Iterator[dict]:
+    '''
+    Fetches the windows of [start, end) concurrently and yields the merged, deduplicated records in time order.
+    At most 2 * max_workers windows are in flight, so memory is bounded however long the range is.
+    Adjacent windows share their boundary instant, so only the previous window's ids are needed for deduplication.
+    '''
+    windows = deque(split_windows(start, end, window))
+    previous_ids = set()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = deque()
+        while windows or in_flight:
+            while windows and len(in_flight) < 2 * max_workers:
+                window_start, window_end = windows.popleft()
+                in_flight.append(executor.submit(
+                    fetch_window, window_start, window_end, limit, base_url))
+
+            records = deduplicate(in_flight.popleft().result(), previous_ids)
+            previous_ids = {earthquake["event_id"] for earthquake in records}
+            yield from records
+
+
+def run_backfill(start: datetime, end: datetime, window: timedelta = WINDOW,
+                 max_workers: int = MAX_WORKERS, chunk_size: int = LOAD_CHUNK_SIZE,
+                 base_url: str = FDSN_URL) -> int:
+    '''Streams the backfilled records through clean_data and load_data in chunks. Returns the number of records extracted.'''
+    load_dotenv()
+    conn = get_connection()
+    total = 0
+    earthquakes = iter_backfill(
+        start, end, window, max_workers, base_url=base_url)
+
+    while True:
+        chunk = EarthquakeBatch.from_records(islice(earthquakes, chunk_size))
+        if len(chunk) == 0:
+            break
+        total += len(chunk)
+        load_data(clean_data(chunk), conn=conn)
+
+    logging.info("Backfilled %s earthquakes between %s and %s",
+                 total, start, end)
+    return total
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Backfill the earthquakes table from the USGS FDSN event API.")
+    parser.add_argument("start", type=datetime.fromisoformat,
+                        help="Start of the range (UTC), e.g. 2024-01-01")
+    parser.add_argument("end", type=datetime.fromisoformat,
+                        help="End of the range (UTC, exclusive), e.g. 2024-02-01")
+    parser.add_argument("--window-hours", type=int, default=24,
+                        help="Length of each fetched window in hours")
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS,
+                        help="Number of windows fetched concurrently")
+    parser.add_argument("--chunk-size", type=int, default=LOAD_CHUNK_SIZE,
+                        help="Number of records transformed and loaded at a time")
+    args = parser.parse_args()
+
+    run_backfill(args.start, args.end, timedelta(hours=args.window_hours),
+                 args.workers, args.chunk_size)
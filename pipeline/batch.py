@@ -0,0 +1,114 @@
+# pylint: disable=line-too-long
+
+'''
+Module with the columnar batch type passed between extract, transform and load.
+Each column is held as one NumPy array instead of one dict per earthquake.
+'''
+
+from typing import Iterable
+import numpy as np
+import pandas as pd
+
+COLUMNS = ("at", "event_url", "felt", "location", "magnitude", "network", "alert",
+           "magnitude_type", "cdi", "longitude", "latitude", "depth", "updated", "event_id")
+FLOAT_COLUMNS = ("magnitude", "longitude", "latitude", "depth")
+NUMERIC_COLUMNS = ("felt", "cdi")
+DATETIME_COLUMNS = ("at",)
+INTEGER_COLUMNS = ("updated",)
+
+
+def to_float_array(values: list) -> np.ndarray:
+    '''
+    Converts values to float64. Anything that is not a number (None, strings) becomes NaN,
+    which the range checks in transform reject just as they rejected non-numeric types.
+    '''
+    return np.fromiter((value if isinstance(value, (int, float)) else np.nan for value in values),
+                       dtype=np.float64, count=len(values))
+
+
+def to_numeric_array(values: list) -> np.ndarray:
+    '''Converts values to float64 the way pd.to_numeric(errors="coerce") does, parsing numeric strings.'''
+    return pd.to_numeric(np.array(values, dtype=object), errors="coerce").astype(np.float64)
+
+
+def to_column(name: str, values: list) -> np.ndarray:
+    '''Converts a list of raw values into the array type used for the column.'''
+    if name in FLOAT_COLUMNS:
+        return to_float_array(values)
+    if name in NUMERIC_COLUMNS:
+        return to_numeric_array(values)
+    if name in DATETIME_COLUMNS:
+        return np.array(values, dtype="datetime64[us]")
+    if name in INTEGER_COLUMNS:
+        return np.array([0 if value is None else value for value in values], dtype=np.int64)
+    array = np.empty(len(values), dtype=object)
+    array[:] = values
+    return array
+
+
+class EarthquakeBatch:
+    '''A batch of earthquake records stored column by column.'''
+    __slots__ = ("columns",)
+
+    def __init__(self, columns: dict[str, np.ndarray]):
+        lengths = {len(values) for values in columns.values()}
+        if len(lengths) > 1:
+            raise ValueError("All columns of a batch must have the same length.")
+        self.columns = columns
+
+    @classmethod
+    def from_records(cls, records: Iterable[dict]) -> "EarthquakeBatch":
+        '''Builds a batch from record dicts, consuming them one at a time so a generator is never materialised.'''
+        values = {name: [] for name in COLUMNS}
+        appenders = [(name, values[name].append) for name in COLUMNS]
+        for record in records:
+            for name, append in appenders:
+                append(record.get(name))
+
+        return cls({name: to_column(name, column_values)
+                    for name, column_values in values.items()})
+
+    @classmethod
+    def concat(cls, batches: list["EarthquakeBatch"]) -> "EarthquakeBatch":
+        '''Joins several batches into one.'''
+        if not batches:
+            return cls.from_records([])
+        return cls({name: np.concatenate([batch[name] for batch in batches])
+                    for name in batches[0].columns})
+
+    def __len__(self) -> int:
+        return len(next(iter(self.columns.values()), ()))
+
+    def __getitem__(self, column: str) -> np.ndarray:
+        return self.columns[column]
+
+    def __setitem__(self, column: str, values: np.ndarray) -> None:
+        if len(values) != len(self):
+            raise ValueError(f"Column {column} does not match the batch length.")
+        self.columns[column] = values
+
+    def __repr__(self) -> str:
+        return f"EarthquakeBatch({len(self)} rows)"
+
+    def filter(self, mask: np.ndarray) -> "EarthquakeBatch":
+        '''Returns a new batch holding only the rows where mask is True, or the rows at the given indices.'''
+        return EarthquakeBatch({name: values[mask] for name, values in self.columns.items()})
+
+    def rows(self, columns: Iterable[str]) -> Iterable[tuple]:
+        '''Yields one tuple of plain Python values per row, ready to be passed to psycopg2.'''
+        return zip(*(self.columns[name].tolist() for name in columns))
+
+    def to_records(self, stringify_datetimes: bool = False) -> list[dict]:
+        '''
+        Converts the batch back into record dicts of plain Python values, e.g. for the Lambda response.
+        With stringify_datetimes, datetime columns are formatted as "YYYY-MM-DD HH:MM:SS".
+        '''
+        columns = {}
+        for name, values in self.columns.items():
+            if stringify_datetimes and np.issubdtype(values.dtype, np.datetime64):
+                columns[name] = np.char.replace(np.datetime_as_string(
+                    values, unit="s"), "T", " ").tolist()
+            else:
+                columns[name] = values.tolist()
+        names = list(columns)
+        return [dict(zip(names, row)) for row in zip(*columns.values())]
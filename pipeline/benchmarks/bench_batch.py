@@ -0,0 +1,132 @@
+# pylint: disable=line-too-long
+
+'''
+Benchmark of the record-dict pipeline against the columnar EarthquakeBatch pipeline.
+Runs extract normalisation, transform and load preparation over a synthetic 100k-event feed
+and reports wall time and peak traced memory for each.
+
+Run from the pipeline directory:
+    python -m benchmarks.bench_batch [--events 100000]
+'''
+
+from datetime import datetime
+import argparse
+import logging
+import random
+import time
+import tracemalloc
+import pandas as pd
+from extract import format_earthquake
+from transform import clean_data, GREEN, ZERO, MIN_CDI
+from load import INSERT_COLUMNS
+from batch import EarthquakeBatch
+from benchmarks.bench_validation import apply_validation
+
+NETWORKS = ("ak", "ci", "hv", "nc", "nn", "us", "uw")
+MAGNITUDE_TYPES = ("md", "ml", "mb", "mw")
+
+
+def make_feed(events: int) -> list[dict]:
+    '''Builds decoded GeoJSON features resembling the USGS summary feeds.'''
+    rng = random.Random(42)
+    now = int(datetime.now().timestamp() * 1000)
+    return [{
+        "type": "Feature",
+        "properties": {
+            "mag": round(rng.uniform(-1, 8), 2),
+            "place": f"{rng.randint(1, 99)} km NE of Somewhere, {rng.choice(('CA', 'Alaska', 'Hawaii'))}",
+            "time": now - i * 1000,
+            "updated": now - i * 500,
+            "felt": rng.choice((None, None, rng.randint(0, 500))),
+            "cdi": rng.choice((None, round(rng.uniform(0, 9), 1))),
+            "alert": rng.choice((None, None, None, "green", "yellow")),
+            "detail": f"https://earthquake.usgs.gov/earthquakes/feed/v1.0/detail/us{i}.geojson",
+            "net": rng.choice(NETWORKS),
+            "magType": rng.choice(MAGNITUDE_TYPES),
+        },
+        "geometry": {"coordinates": [round(rng.uniform(-180, 180), 4),
+                                     round(rng.uniform(-90, 90), 4),
+                                     round(rng.uniform(-5, 700), 2)]},
+        "id": f"us{i}"
+    } for i in range(events)]
+
+
+def legacy_clean_data(earthquake_data: list[dict]) -> list[dict]:
+    '''The list-of-dicts transform the pipeline used before EarthquakeBatch.'''
+    earthquake_df = pd.DataFrame(earthquake_data)
+    earthquake_df["felt"] = pd.to_numeric(
+        earthquake_df["felt"], errors="coerce").fillna(ZERO)
+    earthquake_df["alert"] = earthquake_df["alert"].fillna(GREEN)
+    earthquake_df["cdi"] = pd.to_numeric(
+        earthquake_df["cdi"], errors="coerce").fillna(MIN_CDI)
+
+    earthquake_df = apply_validation(earthquake_df)
+    earthquake_df["at"] = earthquake_df['at'].apply(
+        lambda x: x.replace(microsecond=ZERO))
+    return earthquake_df.to_dict(orient='records')
+
+
+def transform_records(features: list[dict]) -> list[dict]:
+    '''Record-dict extract and transform: list of dicts -> DataFrame -> list of dicts.'''
+    records = [format_earthquake(feature) for feature in features]
+    return legacy_clean_data(records)
+
+
+def run_records(features: list[dict]) -> int:
+    '''Record-dict pipeline, including insert rows and the stringify loop for the Lambda response.'''
+    cleaned = transform_records(features)
+    rows = [tuple(earthquake[column] for column in INSERT_COLUMNS)
+            for earthquake in cleaned]
+    for earthquake in cleaned:
+        earthquake['at'] = str(earthquake['at'])
+    return len(rows) + len(cleaned)
+
+
+def transform_batch(features: list[dict]) -> EarthquakeBatch:
+    '''Columnar extract and transform: generator -> EarthquakeBatch -> EarthquakeBatch.'''
+    return clean_data(EarthquakeBatch.from_records(
+        format_earthquake(feature) for feature in features))
+
+
+def run_batch(features: list[dict]) -> int:
+    '''Columnar pipeline, including insert rows and the records for the Lambda response.'''
+    cleaned = transform_batch(features)
+    rows = list(cleaned.rows(INSERT_COLUMNS))
+    body = cleaned.to_records(stringify_datetimes=True)
+    return len(rows) + len(body)
+
+
+def measure(pipeline, features: list[dict]) -> tuple[float, float]:
+    '''Returns (seconds, peak MiB traced) for one pipeline run.'''
+    start = time.perf_counter()
+    pipeline(features)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    pipeline(features)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak / 2 ** 20
+
+
+def main() -> None:
+    '''Runs both pipelines over one synthetic feed and prints the time and peak memory of each stage.'''
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=100_000)
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+
+    synthetic_feed = make_feed(args.events)
+    print(f"{args.events} synthetic events")
+    print(f"{'stage':<22}{'pipeline':<10}{'time (s)':>10}{'peak (MiB)':>12}")
+    for stage, runs in (("extract + transform", (("records", transform_records), ("batch", transform_batch))),
+                        ("end to end", (("records", run_records), ("batch", run_batch)))):
+        for name, run in runs:
+            seconds, peak_mib = measure(run, synthetic_feed)
+            print(f"{stage:<22}{name:<10}{seconds:>10.2f}{peak_mib:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
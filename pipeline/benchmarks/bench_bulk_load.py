@@ -0,0 +1,76 @@
+# pylint: disable=line-too-long
+
+'''
+Benchmark of rows per second loaded into the earthquakes table with executemany, execute_values and COPY,
+and through the staging table upsert that load_data uses.
+Needs a Postgres database with schema.sql applied, configured through the same DB_* environment
+variables as the pipeline. Each method runs inside a transaction that is rolled back, so no rows are kept.
+
+Run from the pipeline directory:
+    python -m benchmarks.bench_bulk_load [--events 1000 10000 100000]
+'''
+
+import argparse
+import logging
+import os
+import sys
+import time
+from dotenv import load_dotenv
+from psycopg2.extras import execute_values
+from db import get_connection, get_cursor
+from load import get_earthquake_values, copy_into_earthquake, upsert_earthquakes, INSERT_QUERY, EARTHQUAKE_COLUMNS
+from batch import EarthquakeBatch
+from benchmarks.bench_batch import make_feed
+from extract import format_earthquake
+from transform import clean_data
+
+
+def load_with_executemany(db_cursor, value_list: list[tuple]) -> None:
+    '''One INSERT statement per row, as psycopg2's executemany sends them.'''
+    db_cursor.executemany(INSERT_QUERY.format("earthquakes"), value_list)
+
+
+def load_with_execute_values(db_cursor, value_list: list[tuple]) -> None:
+    '''Multi-row INSERT statements of up to 1000 rows each.'''
+    execute_values(db_cursor, f"INSERT INTO earthquakes ({', '.join(EARTHQUAKE_COLUMNS)}) VALUES %s",
+                   value_list, page_size=1000)
+
+
+METHODS = (("executemany", load_with_executemany),
+           ("execute_values", load_with_execute_values),
+           ("COPY", copy_into_earthquake),
+           ("staged upsert", upsert_earthquakes))
+
+
+def main() -> None:
+    '''Loads batches of each size with every method, rolling each back, and prints rows per second.'''
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, nargs="+", default=[1000, 10000, 100000])
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    load_dotenv()
+    if not os.getenv("DB_HOST"):
+        sys.exit("Set DB_HOST, DB_PORT, DB_NAME, DB_USER and DB_PASSWORD to a Postgres database with schema.sql applied.")
+
+    conn = get_connection()
+    app_cursor = get_cursor(conn)
+    print(f"{'events':>10}" + "".join(f"{name + ' rows/s':>22}" for name, _ in METHODS))
+    for events in args.events:
+        batch = clean_data(EarthquakeBatch.from_records(
+            format_earthquake(feature) for feature in make_feed(events)))
+        value_list = get_earthquake_values(app_cursor, batch)
+        conn.commit()
+
+        rates = []
+        for _, load in METHODS:
+            start = time.perf_counter()
+            load(app_cursor, value_list)
+            rates.append(len(value_list) / (time.perf_counter() - start))
+            conn.rollback()
+        print(f"{events:>10}" + "".join(f"{rate:>22,.0f}" for rate in rates))
+
+
+if __name__ == "__main__":
+    main()
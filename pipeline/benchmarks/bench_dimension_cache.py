@@ -0,0 +1,125 @@
+# pylint: disable=line-too-long
+
+'''
+Benchmark of database round-trips made by insert_into_earthquake for one batch, comparing
+per-record foreign key lookups with the cached lookup tables.
+A counting cursor stands in for the database and sleeps for a simulated round-trip time on each statement
+(psycopg2's executemany sends one statement per row, so it is counted per row).
+
+Run from the pipeline directory:
+    python -m benchmarks.bench_dimension_cache [--events 500] [--rtt-ms 1.0]
+'''
+
+import argparse
+import logging
+import time
+from load import insert_into_earthquake, reset_dimension_cache, INSERT_COLUMNS, DIMENSIONS
+from batch import EarthquakeBatch
+from benchmarks.bench_batch import make_feed, NETWORKS, MAGNITUDE_TYPES
+from extract import format_earthquake
+from transform import clean_data
+
+ALERTS = ("green", "yellow", "orange", "red")
+
+
+class Connection:
+    '''Connection stand-in.'''
+
+    def __init__(self):
+        self.prepared_statements = set()
+
+    def commit(self):
+        '''Commits nothing.'''
+
+
+class CountingCursor:
+    '''Cursor stand-in that counts round-trips and answers the lookup queries.'''
+
+    def __init__(self, rtt: float):
+        self.connection = Connection()
+        self.rowcount = 0
+        self.rtt = rtt
+        self.round_trips = 0
+        self.insert_round_trips = 0
+        self.query = None
+
+    def execute(self, query, params=None):  # pylint: disable=unused-argument
+        '''Runs one statement.'''
+        self.query = query
+        self.round_trips += 1
+        time.sleep(self.rtt)
+
+    def executemany(self, query, params_list):  # pylint: disable=unused-argument
+        '''Runs one statement per row, as psycopg2 does.'''
+        self.insert_round_trips += len(params_list)
+        time.sleep(self.rtt * len(params_list))
+
+    def fetchone(self):
+        '''Answers a per-record foreign key lookup.'''
+        return {"id": 1}
+
+    def fetchall(self):
+        '''Answers a lookup table load.'''
+        for table_name, key_column, value_column, values in (
+                DIMENSIONS["alert"] + (ALERTS,),
+                DIMENSIONS["magnitude_type"] + (MAGNITUDE_TYPES,),
+                DIMENSIONS["network"] + (NETWORKS,)):
+            if table_name in self.query:
+                return [{key_column: key, value_column: value} for key, value in enumerate(values, 1)]
+        return []
+
+
+def get_foreign_key(db_cursor: CountingCursor, table_name: str, column_name: str, value: str) -> int:
+    '''Looks up one foreign key, as load.py did before the dimension cache.'''
+    db_cursor.execute(f"SELECT * FROM {table_name} WHERE {column_name} = %s", (value,))
+    result = db_cursor.fetchone()
+    if result:
+        return result[next(iter(result))]
+    raise ValueError(f"{value!r} not in {table_name}")
+
+
+def per_record_insert(db_conn: Connection, db_cursor: CountingCursor, earthquake_data: EarthquakeBatch) -> None:
+    '''insert_into_earthquake as it was before the dimension cache, with three lookups per record.'''
+    value_list = []
+    for row in earthquake_data.rows(INSERT_COLUMNS):
+        alert_id = get_foreign_key(db_cursor, 'alerts', 'alert_type', row[7])
+        magnitude_id = get_foreign_key(db_cursor, 'magnitude_types', 'magnitude_type', row[8])
+        network_id = get_foreign_key(db_cursor, 'networks', 'network_name', row[9])
+        value_list.append(row[:7] + (alert_id, magnitude_id, network_id) + row[10:])
+    db_cursor.executemany(None, value_list)
+    db_conn.commit()
+
+
+def measure(label: str, insert, earthquake_data: EarthquakeBatch, rtt: float) -> None:
+    '''Prints the lookup and insert round-trips made for the batch, and the total time.'''
+    db_cursor = CountingCursor(rtt)
+    start = time.perf_counter()
+    insert(db_cursor.connection, db_cursor, earthquake_data)
+    seconds = time.perf_counter() - start
+    print(f"{label:<26}{db_cursor.round_trips:>10}{db_cursor.insert_round_trips:>10}{seconds:>12.3f}")
+
+
+def main() -> None:
+    '''Prints the round-trips of one batch with per-record lookups and with the cache, cold and warm.'''
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=500)
+    parser.add_argument("--rtt-ms", type=float, default=1.0,
+                        help="Simulated database round-trip time in milliseconds")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    batch = clean_data(EarthquakeBatch.from_records(
+        format_earthquake(feature) for feature in make_feed(args.events)))
+    rtt = args.rtt_ms / 1000
+
+    print(f"{len(batch)} events, {args.rtt_ms} ms simulated round-trip")
+    print(f"{'':<26}{'lookups':>10}{'inserts':>10}{'seconds':>12}")
+    measure("per record (before)", per_record_insert, batch, rtt)
+    reset_dimension_cache()
+    measure("cached, cold container", insert_into_earthquake, batch, rtt)
+    measure("cached, warm container", insert_into_earthquake, batch, rtt)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+# pylint: disable=line-too-long
+
+'''
+Benchmark of the per-row .apply() validation the pipeline used to run against the vectorised validate_data.
+A month of the all_month feed is roughly 10k events; larger sizes show how each approach scales.
+
+Run from the pipeline directory:
+    python -m benchmarks.bench_validation [--events 10000 100000 1000000]
+'''
+
+import argparse
+import logging
+import time
+import numpy as np
+import pandas as pd
+from transform import (validate_data, MIN_LAT, MAX_LAT, MIN_LON, MAX_LON, MIN_MAGNITUDE, MAX_MAGNITUDE,
+                       MIN_CDI, MAX_CDI, MIN_DEPTH, MAX_DEPTH)
+from batch import EarthquakeBatch, COLUMNS
+
+
+def is_valid_latitude(lat: float) -> bool:
+    '''Checks if latitude is valid'''
+    if not isinstance(lat, (float, int)):
+        logging.error("Invalid latitude type: %s", type(lat))
+        return False
+    return MIN_LAT <= lat <= MAX_LAT
+
+
+def is_valid_longitude(lon: float) -> bool:
+    '''Checks if longitude is valid'''
+    if not isinstance(lon, (float, int)):
+        logging.error("Invalid longitude type: %s", type(lon))
+        return False
+    return MIN_LON <= lon <= MAX_LON
+
+
+def is_valid_magnitude(mag: float) -> bool:
+    '''Checks if magnitude is valid'''
+    if not isinstance(mag, (float, int)):
+        logging.error("Invalid magnitude type: %s", type(mag))
+        return False
+    return MIN_MAGNITUDE <= mag <= MAX_MAGNITUDE
+
+
+def is_valid_cdi(cdi: float) -> bool:
+    '''Checks if cdi is valid'''
+    if not isinstance(cdi, (float, int)):
+        logging.error("Invalid CDI type: %s", type(cdi))
+        return False
+    return MIN_CDI <= cdi <= MAX_CDI
+
+
+def is_valid_depth(depth: float) -> bool:
+    '''Checks if depth is valid'''
+    if not isinstance(depth, (float, int)):
+        logging.error("Invalid depth type: %s", type(depth))
+        return False
+    return MIN_DEPTH <= depth <= MAX_DEPTH
+
+
+def make_batch(events: int) -> EarthquakeBatch:
+    '''Builds a batch with around 1% of rows out of range in each validated column.'''
+    rng = np.random.default_rng(42)
+    columns = {name: np.full(events, None, dtype=object) for name in COLUMNS}
+    columns["at"] = np.full(events, np.datetime64("2024-12-03T13:42:51"), dtype="datetime64[us]")
+    columns["updated"] = np.arange(events, dtype=np.int64)
+    for name, low, high in (("latitude", -91, 91), ("longitude", -182, 182), ("magnitude", -10.2, 12.2),
+                            ("cdi", -0.1, 12.1), ("depth", -101, 1010)):
+        columns[name] = rng.uniform(low, high, events)
+    return EarthquakeBatch(columns)
+
+
+def apply_validation(earthquake_df: pd.DataFrame) -> pd.DataFrame:
+    '''The per-row validation used before validate_data was vectorised.'''
+    earthquake_df["latitude_valid"] = earthquake_df["latitude"].apply(is_valid_latitude)
+    earthquake_df["longitude_valid"] = earthquake_df["longitude"].apply(is_valid_longitude)
+    earthquake_df["magnitude_valid"] = earthquake_df["magnitude"].apply(is_valid_magnitude)
+    earthquake_df["cdi_valid"] = earthquake_df["cdi"].apply(is_valid_cdi)
+    earthquake_df["depth_valid"] = earthquake_df["depth"].apply(is_valid_depth)
+    valid_df = earthquake_df[earthquake_df["latitude_valid"] & earthquake_df["longitude_valid"] &
+                             earthquake_df["magnitude_valid"] & earthquake_df["cdi_valid"] &
+                             earthquake_df["depth_valid"]]
+    return valid_df.drop(columns=["latitude_valid", "longitude_valid", "magnitude_valid",
+                                  "cdi_valid", "depth_valid"])
+
+
+def main() -> None:
+    '''Times both validations on batches of each size and prints the speed-up.'''
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, nargs="+",
+                        default=[10_000, 100_000, 1_000_000])
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    print(f"{'events':>10}{'apply (s)':>12}{'vectorised (s)':>16}{'speed-up':>10}")
+    for events in args.events:
+        batch = make_batch(events)
+        earthquake_df = pd.DataFrame(batch.columns)
+
+        start = time.perf_counter()
+        expected = apply_validation(earthquake_df)
+        apply_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        valid, _ = validate_data(batch)
+        vectorised_seconds = time.perf_counter() - start
+
+        assert len(valid) == len(expected)
+        print(f"{events:>10}{apply_seconds:>12.3f}{vectorised_seconds:>16.4f}"
+              f"{apply_seconds / vectorised_seconds:>9.0f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,34 +3,54 @@
 # pylint: disable=line-too-long
 
 from dotenv import load_dotenv
-from extract import get_data
-from transform import clean_data
-from load import *
+from extract import get_data, get_feeds, get_high_water_mark, reset_fetch_stats, FEED_NAME, FETCH_STATS
+from transform import clean_data, reset_validation_stats, VALIDATION_STATS
+from quarantine import reset_quarantine
+from load import get_watermark, get_feed_validators, set_feed_validators, load_data
+from db import get_cursor, get_shared_connection, transaction, reset_db_stats, DB_STATS
 
 
 def lambda_handler(event, context):
     """Runs the ETL pipeline when the lambda is invoked"""
     try:
         load_dotenv()
+        reset_fetch_stats()
+        reset_validation_stats()
+        reset_quarantine()
+        reset_db_stats()
 
-        extracted_earthquake_data = get_data()
+        conn = get_shared_connection()
+        app_cursor = get_cursor(conn)
+        feeds = get_feeds()
+        # Committed straight away, so no transaction stays open while the feeds are fetched.
+        with transaction(conn):
+            watermark = get_watermark(app_cursor, FEED_NAME)
+            validators = get_feed_validators(app_cursor, feeds)
 
-        if len(extracted_earthquake_data) == 0:
+        extracted_earthquake_data = get_data(watermark, validators, feeds)
+
+        if not extracted_earthquake_data:
+            if extracted_earthquake_data is not None:
+                set_feed_validators(conn, app_cursor, validators)
             return {
                 "status_code": 200,
-                "body": "No new earthquake data"
+                "body": "No new earthquake data",
+                "fetch_stats": dict(FETCH_STATS),
+                "db_stats": dict(DB_STATS)
             }
 
         cleaned_earthquake_data = clean_data(extracted_earthquake_data)
 
-        load_data(cleaned_earthquake_data)
-
-        for earthquake in cleaned_earthquake_data:
-            earthquake['at'] = str(earthquake['at'])
+        load_data(cleaned_earthquake_data, FEED_NAME,
+                  get_high_water_mark(extracted_earthquake_data), conn)
+        set_feed_validators(conn, app_cursor, validators)
 
         return {
             "status_code": 200,
-            "body": cleaned_earthquake_data
+            "body": cleaned_earthquake_data.to_records(stringify_datetimes=True),
+            "fetch_stats": dict(FETCH_STATS),
+            "validation_stats": dict(VALIDATION_STATS),
+            "db_stats": dict(DB_STATS)
         }
 
     except Exception as e:
@@ -2,59 +2,241 @@
 
 '''Module that queries all the earthquake API and stores all of the wanted data'''
 
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Iterable, Iterator
+import codecs
+import json
 import logging
+import os
+import random
+import time
 import requests
+from requests.adapters import HTTPAdapter
+from batch import EarthquakeBatch
 
-URL = "https://earthquake.usgs.gov/earthquakes/feed/v1.0/summary/all_hour.geojson"
+FEED_URL = "https://earthquake.usgs.gov/earthquakes/feed/v1.0/summary/{}.geojson"
+URL = FEED_URL.format("all_hour")
+FEED_NAME = "usgs_summary"
+FEEDS = ("all_hour",)
+FEED_WINDOWS = (("hour", timedelta(hours=1)),
+                ("day", timedelta(days=1)),
+                ("week", timedelta(weeks=1)),
+                ("month", timedelta(days=30)))
+DEFAULT_LOOKBACK = timedelta(minutes=2)
+FETCH_STATS = {"cache_hits": 0, "cache_misses": 0, "attempts": []}
+
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT = 20
+MAX_ATTEMPTS = 4
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 8.0
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+POOL_SIZE = 8
+CHUNK_SIZE = 64 * 1024
+WHITESPACE = " \t\n\r"
 
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
 
-def get_data() -> list[dict]:
+def create_session() -> requests.Session:
     '''
-    Function to get the necessary data from the API. 
-    Only gets data that was uploaded within the last minute as the pipeline will run every minute.
+    Creates a pooled HTTP session that negotiates gzip.
+    Retries are handled by request_with_retry so that every attempt can be timed.
+    '''
+    session = requests.Session()
+    session.headers.update({"Accept-Encoding": "gzip, deflate"})
+    adapter = HTTPAdapter(pool_connections=POOL_SIZE,
+                          pool_maxsize=POOL_SIZE, max_retries=0)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+# Created at import time so the connection pool is reused across warm Lambda invocations.
+SESSION = create_session()
+
+
+def format_earthquake(earthquake_data: dict) -> dict:
+    '''Normalises a single GeoJSON feature into the record format used by the pipeline.'''
+    return {
+        "at": datetime.fromtimestamp(earthquake_data["properties"].get("time", 0) / 1000),
+        "event_url": earthquake_data["properties"].get("detail"),
+        "felt": earthquake_data["properties"].get("felt"),
+        "location": earthquake_data["properties"].get("place"),
+        "magnitude": earthquake_data["properties"]['mag'],
+        "network": earthquake_data["properties"].get("net"),
+        "alert": earthquake_data["properties"].get("alert"),
+        "magnitude_type": earthquake_data["properties"].get("magType"),
+        "cdi": earthquake_data["properties"]['cdi'],
+        "longitude": earthquake_data["geometry"]['coordinates'][0],
+        "latitude": earthquake_data["geometry"]['coordinates'][1],
+        "depth": earthquake_data["geometry"]['coordinates'][-1],
+        "updated": earthquake_data["properties"]["updated"],
+        "event_id": earthquake_data.get("id")
+    }
+
+
+def get_default_watermark() -> int:
+    '''Watermark used on the very first run, before anything has been ingested.'''
+    return int((datetime.now() - DEFAULT_LOOKBACK).timestamp() * 1000)
+
+
+def get_feeds() -> tuple[str]:
+    '''
+    Gets the summary feeds to extract from, e.g. USGS_FEEDS=significant_hour,4.5_hour,all_hour.
+    Falls back to FEEDS when the setting is unset or names no feed.
+    '''
+    feeds = tuple(feed.strip() for feed in os.getenv("USGS_FEEDS", "").split(",") if feed.strip())
+    if not feeds:
+        if os.getenv("USGS_FEEDS", "").strip():
+            logging.warning("USGS_FEEDS names no feed, using %s", ",".join(FEEDS))
+        return FEEDS
+    return feeds
+
+
+def select_feed(since: int, feed: str = FEEDS[0]) -> str:
+    '''
+    Picks the smallest period of a summary feed (e.g. all_hour, all_day) that still covers
+    everything updated after the watermark, so a run after a stall can catch up in one go.
+    '''
+    magnitude_band = feed.rsplit("_", 1)[0]
+    age = datetime.now() - datetime.fromtimestamp(since / 1000)
+    for period, window in FEED_WINDOWS:
+        if age < window:
+            return FEED_URL.format(f"{magnitude_band}_{period}")
+
+    logging.warning(
+        "Watermark is older than the largest summary feed, some events may be missed.")
+    return FEED_URL.format(f"{magnitude_band}_{FEED_WINDOWS[-1][0]}")
+
+
+def deduplicate(earthquake_data: list[dict], seen: set = frozenset()) -> list[dict]:
+    '''
+    Removes repeated events, keeping the copy with the latest updated timestamp.
+    Events whose id is in seen (already emitted elsewhere) are dropped, events without an id are kept.
+    '''
+    latest = {}
+    for index, earthquake in enumerate(earthquake_data):
+        event_id = earthquake["event_id"]
+        if event_id is None:
+            latest[index] = earthquake
+        elif event_id in seen:
+            continue
+        elif event_id not in latest or earthquake["updated"] > latest[event_id]["updated"]:
+            latest[event_id] = earthquake
+
+    return list(latest.values())
+
+
+def get_high_water_mark(earthquake_data: EarthquakeBatch) -> int | None:
+    '''Returns the largest updated timestamp in the extracted records.'''
+    if len(earthquake_data) == 0:
+        return None
+    return int(earthquake_data["updated"].max())
+
+
+def reset_fetch_stats() -> None:
+    '''Resets the fetch counters at the start of a run, as they survive warm Lambda invocations.'''
+    FETCH_STATS.update(cache_hits=0, cache_misses=0, attempts=[])
+
+
+def get_backoff(attempt: int) -> float:
+    '''Full-jitter exponential backoff, capped at BACKOFF_CAP seconds.'''
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** (attempt - 1)))
+
+
+def request_with_retry(url: str, **kwargs) -> requests.Response:
+    '''
+    GETs a URL through the pooled session with connect/read timeouts.
+    Connection errors, timeouts and retryable status codes are retried with jittered exponential backoff.
+    The latency of every attempt is recorded in FETCH_STATS["attempts"].
+    '''
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        start = time.perf_counter()
+        try:
+            response = SESSION.get(url, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            FETCH_STATS["attempts"].append({"url": url, "attempt": attempt, "status": type(e).__name__,
+                                            "latency_ms": round((time.perf_counter() - start) * 1000, 1)})
+            if attempt == MAX_ATTEMPTS:
+                raise
+            logging.warning("Attempt %s to fetch %s failed: %s", attempt, url, e)
+            time.sleep(get_backoff(attempt))
+            continue
+
+        FETCH_STATS["attempts"].append({"url": url, "attempt": attempt, "status": response.status_code,
+                                        "latency_ms": round((time.perf_counter() - start) * 1000, 1)})
+        if response.status_code not in RETRY_STATUSES or attempt == MAX_ATTEMPTS:
+            return response
+
+        logging.warning("Attempt %s to fetch %s returned %s",
+                        attempt, url, response.status_code)
+        response.close()
+        time.sleep(get_backoff(attempt))
+
+    return response
+
+
+def fetch_feed(url: str, validators: dict = None) -> requests.Response | None:
+    '''
+    Fetches a feed with a conditional GET using the ETag and Last-Modified values from the previous fetch.
+    Returns None when the server answers 304 Not Modified.
+    validators is updated in place with the values from a fresh response, ready to be persisted.
+    '''
+    if validators is None:
+        validators = {}
+
+    headers = {}
+    if validators.get("feed_url") == url:
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+
+    response = request_with_retry(url, headers=headers)
+
+    if response.status_code == 304:
+        FETCH_STATS["cache_hits"] += 1
+        logging.info("Feed %s not modified since the last fetch.", url)
+        return None
+
+    FETCH_STATS["cache_misses"] += 1
+    response.raise_for_status()
+    validators.update({"feed_url": url,
+                       "etag": response.headers.get("ETag"),
+                       "last_modified": response.headers.get("Last-Modified")})
+    return response
+
+
+def get_feed_data(url: str, since: int, validators: dict = None) -> list[dict] | None:
+    '''
+    Gets the records of one summary feed that were updated after the watermark (epoch milliseconds).
+    Returns None, without parsing anything, when the feed has not changed since the last fetch.
     '''
     data = []
     try:
-        logging.info("Fetching earthquake data from API...")
-        response = requests.get(URL)
+        logging.info("Fetching earthquake data from %s", url)
+        response = fetch_feed(url, validators)
+
+        if response is None:
+            return None
 
-        response.raise_for_status()
         earthquakes_data = response.json()["features"]
 
         if not earthquakes_data:
             logging.warning("No earthquake data found in the response.")
             return []
 
-        current_time = datetime.now()
-
         for earthquake_data in earthquakes_data:
             try:
-                time_uploaded_at = datetime.fromtimestamp(
-                    earthquake_data["properties"]["updated"] / 1000)
-
-                if (time_uploaded_at.hour != current_time.hour or time_uploaded_at.minute < current_time.minute - 1):
+                if earthquake_data["properties"]["updated"] <= since:
                     continue
 
                 if earthquake_data.get("properties") and earthquake_data.get("geometry"):
 
-                    data.append({
-                        "at": datetime.fromtimestamp(earthquake_data["properties"].get("time", 0) / 1000),
-                        "event_url": earthquake_data["properties"].get("detail"),
-                        "felt": earthquake_data["properties"].get("felt"),
-                        "location": earthquake_data["properties"].get("place"),
-                        "magnitude": earthquake_data["properties"]['mag'],
-                        "network": earthquake_data["properties"].get("net"),
-                        "alert": earthquake_data["properties"].get("alert"),
-                        "magnitude_type": earthquake_data["properties"].get("magType"),
-                        "cdi": earthquake_data["properties"]['cdi'],
-                        "longitude": earthquake_data["geometry"]['coordinates'][0],
-                        "latitude": earthquake_data["geometry"]['coordinates'][1],
-                        "depth": earthquake_data["geometry"]['coordinates'][-1]
-                    })
+                    data.append(format_earthquake(earthquake_data))
             except KeyError as e:
                 logging.error(
                     "KeyError while processing earthquake data: %s", e)
@@ -67,5 +249,150 @@ def get_data() -> list[dict]:
         logging.error("Error fetching data from the API: %s", e)
         raise requests.exceptions.RequestException
 
+    logging.info("Retrieved %s earthquake records from %s.", len(data), url)
+    return data
+
+
+def get_data(since: int = None, validators: dict = None, feeds: tuple[str] = FEEDS) -> EarthquakeBatch | None:
+    '''
+    Function to get the necessary data from the API. 
+    Fetches each summary feed concurrently, keeping data that was updated after the watermark of the previous run,
+    and merges them into one batch deduplicated by event id.
+    validators maps each feed to its stored ETag/Last-Modified values.
+    Returns None when none of the feeds has changed since the last fetch.
+    '''
+    if since is None:
+        since = get_default_watermark()
+    if validators is None:
+        validators = {}
+
+    def fetch(feed: str) -> list[dict] | None:
+        return get_feed_data(select_feed(since, feed), since, validators.setdefault(feed, {}))
+
+    with ThreadPoolExecutor(max_workers=len(feeds)) as executor:
+        feed_data = [data for data in executor.map(fetch, feeds)
+                     if data is not None]
+
+    if not feed_data:
+        return None
+
+    data = EarthquakeBatch.from_records(
+        deduplicate([earthquake for data in feed_data for earthquake in data]))
     logging.info("Retrieved %s earthquake records.", len(data))
     return data
+
+
+def decode_value(decoder: json.JSONDecoder, buffer: str, pos: int, final: bool) -> tuple | None:
+    '''
+    Decodes the JSON value starting at pos.
+    Returns None when the buffer ends before the value does and more of the body is still to come.
+    '''
+    try:
+        value, end = decoder.raw_decode(buffer, pos)
+    except json.JSONDecodeError:
+        if final:
+            raise
+        return None
+    if end == len(buffer) and not final:
+        return None
+    return value, end
+
+
+def iter_features(chunks: Iterable[bytes]) -> Iterator[dict]:
+    '''
+    Incrementally decodes the "features" array of a GeoJSON FeatureCollection.
+    Only the feature currently being decoded is held in memory, so memory use stays flat as the feed grows.
+    '''
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    chunks = iter(chunks)
+    buffer, pos, final = "", 0, False
+    state, key = "start", None
+
+    while True:
+        while pos < len(buffer) and buffer[pos] in WHITESPACE:
+            pos += 1
+
+        decoded = None
+        if pos < len(buffer):
+            char = buffer[pos]
+            if state == "start" and char == "{":
+                state, pos = "key", pos + 1
+                continue
+            if state in ("key", "next_key") and char == "}":
+                return
+            if state == "next_key" and char == ",":
+                state, pos = "key", pos + 1
+                continue
+            if state == "colon" and char == ":":
+                state, pos = "value", pos + 1
+                continue
+            if state == "value" and key == "features" and char == "[":
+                state, pos = "feature", pos + 1
+                continue
+            if state in ("feature", "next_feature") and char == "]":
+                state, pos = "next_key", pos + 1
+                continue
+            if state == "next_feature" and char == ",":
+                state, pos = "feature", pos + 1
+                continue
+            if state not in ("key", "value", "feature"):
+                raise ValueError(
+                    f"Unexpected character {char!r} in GeoJSON document")
+
+            decoded = decode_value(decoder, buffer, pos, final)
+            if decoded is not None:
+                value, pos = decoded
+                if state == "key":
+                    state, key = "colon", value
+                elif state == "value":
+                    state = "next_key"
+                else:
+                    state = "next_feature"
+                    yield value
+                continue
+
+        if final:
+            raise ValueError("GeoJSON document ended unexpectedly")
+
+        chunk = next(chunks, None)
+        if chunk is None:
+            final = True
+            buffer = buffer[pos:] + utf8.decode(b"", final=True)
+        else:
+            buffer = buffer[pos:] + utf8.decode(chunk)
+        pos = 0
+
+
+def stream_data(url: str = URL, since: int = 0, counts: dict = None) -> Iterator[dict]:
+    '''
+    Streaming counterpart of get_data for large feeds such as all_day, all_week and all_month.
+    Yields each normalised record as soon as its feature has been downloaded, without buffering the body.
+    If given, counts["features"] is set to the number of features read, including those skipped.
+    '''
+    count = 0
+    counts = {} if counts is None else counts
+    counts["features"] = 0
+    try:
+        logging.info("Streaming earthquake data from %s", url)
+        with request_with_retry(url, stream=True) as response:
+            response.raise_for_status()
+
+            for earthquake_data in iter_features(response.iter_content(chunk_size=CHUNK_SIZE)):
+                counts["features"] += 1
+                try:
+                    if earthquake_data["properties"]["updated"] <= since:
+                        continue
+                    if earthquake_data.get("properties") and earthquake_data.get("geometry"):
+                        count += 1
+                        yield format_earthquake(earthquake_data)
+                except KeyError as e:
+                    logging.error(
+                        "KeyError while processing earthquake data: %s", e)
+                    continue
+
+    except requests.exceptions.RequestException as e:
+        logging.error("Error fetching data from the API: %s", e)
+        raise requests.exceptions.RequestException
+
+    logging.info("Streamed %s earthquake records.", count)
@@ -1,137 +1,381 @@
 # pylint: disable=line-too-long
 
 '''Module that inserts the transformed data into an RDS'''
-import os
+import io
 import logging
+import time
+import numpy as np
 import psycopg2
 from psycopg2.extensions import connection, cursor
-from psycopg2.extras import RealDictCursor
 from dotenv import load_dotenv
+from batch import EarthquakeBatch
+from db import get_cursor, get_shared_connection, transaction
+from quarantine import quarantine, flush_quarantine
+
+INSERT_COLUMNS = ("at", "felt", "magnitude", "cdi", "latitude", "longitude", "event_url",
+                  "alert", "magnitude_type", "network", "depth", "location", "event_id", "updated")
+EARTHQUAKE_COLUMNS = ("time", "felt_report_count", "magnitude", "cdi", "latitude", "longitude",
+                      "detail_url", "alert_id", "magnitude_id", "network_id", "depth", "place",
+                      "event_id", "updated")
+# Rows are first loaded into a per-session staging table, then upserted into earthquakes in one statement.
+STAGING_TABLE = "earthquake_staging"
+INSERT_QUERY = f"""INSERT INTO {{}} ({', '.join(EARTHQUAKE_COLUMNS)})
+                   VALUES ({', '.join(['%s'] * len(EARTHQUAKE_COLUMNS))})"""
+CREATE_STAGING_QUERY = f"""CREATE TEMP TABLE IF NOT EXISTS {STAGING_TABLE} AS
+                           SELECT {', '.join(EARTHQUAKE_COLUMNS)} FROM earthquakes WITH NO DATA"""
+# Empties the staging table, keeps the latest revision of each event in the batch, and only replaces
+# a stored row with a newer revision. Rows without an event id cannot conflict and are inserted as they are.
+UPSERT_QUERY = f"""WITH staged AS (DELETE FROM {STAGING_TABLE} RETURNING *)
+                   INSERT INTO earthquakes ({', '.join(EARTHQUAKE_COLUMNS)})
+                   SELECT {', '.join(EARTHQUAKE_COLUMNS)} FROM (
+                       SELECT DISTINCT ON (event_id) * FROM staged
+                       WHERE event_id IS NOT NULL ORDER BY event_id, updated DESC) AS latest
+                   UNION ALL
+                   SELECT {', '.join(EARTHQUAKE_COLUMNS)} FROM staged WHERE event_id IS NULL
+                   ON CONFLICT (event_id) DO UPDATE SET
+                   {', '.join(f"{column} = EXCLUDED.{column}" for column in EARTHQUAKE_COLUMNS if column != "event_id")}
+                   WHERE earthquakes.updated IS NULL OR earthquakes.updated < EXCLUDED.updated"""
+# UTC hours a batch touches: those of the staged rows and, for revised events, the hours they are moving out of.
+ROLLUP_HOURS_TABLE = "rollup_hours"
+MARK_ROLLUP_HOURS_QUERY = f"""CREATE TEMP TABLE IF NOT EXISTS {ROLLUP_HOURS_TABLE} (hour TIMESTAMPTZ PRIMARY KEY);
+                              INSERT INTO {ROLLUP_HOURS_TABLE}
+                              SELECT date_trunc('hour', time, 'UTC') FROM {STAGING_TABLE}
+                              UNION
+                              SELECT date_trunc('hour', e.time, 'UTC') FROM earthquakes e
+                              JOIN {STAGING_TABLE} s ON e.event_id = s.event_id
+                              ON CONFLICT DO NOTHING"""
+ROLLUP_AGGREGATES = """count(*), sum(e.magnitude), max(e.magnitude),
+                       (array_agg(e.earthquake_id ORDER BY e.magnitude DESC, e.earthquake_id))[1]"""
+ROLLUP_HOUR_JOIN = f"""FROM {ROLLUP_HOURS_TABLE} h
+                       JOIN earthquakes e ON e.time >= h.hour AND e.time < h.hour + interval '1 hour'"""
+# Recomputes the touched hours from earthquakes, then their days from the hourly rollups, in one round trip.
+# Only those hours' earthquakes are read, so the cost follows the batch rather than the history stored.
+# The hours are also logged to earthquake_changes, which the API reads to expire its cached responses.
+# Loads refresh one at a time, holding ROLLUP_LOCK_KEY until they commit: a load that overlaps another's hours
+# waits, then its statements see the rows the other committed instead of colliding with them on the primary keys.
+# Arbitrary, but unique to this lock among the database's advisory locks.
+ROLLUP_LOCK_KEY = 25
+REFRESH_ROLLUPS_QUERY = f"""SELECT pg_advisory_xact_lock({ROLLUP_LOCK_KEY});
+    DELETE FROM earthquake_rollups_hourly WHERE hour IN (SELECT hour FROM {ROLLUP_HOURS_TABLE});
+    INSERT INTO earthquake_rollups_hourly
+    SELECT h.hour,
+           CASE WHEN GROUPING(a.alert_type) = 0 THEN 'alert'
+                WHEN GROUPING(n.network_name) = 0 THEN 'network' ELSE 'all' END,
+           COALESCE(a.alert_type, n.network_name, ''), {ROLLUP_AGGREGATES}
+    {ROLLUP_HOUR_JOIN}
+    JOIN alerts a ON e.alert_id = a.alert_id
+    JOIN networks n ON e.network_id = n.network_id
+    GROUP BY GROUPING SETS ((h.hour), (h.hour, a.alert_type), (h.hour, n.network_name));
+    INSERT INTO earthquake_rollups_hourly
+    SELECT h.hour, 'region', r.region_name, {ROLLUP_AGGREGATES}
+    {ROLLUP_HOUR_JOIN}
+    JOIN regions r ON e.latitude BETWEEN r.min_latitude AND r.max_latitude
+                  AND e.longitude BETWEEN r.min_longitude AND r.max_longitude
+    GROUP BY h.hour, r.region_name;
+    DELETE FROM earthquake_rollups_daily
+    WHERE day IN (SELECT date_trunc('day', hour, 'UTC') FROM {ROLLUP_HOURS_TABLE});
+    INSERT INTO earthquake_rollups_daily
+    SELECT d.day, r.dimension, r.dimension_value, sum(r.earthquake_count), sum(r.magnitude_sum),
+           max(r.max_magnitude), (array_agg(r.max_earthquake_id ORDER BY r.max_magnitude DESC, r.max_earthquake_id))[1]
+    FROM (SELECT DISTINCT date_trunc('day', hour, 'UTC') AS day FROM {ROLLUP_HOURS_TABLE}) d
+    JOIN earthquake_rollups_hourly r ON r.hour >= d.day AND r.hour < d.day + interval '24 hours'
+    GROUP BY d.day, r.dimension, r.dimension_value;
+    INSERT INTO earthquake_changes (hour) SELECT hour FROM {ROLLUP_HOURS_TABLE};
+    DELETE FROM earthquake_changes WHERE changed_at < now() - interval '1 day';
+    DELETE FROM {ROLLUP_HOURS_TABLE}"""
+# Batches of at least this many rows are staged with COPY instead of executemany.
+COPY_MIN_ROWS = 1000
+# Batch column -> (lookup table, key column, value column) of each foreign key.
+DIMENSIONS = {"alert": ("alerts", "alert_id", "alert_type"),
+              "magnitude_type": ("magnitude_types", "magnitude_id", "magnitude_type"),
+              "network": ("networks", "network_id", "network_name")}
+# Lookup tables that get new values from the feeds; unknown alert levels are still rejected.
+CREATABLE_DIMENSIONS = ("magnitude_type", "network")
+MAX_DIMENSION_LENGTH = 20
+DIMENSION_TTL = 300
+DIMENSION_CACHE = {}
 
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
 
-def get_connection() -> connection:
-    """ Establishes a connection with database. """
-    logging.info("Attempting to connect to the database")
+def reset_dimension_cache() -> None:
+    """Forgets every cached lookup table, so the next batch reloads them."""
+    DIMENSION_CACHE.clear()
+
+
+def load_dimension(db_cursor: cursor, column: str) -> dict:
+    """Reads a whole lookup table in one query and caches it as a value -> key mapping."""
+    table_name, key_column, value_column = DIMENSIONS[column]
     try:
-        conn = psycopg2.connect(dbname=os.getenv("DB_NAME"),
-                                user=os.getenv("DB_USER"),
-                                password=os.getenv("DB_PASSWORD"),
-                                host=os.getenv("DB_HOST"),
-                                port=os.getenv("DB_PORT"))
-        logging.info("Database connection successful.")
-        return conn
-    except KeyError as e:
-        logging.error("%s missing from environment variables.", e)
-        raise
-    except psycopg2.OperationalError as e:
-        logging.error("Error connecting to database: %s", e)
+        db_cursor.execute(f"SELECT {key_column}, {value_column} FROM {table_name}")
+        keys = {row[value_column]: row[key_column] for row in db_cursor.fetchall()}
+    except psycopg2.Error as e:
+        logging.error("Database error while loading %s: %s", table_name, e)
         raise
-    except Exception as e:
-        logging.error("Unexpected error while connecting to database: %s", e)
+
+    DIMENSION_CACHE[column] = {"loaded_at": time.monotonic(), "keys": keys, "absent": set()}
+    return keys
+
+
+def create_dimension_values(db_cursor: cursor, column: str, values: set) -> dict:
+    """
+    Inserts the values missing from a lookup table and reloads the whole table, in a single statement.
+    The insert is part of the batch's transaction, so it is committed with the earthquakes.
+    """
+    table_name, key_column, value_column = DIMENSIONS[column]
+    query = f"""WITH created AS (
+                    INSERT INTO {table_name} ({value_column}) SELECT unnest(%s::varchar[])
+                    ON CONFLICT ({value_column}) DO UPDATE SET {value_column} = EXCLUDED.{value_column}
+                    RETURNING {key_column}, {value_column})
+                SELECT {key_column}, {value_column} FROM created
+                UNION SELECT {key_column}, {value_column} FROM {table_name}"""
+    try:
+        db_cursor.execute(query, (sorted(values),))
+        keys = {row[value_column]: row[key_column] for row in db_cursor.fetchall()}
+    except psycopg2.Error as e:
+        logging.error("Database error while adding to %s: %s", table_name, e)
         raise
 
+    logging.info("Added %s to %s", sorted(values), table_name)
+    DIMENSION_CACHE[column] = {"loaded_at": time.monotonic(), "keys": keys, "absent": set()}
+    return keys
+
+
+def get_dimension_keys(db_cursor: cursor, column: str, values: set) -> dict:
+    """
+    Returns the value -> key mapping of a lookup table from the cache, which survives warm Lambda invocations.
+    The table is reloaded once the cache is older than DIMENSION_TTL seconds, or if any of values is missing from it.
+    Missing networks and magnitude types are created in the same statement as the reload. None and NaN are
+    never looked up, and values still missing after that, such as an unknown alert level, are remembered as
+    absent until the TTL, so they do not reload the table on every batch.
+    """
+    cached = DIMENSION_CACHE.get(column)
+    reloaded = cached is None or time.monotonic() - cached["loaded_at"] > DIMENSION_TTL
+    keys = load_dimension(db_cursor, column) if reloaded else cached["keys"]
+
+    values = {value for value in values if isinstance(value, str)}
+    missing = values - keys.keys() - DIMENSION_CACHE[column]["absent"]
+    creatable = {value for value in missing if 0 < len(value) <= MAX_DIMENSION_LENGTH}
+    if creatable and column in CREATABLE_DIMENSIONS:
+        keys = create_dimension_values(db_cursor, column, creatable)
+    elif missing and not reloaded:
+        logging.info("Reloading %s for values missing from the cache", DIMENSIONS[column][0])
+        keys = load_dimension(db_cursor, column)
+
+    DIMENSION_CACHE[column]["absent"].update(values - keys.keys())
+    return keys
+
+
+def get_cached_key(dimension_keys: dict[str, dict], column: str, value: str) -> int:
+    """Gets a foreign key from the cached lookup tables."""
+    key = dimension_keys[column].get(value)
+    if key is None:
+        logging.error("Foreign key not found for %s in %s", value, DIMENSIONS[column][0])
+        raise ValueError(f"{column} {value!r} not in {DIMENSIONS[column][0]}")
+    return key
+
+
+def to_copy_field(value) -> str:
+    """Formats a value for COPY's text format, escaping the characters it treats as delimiters."""
+    if value is None:
+        return "\\N"
+    if isinstance(value, str):
+        return (value.replace("\\", "\\\\").replace("\t", "\\t")
+                .replace("\n", "\\n").replace("\r", "\\r"))
+    return str(value)
+
+
+def copy_into_earthquake(db_cursor: cursor, value_list: list[tuple], table_name: str = "earthquakes") -> None:
+    """Streams rows, with their foreign keys already resolved, into an earthquakes-shaped table through COPY FROM STDIN."""
+    buffer = io.StringIO("".join("\t".join(map(to_copy_field, values)) + "\n"
+                                 for values in value_list))
+    db_cursor.copy_expert(
+        f"COPY {table_name} ({', '.join(EARTHQUAKE_COLUMNS)}) FROM STDIN", buffer)
+
+
+def upsert_earthquakes(db_cursor: cursor, value_list: list[tuple]) -> int:
+    """
+    Stages the rows and upserts them into earthquakes on their USGS event id, so replaying a window is safe
+    and newer revisions replace older ones. The hourly and daily rollups of the hours the batch touches are
+    recomputed in the same transaction. Returns the number of rows inserted or updated.
+    """
+    db_cursor.execute(CREATE_STAGING_QUERY)
+    if len(value_list) >= COPY_MIN_ROWS:
+        copy_into_earthquake(db_cursor, value_list, STAGING_TABLE)
+    else:
+        db_cursor.executemany(INSERT_QUERY.format(STAGING_TABLE), value_list)
+    db_cursor.execute(MARK_ROLLUP_HOURS_QUERY)
+    db_cursor.execute(UPSERT_QUERY)
+    upserted = db_cursor.rowcount
+    db_cursor.execute(REFRESH_ROLLUPS_QUERY)
+    return upserted
+
+
+def get_earthquake_values(db_cursor: cursor, earthquake_data: EarthquakeBatch) -> list[tuple]:
+    """Builds the earthquakes table rows for a batch, resolving foreign keys. Rows that cannot be built are quarantined."""
+    value_list = []
+    failed_rows = []
+    reasons = []
+
+    dimension_keys = {column: get_dimension_keys(db_cursor, column, set(earthquake_data[column].tolist()))
+                      for column in DIMENSIONS} if len(earthquake_data) else {}
+
+    for row, (at, felt, magnitude, cdi, latitude, longitude, event_url, alert, magnitude_type,
+              network, depth, location, event_id, updated) in enumerate(earthquake_data.rows(INSERT_COLUMNS)):
+        try:
+            alert_id = get_cached_key(dimension_keys, 'alert', alert)
+            magnitude_id = get_cached_key(
+                dimension_keys, 'magnitude_type', magnitude_type)
+            network_id = get_cached_key(dimension_keys, 'network', network)
+
+            values = (
+                at,
+                int(felt),
+                float(magnitude),
+                float(cdi),
+                float(latitude),
+                float(longitude),
+                event_url,
+                alert_id,
+                magnitude_id,
+                network_id,
+                float(depth),
+                location,
+                event_id,
+                int(updated)
+            )
+
+            value_list.append(values)
+
+        except ValueError as e:
+            logging.error("Skipping record due to ValueError: %s", e)
+            failed_rows.append(row)
+            reasons.append(f"foreign_key: {e}")
+            continue
+        except Exception as e:
+            logging.error(
+                "Unexpected error while processing earthquake data: %s", e)
+            failed_rows.append(row)
+            reasons.append(f"load: {e}")
+            continue
+
+    quarantine(earthquake_data.filter(np.array(failed_rows, dtype=np.int64)), reasons, "load")
+    return value_list
+
+
+def insert_into_earthquake(db_conn: connection,
+                           db_cursor: cursor,
+                           earthquake_data: EarthquakeBatch) -> None:
+    """
+    Upserts cleaned data into the earthquake table in one transaction. Rows that cannot be inserted are quarantined.
+    Batches of COPY_MIN_ROWS or more, such as backfill chunks, are staged with COPY; smaller ones with executemany.
+    """
+
+    if len(earthquake_data) == 0:
+        logging.warning("No valid records to insert.")
+        return
 
-def get_cursor(connect: connection) -> cursor:
-    """ Create a cursor to send and receive data. """
-    logging.info("Creating database cursor")
     try:
-        return connect.cursor(cursor_factory=RealDictCursor)
+        with transaction(db_conn):
+            value_list = get_earthquake_values(db_cursor, earthquake_data)
+
+            if value_list:
+                logging.info(
+                    "Inserting %s records into the earthquake table", len(value_list))
+                upserted = upsert_earthquakes(db_cursor, value_list)
+                logging.info("Data successfully inserted into the database, %s rows inserted or revised", upserted)
+            else:
+                logging.warning("No valid records to insert.")
+
+    except psycopg2.Error as e:
+        logging.error("Database error while inserting earthquake data: %s", e)
+        # Values created for this batch are rolled back with it, so their cached keys are not valid.
+        reset_dimension_cache()
+        raise
     except Exception as e:
-        logging.error("Failed to create cursor: %s", e)
+        logging.error(
+            "Unexpected error while inserting earthquake data: %s", e)
         raise
 
 
-def get_foreign_key(db_cursor: psycopg2.extensions.cursor, table_name: str,
-                    column_name: str, value: str) -> int:
-    """ Gets foreign keys. """
+def get_watermark(db_cursor: cursor, feed_name: str) -> int | None:
+    """Gets the largest updated timestamp already ingested from a feed."""
     try:
         db_cursor.execute(
-            f"SELECT * FROM {table_name} WHERE {column_name} = '{value}'")
+            "SELECT high_water_mark FROM feed_state WHERE feed_name = %s", (feed_name,))
         result = db_cursor.fetchone()
         if result:
-            first_key = next(iter(result))
-            return result[first_key]
+            return result["high_water_mark"]
 
-        logging.error("Foreign key not found for %s in %s", value, table_name)
-        raise ValueError('Invalid Data!')
+        logging.info("No watermark stored for %s", feed_name)
+        return None
 
     except psycopg2.Error as e:
-        logging.error("Database error while fetching foreign key: %s", e)
-        raise
-    except Exception as e:
-        logging.error("Unexpected error while fetching foreign key: %s", e)
+        logging.error("Database error while fetching watermark: %s", e)
         raise
 
 
-def insert_into_earthquake(db_conn: connection,
-                           db_cursor: cursor,
-                           earthquake_data: list[dict]) -> None:
-    """Inserts cleaned data into the earthquake table."""
+def set_watermark(db_conn: connection, db_cursor: cursor,
+                  feed_name: str, high_water_mark: int) -> None:
+    """Advances the stored watermark for a feed. It never moves backwards, so overlapping runs are safe."""
+    query = """INSERT INTO feed_state (feed_name, high_water_mark) VALUES (%s, %s)
+                ON CONFLICT (feed_name) DO UPDATE
+                SET high_water_mark = GREATEST(feed_state.high_water_mark, EXCLUDED.high_water_mark)"""
+    try:
+        with transaction(db_conn):
+            db_cursor.execute(query, (feed_name, high_water_mark))
+        logging.info("Watermark for %s set to %s", feed_name, high_water_mark)
+    except psycopg2.Error as e:
+        logging.error("Database error while updating watermark: %s", e)
+        raise
+
 
+def get_feed_validators(db_cursor: cursor, feed_names: tuple[str]) -> dict[str, dict]:
+    """Gets the ETag and Last-Modified values stored from the last successful fetch of each feed."""
     try:
-        value_list = []
-
-        query = """INSERT INTO earthquakes(time, felt_report_count, magnitude,
-                            cdi, latitude, longitude, detail_url, alert_id, magnitude_id, network_id, depth, place) VALUES
-                            (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"""
-        for earthquake in earthquake_data:
-            try:
-                alert_id = get_foreign_key(
-                    db_cursor, 'alerts', 'alert_type', earthquake['alert'])
-                magnitude_id = get_foreign_key(
-                    db_cursor, 'magnitude', 'magnitude_type', earthquake['magnitude_type'])
-                network_id = get_foreign_key(
-                    db_cursor, 'networks', 'network_name', earthquake['network'])
-
-                values = (
-                    earthquake['at'],
-                    int(earthquake['felt']),
-                    float(earthquake['magnitude']),
-                    float(earthquake['cdi']),
-                    float(earthquake['latitude']),
-                    float(earthquake['longitude']),
-                    earthquake['event_url'],
-                    alert_id,
-                    magnitude_id,
-                    network_id,
-                    float(earthquake['depth']),
-                    earthquake['location']
-                )
-
-                value_list.append(values)
-
-            except ValueError as e:
-                logging.error("Skipping record due to ValueError: %s", e)
-                continue
-            except Exception as e:
-                logging.error(
-                    "Unexpected error while processing earthquake data: %s", e)
-                continue
-
-        if value_list:
-            logging.info(
-                "Inserting %s records into the earthquake table", len(value_list))
-            db_cursor.executemany(query, value_list)
-            db_conn.commit()
-            logging.info("Data successfully inserted into the database")
-        else:
-            logging.warning("No valid records to insert.")
+        db_cursor.execute(
+            "SELECT feed_name, feed_url, etag, last_modified FROM feed_state WHERE feed_name = ANY(%s)",
+            (list(feed_names),))
+        return {row["feed_name"]: {"feed_url": row["feed_url"],
+                                   "etag": row["etag"],
+                                   "last_modified": row["last_modified"]}
+                for row in db_cursor.fetchall()}
 
     except psycopg2.Error as e:
-        logging.error("Database error while inserting earthquake data: %s", e)
+        logging.error("Database error while fetching feed validators: %s", e)
         raise
-    except Exception as e:
-        logging.error(
-            "Unexpected error while inserting earthquake data: %s", e)
+
+
+def set_feed_validators(db_conn: connection, db_cursor: cursor,
+                        validators: dict[str, dict]) -> None:
+    """Stores the ETag and Last-Modified values of the last successfully loaded fetch of each feed."""
+    query = """INSERT INTO feed_state (feed_name, feed_url, etag, last_modified) VALUES (%s, %s, %s, %s)
+                ON CONFLICT (feed_name) DO UPDATE
+                SET feed_url = EXCLUDED.feed_url, etag = EXCLUDED.etag, last_modified = EXCLUDED.last_modified"""
+    values = [(feed_name, feed_validators.get("feed_url"),
+               feed_validators.get("etag"), feed_validators.get("last_modified"))
+              for feed_name, feed_validators in validators.items()]
+    try:
+        with transaction(db_conn):
+            db_cursor.executemany(query, values)
+    except psycopg2.Error as e:
+        logging.error("Database error while updating feed validators: %s", e)
         raise
 
 
-def load_data(clean_data: list[dict]) -> None:
-    """Calls necessary functions to upload data to rds"""
+def load_data(clean_data: EarthquakeBatch, feed_name: str = None,
+              high_water_mark: int = None, conn: connection = None) -> None:
+    """
+    Calls necessary functions to upload data to rds.
+    The earthquakes, quarantined rows and watermark of the batch are committed together in one transaction.
+    """
     load_dotenv()
-    conn = get_connection()
+    if conn is None:
+        conn = get_shared_connection()
     app_cursor = get_cursor(conn)
-    insert_into_earthquake(conn, app_cursor, clean_data)
+    with transaction(conn):
+        insert_into_earthquake(conn, app_cursor, clean_data)
+        flush_quarantine(app_cursor)
+        if feed_name and high_water_mark is not None:
+            set_watermark(conn, app_cursor, feed_name, high_water_mark)
@@ -0,0 +1,7 @@
+-- Stores the largest `updated` timestamp (epoch milliseconds) ingested from each feed,
+-- so each ETL run only extracts features that are new or changed since the previous one.
+CREATE TABLE IF NOT EXISTS feed_state (
+    feed_name VARCHAR(50) NOT NULL,
+    high_water_mark BIGINT NOT NULL,
+    PRIMARY KEY (feed_name)
+);
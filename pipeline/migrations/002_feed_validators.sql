@@ -0,0 +1,7 @@
+-- Stores the ETag and Last-Modified response headers of the last loaded fetch,
+-- so the next run can send a conditional request and skip the pipeline on a 304.
+ALTER TABLE feed_state
+    ALTER COLUMN high_water_mark DROP NOT NULL,
+    ADD COLUMN IF NOT EXISTS feed_url VARCHAR(255),
+    ADD COLUMN IF NOT EXISTS etag VARCHAR(255),
+    ADD COLUMN IF NOT EXISTS last_modified VARCHAR(50);
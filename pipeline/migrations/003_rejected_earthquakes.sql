@@ -0,0 +1,14 @@
+-- Keeps the earthquake records rejected by validation or by the load, with the reasons,
+-- so they can be inspected and replayed (python replay.py replay) after the rules change.
+CREATE TABLE IF NOT EXISTS rejected_earthquakes (
+    rejected_id BIGINT GENERATED ALWAYS AS IDENTITY,
+    rejected_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    stage VARCHAR(20) NOT NULL,
+    reasons VARCHAR(255) NOT NULL,
+    record JSONB NOT NULL,
+    replayed_at TIMESTAMPTZ,
+    PRIMARY KEY (rejected_id)
+);
+
+CREATE INDEX IF NOT EXISTS rejected_earthquakes_pending_idx
+    ON rejected_earthquakes (rejected_id) WHERE replayed_at IS NULL;
@@ -0,0 +1,7 @@
+-- Widens the lookup values so load can add the networks and magnitude types USGS reports
+-- beyond the seed lists (e.g. mb_lg, ms_20, iscgem) instead of skipping their earthquakes.
+ALTER TABLE magnitude_types
+    ALTER COLUMN magnitude_type TYPE VARCHAR(20);
+
+ALTER TABLE networks
+    ALTER COLUMN network_name TYPE VARCHAR(20);
@@ -0,0 +1,18 @@
+-- Keys earthquakes on the USGS event id so loads can upsert: replaying a window no longer
+-- creates duplicates, and newer revisions (a larger `updated`, in epoch milliseconds) replace older ones.
+ALTER TABLE earthquakes
+    ADD COLUMN IF NOT EXISTS event_id VARCHAR(50),
+    ADD COLUMN IF NOT EXISTS updated BIGINT;
+
+-- Existing rows get their id from the detail URL, e.g. .../detail/us7000nrz6.geojson.
+UPDATE earthquakes
+SET event_id = substring(detail_url FROM '/detail/([^/]+)\.geojson$')
+WHERE event_id IS NULL;
+
+-- Keeps the most recently loaded copy of events loaded more than once.
+DELETE FROM earthquakes AS duplicate
+USING earthquakes AS kept
+WHERE duplicate.event_id = kept.event_id
+  AND duplicate.earthquake_id < kept.earthquake_id;
+
+CREATE UNIQUE INDEX IF NOT EXISTS earthquakes_event_id_key ON earthquakes (event_id);
@@ -0,0 +1,3 @@
+-- Orders earthquakes by (time, earthquake_id), the order the API pages through them in, so each page
+-- seeks straight past the last row of the previous one instead of sorting the whole match.
+CREATE INDEX IF NOT EXISTS earthquakes_time_id_idx ON earthquakes (time, earthquake_id);
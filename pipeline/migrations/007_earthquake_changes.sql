@@ -0,0 +1,9 @@
+-- The UTC hours each load touched, including the hours revised events moved out of.
+-- The API reads the rows added since its last check to expire the cached responses built from those hours.
+-- The load step deletes rows older than a day, long after any cached response built before them has expired.
+CREATE TABLE IF NOT EXISTS earthquake_changes (
+    change_id BIGINT GENERATED ALWAYS AS IDENTITY,
+    hour TIMESTAMPTZ NOT NULL,
+    changed_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (change_id)
+);
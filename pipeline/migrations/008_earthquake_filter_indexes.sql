@@ -0,0 +1,8 @@
+-- Indexes behind the API's filters, each returning rows in the (time, earthquake_id) order the API pages in.
+-- Date ranges use earthquakes_time_id_idx from migration 006, now that the filter no longer casts time.
+-- Alert levels are few, so the alert id leads and each level is read already in page order.
+CREATE INDEX IF NOT EXISTS earthquakes_alert_time_idx ON earthquakes (alert_id, time, earthquake_id);
+CREATE INDEX IF NOT EXISTS earthquakes_magnitude_idx ON earthquakes (magnitude);
+-- Earthquakes arrive roughly in time order, so a BRIN summary of time answers wide range scans,
+-- such as the dashboard's, for a few pages of index instead of a B-tree the size of the table.
+CREATE INDEX IF NOT EXISTS earthquakes_time_brin_idx ON earthquakes USING brin (time);
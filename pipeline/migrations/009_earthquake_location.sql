@@ -0,0 +1,9 @@
+-- Stores each earthquake's position as a PostGIS geography point, kept in step with latitude and longitude,
+-- and indexes it with GiST so radius and nearest-earthquake queries read a few index pages instead of every row.
+-- Needs the PostGIS extension, which RDS provides.
+CREATE EXTENSION IF NOT EXISTS postgis;
+
+ALTER TABLE earthquakes ADD COLUMN IF NOT EXISTS location geography(Point, 4326)
+    GENERATED ALWAYS AS (ST_SetSRID(ST_MakePoint(longitude::float8, latitude::float8), 4326)::geography) STORED;
+
+CREATE INDEX IF NOT EXISTS earthquakes_location_idx ON earthquakes USING gist (location);
@@ -0,0 +1,58 @@
+-- Hourly and daily summaries of earthquakes: in total ('all', with an empty value) and per alert level,
+-- network and region. The load step recomputes the hours and days each batch touches, so the API's
+-- statistics read a handful of summary rows instead of aggregating every earthquake.
+CREATE TABLE IF NOT EXISTS earthquake_rollups_hourly (
+    hour TIMESTAMPTZ NOT NULL,
+    dimension VARCHAR(10) NOT NULL,
+    dimension_value VARCHAR(100) NOT NULL,
+    earthquake_count INT NOT NULL,
+    magnitude_sum DECIMAL NOT NULL,
+    max_magnitude DECIMAL NOT NULL,
+    max_earthquake_id BIGINT NOT NULL,
+    PRIMARY KEY (hour, dimension, dimension_value)
+);
+
+CREATE TABLE IF NOT EXISTS earthquake_rollups_daily (
+    day TIMESTAMPTZ NOT NULL,
+    dimension VARCHAR(10) NOT NULL,
+    dimension_value VARCHAR(100) NOT NULL,
+    earthquake_count INT NOT NULL,
+    magnitude_sum DECIMAL NOT NULL,
+    max_magnitude DECIMAL NOT NULL,
+    max_earthquake_id BIGINT NOT NULL,
+    PRIMARY KEY (day, dimension, dimension_value)
+);
+
+-- Summarises the earthquakes already stored.
+INSERT INTO earthquake_rollups_hourly
+SELECT date_trunc('hour', e.time, 'UTC') AS hour,
+       CASE WHEN GROUPING(a.alert_type) = 0 THEN 'alert'
+            WHEN GROUPING(n.network_name) = 0 THEN 'network' ELSE 'all' END,
+       COALESCE(a.alert_type, n.network_name, ''),
+       count(*), sum(e.magnitude), max(e.magnitude),
+       (array_agg(e.earthquake_id ORDER BY e.magnitude DESC, e.earthquake_id))[1]
+FROM earthquakes e
+JOIN alerts a ON e.alert_id = a.alert_id
+JOIN networks n ON e.network_id = n.network_id
+GROUP BY GROUPING SETS ((date_trunc('hour', e.time, 'UTC')),
+                        (date_trunc('hour', e.time, 'UTC'), a.alert_type),
+                        (date_trunc('hour', e.time, 'UTC'), n.network_name))
+ON CONFLICT DO NOTHING;
+
+INSERT INTO earthquake_rollups_hourly
+SELECT date_trunc('hour', e.time, 'UTC'), 'region', r.region_name,
+       count(*), sum(e.magnitude), max(e.magnitude),
+       (array_agg(e.earthquake_id ORDER BY e.magnitude DESC, e.earthquake_id))[1]
+FROM earthquakes e
+JOIN regions r ON e.latitude BETWEEN r.min_latitude AND r.max_latitude
+              AND e.longitude BETWEEN r.min_longitude AND r.max_longitude
+GROUP BY 1, r.region_name
+ON CONFLICT DO NOTHING;
+
+INSERT INTO earthquake_rollups_daily
+SELECT date_trunc('day', hour, 'UTC'), dimension, dimension_value,
+       sum(earthquake_count), sum(magnitude_sum), max(max_magnitude),
+       (array_agg(max_earthquake_id ORDER BY max_magnitude DESC, max_earthquake_id))[1]
+FROM earthquake_rollups_hourly
+GROUP BY 1, dimension, dimension_value
+ON CONFLICT DO NOTHING;
@@ -0,0 +1,101 @@
+# pylint: disable=line-too-long
+
+'''
+Module that keeps the earthquake records rejected by validation or by the load, with the reason for each.
+Rejected rows are buffered during a run and written in one batched write, either to the
+rejected_earthquakes table or, if QUARANTINE_FILE is set, to a newline-delimited JSON file.
+replay.py re-validates them once the rules change.
+'''
+
+import json
+import logging
+import math
+import os
+from datetime import datetime, timezone
+from psycopg2.extensions import cursor
+from psycopg2.extras import Json, execute_values
+from batch import EarthquakeBatch
+
+PENDING = []
+# Longest reason stored, the width of rejected_earthquakes.reasons.
+MAX_REASON_LENGTH = 255
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+def reset_quarantine() -> None:
+    """Drops any buffered rows, as the buffer survives warm Lambda invocations."""
+    PENDING.clear()
+
+
+def quarantine(earthquake_data: EarthquakeBatch, reasons: list[str], stage: str) -> None:
+    """
+    Buffers rejected rows with the reason each was rejected and the pipeline stage that rejected it.
+    Reasons are cut to MAX_REASON_LENGTH, so a long error message cannot fail the batch's insert.
+    """
+    if len(earthquake_data) != len(reasons):
+        raise ValueError("Each quarantined row needs a reason.")
+    if len(earthquake_data):
+        PENDING.append((earthquake_data, [reason[:MAX_REASON_LENGTH] for reason in reasons], stage))
+
+
+def to_json_record(record: dict) -> dict:
+    """Replaces NaN, which JSON and JSONB cannot hold, with None."""
+    return {name: None if isinstance(value, float) and math.isnan(value) else value
+            for name, value in record.items()}
+
+
+def get_pending() -> list[dict]:
+    """Returns the buffered rows as JSON-ready entries."""
+    return [{"stage": stage, "reasons": reason, "record": to_json_record(record)}
+            for earthquake_data, reasons, stage in PENDING
+            for reason, record in zip(reasons, earthquake_data.to_records(stringify_datetimes=True))]
+
+
+def write_quarantine_table(db_cursor: cursor, entries: list[dict]) -> None:
+    """Inserts the entries into rejected_earthquakes with a single multi-row INSERT, in the caller's transaction."""
+    query = "INSERT INTO rejected_earthquakes (stage, reasons, record) VALUES %s"
+    execute_values(db_cursor, query,
+                   [(entry["stage"], entry["reasons"], Json(entry["record"]))
+                    for entry in entries],
+                   page_size=len(entries))
+
+
+def write_quarantine_file(path: str, entries: list[dict]) -> None:
+    """Appends the entries to a newline-delimited JSON file with a single write."""
+    rejected_at = datetime.now(timezone.utc).isoformat()
+    lines = "".join(json.dumps({"rejected_at": rejected_at, **entry}) + "\n"
+                    for entry in entries)
+    with open(path, "a", encoding="utf-8") as quarantine_file:
+        quarantine_file.write(lines)
+
+
+def flush_quarantine(db_cursor: cursor = None) -> int:
+    """Writes all buffered rows to the configured sink and empties the buffer. Returns the number written."""
+    entries = get_pending()
+    if not entries:
+        return 0
+
+    path = os.getenv("QUARANTINE_FILE")
+    if path:
+        write_quarantine_file(path, entries)
+    else:
+        write_quarantine_table(db_cursor, entries)
+
+    reset_quarantine()
+    logging.info("Quarantined %s rejected earthquake records", len(entries))
+    return len(entries)
+
+
+def read_quarantine_table(db_cursor: cursor, limit: int) -> list[tuple[int, dict]]:
+    """Gets the rejected rows that have not been replayed yet, oldest first."""
+    db_cursor.execute("""SELECT rejected_id, record FROM rejected_earthquakes
+                         WHERE replayed_at IS NULL ORDER BY rejected_id LIMIT %s""", (limit,))
+    return [(row["rejected_id"], row["record"]) for row in db_cursor.fetchall()]
+
+
+def read_quarantine_file(path: str) -> list[dict]:
+    """Reads every entry of a quarantine file."""
+    with open(path, encoding="utf-8") as quarantine_file:
+        return [json.loads(line) for line in quarantine_file if line.strip()]
@@ -0,0 +1,113 @@
+# pylint: disable=line-too-long
+
+'''
+Module that re-validates quarantined earthquakes after the validation rules change.
+Rows that now pass are loaded into the earthquakes table; the rest stay quarantined with their new reasons.
+'''
+
+import argparse
+import json
+import logging
+import os
+import numpy as np
+from dotenv import load_dotenv
+from psycopg2.extensions import connection, cursor
+from psycopg2.extras import execute_values
+from batch import EarthquakeBatch
+from transform import clean_data
+from db import get_connection, get_cursor, transaction
+from load import insert_into_earthquake
+from quarantine import PENDING, reset_quarantine, read_quarantine_table, read_quarantine_file
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+def revalidate(db_conn: connection, db_cursor: cursor,
+               records: list[dict]) -> dict[int, str]:
+    """
+    Runs quarantined records through the current rules and loads those that now pass.
+    Returns the reasons of the records, by position, that are still rejected.
+    """
+    earthquake_data = EarthquakeBatch.from_records(records)
+    earthquake_data["position"] = np.arange(len(records))
+
+    reset_quarantine()
+    try:
+        insert_into_earthquake(db_conn, db_cursor, clean_data(earthquake_data))
+        return {position: reason
+                for rejected, reasons, _ in PENDING
+                for position, reason in zip(rejected["position"].tolist(), reasons)}
+    finally:
+        reset_quarantine()
+
+
+def replay_table(db_conn: connection, db_cursor: cursor, limit: int) -> tuple[int, int]:
+    """
+    Replays unreplayed rows of rejected_earthquakes. The loaded earthquakes and the updated quarantine rows
+    are committed in one transaction. Returns the number replayed and still rejected.
+    """
+    with transaction(db_conn):
+        rows = read_quarantine_table(db_cursor, limit)
+        if not rows:
+            return 0, 0
+
+        still_rejected = revalidate(db_conn, db_cursor, [record for _, record in rows])
+        replayed = [rejected_id for position, (rejected_id, _) in enumerate(rows)
+                    if position not in still_rejected]
+
+        if replayed:
+            db_cursor.execute("UPDATE rejected_earthquakes SET replayed_at = NOW() WHERE rejected_id = ANY(%s)",
+                              (replayed,))
+        if still_rejected:
+            execute_values(db_cursor,
+                           """UPDATE rejected_earthquakes SET reasons = data.reasons
+                              FROM (VALUES %s) AS data (rejected_id, reasons)
+                              WHERE rejected_earthquakes.rejected_id = data.rejected_id""",
+                           [(rows[position][0], reason)
+                            for position, reason in still_rejected.items()],
+                           page_size=len(still_rejected))
+    return len(replayed), len(still_rejected)
+
+
+def replay_file(db_conn: connection, db_cursor: cursor, path: str) -> tuple[int, int]:
+    """Replays a quarantine file, rewriting it with only the entries that are still rejected."""
+    entries = read_quarantine_file(path)
+    if not entries:
+        return 0, 0
+
+    still_rejected = revalidate(db_conn, db_cursor, [entry["record"] for entry in entries])
+    remaining = "".join(json.dumps({**entries[position], "reasons": reason}) + "\n"
+                        for position, reason in still_rejected.items())
+    with open(path + ".tmp", "w", encoding="utf-8") as quarantine_file:
+        quarantine_file.write(remaining)
+    os.replace(path + ".tmp", path)
+    return len(entries) - len(still_rejected), len(still_rejected)
+
+
+def replay_quarantine(limit: int = 10000, path: str = None) -> tuple[int, int]:
+    """Re-validates quarantined rows after the rules have changed, loading those that now pass."""
+    load_dotenv()
+    conn = get_connection()
+    app_cursor = get_cursor(conn)
+    path = path or os.getenv("QUARANTINE_FILE")
+    if path:
+        replayed, rejected = replay_file(conn, app_cursor, path)
+    else:
+        replayed, rejected = replay_table(conn, app_cursor, limit)
+
+    logging.info("Replayed %s quarantined earthquakes, %s still rejected", replayed, rejected)
+    return replayed, rejected
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Re-validate quarantined earthquakes and load those that pass the current rules.")
+    parser.add_argument("command", choices=["replay"])
+    parser.add_argument("--limit", type=int, default=10000,
+                        help="Maximum number of rows replayed from the rejected_earthquakes table")
+    parser.add_argument("--file", default=None,
+                        help="Replay a newline-delimited JSON quarantine file instead of the table")
+    args = parser.parse_args()
+
+    replay_quarantine(args.limit, args.file)
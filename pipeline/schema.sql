@@ -1,3 +1,8 @@
+CREATE EXTENSION IF NOT EXISTS postgis;
+
+DROP TABLE IF EXISTS earthquake_changes;
+DROP TABLE IF EXISTS earthquake_rollups_hourly;
+DROP TABLE IF EXISTS earthquake_rollups_daily;
 DROP TABLE IF EXISTS earthquakes;
 DROP TABLE IF EXISTS user_topic_assignment;
 DROP TABLE IF EXISTS topics;
@@ -6,6 +11,8 @@ DROP TABLE IF EXISTS magnitude_types;
 DROP TABLE IF EXISTS networks;
 DROP TABLE IF EXISTS users;
 DROP TABLE IF EXISTS regions;
+DROP TABLE IF EXISTS feed_state;
+DROP TABLE IF EXISTS rejected_earthquakes;
 
 CREATE TABLE alerts (
     alert_id SMALLINT GENERATED ALWAYS AS IDENTITY,
@@ -15,13 +22,13 @@ CREATE TABLE alerts (
 
 CREATE TABLE magnitude_types (
     magnitude_id SMALLINT GENERATED ALWAYS AS IDENTITY,
-    magnitude_type VARCHAR(3) UNIQUE NOT NULL,
+    magnitude_type VARCHAR(20) UNIQUE NOT NULL,
     PRIMARY KEY (magnitude_id)
 );
 
 CREATE TABLE networks (
     network_id SMALLINT GENERATED ALWAYS AS IDENTITY,
-    network_name VARCHAR(2) UNIQUE NOT NULL,
+    network_name VARCHAR(20) UNIQUE NOT NULL,
     PRIMARY KEY (network_id)
 );
 
@@ -40,7 +47,12 @@ CREATE TABLE earthquakes (
     magnitude_id SMALLINT,
     network_id SMALLINT,
     place VARCHAR(255),
+    event_id VARCHAR(50),
+    updated BIGINT,
+    location geography(Point, 4326)
+        GENERATED ALWAYS AS (ST_SetSRID(ST_MakePoint(longitude::float8, latitude::float8), 4326)::geography) STORED,
     PRIMARY KEY (earthquake_id),
+    CONSTRAINT earthquakes_event_id_key UNIQUE (event_id),
     FOREIGN KEY (alert_id) REFERENCES alerts(alert_id),
     FOREIGN KEY (magnitude_id) REFERENCES magnitude_types(magnitude_id),
     FOREIGN KEY (network_id) REFERENCES networks(network_id),
@@ -48,6 +60,63 @@ CREATE TABLE earthquakes (
     CONSTRAINT longitude_range CHECK (longitude BETWEEN -180.0 AND 180.0)
 );
 
+CREATE INDEX earthquakes_time_id_idx ON earthquakes (time, earthquake_id);
+CREATE INDEX earthquakes_alert_time_idx ON earthquakes (alert_id, time, earthquake_id);
+CREATE INDEX earthquakes_magnitude_idx ON earthquakes (magnitude);
+CREATE INDEX earthquakes_time_brin_idx ON earthquakes USING brin (time);
+CREATE INDEX earthquakes_location_idx ON earthquakes USING gist (location);
+
+CREATE TABLE earthquake_rollups_hourly (
+    hour TIMESTAMPTZ NOT NULL,
+    dimension VARCHAR(10) NOT NULL,
+    dimension_value VARCHAR(100) NOT NULL,
+    earthquake_count INT NOT NULL,
+    magnitude_sum DECIMAL NOT NULL,
+    max_magnitude DECIMAL NOT NULL,
+    max_earthquake_id BIGINT NOT NULL,
+    PRIMARY KEY (hour, dimension, dimension_value)
+);
+
+CREATE TABLE earthquake_rollups_daily (
+    day TIMESTAMPTZ NOT NULL,
+    dimension VARCHAR(10) NOT NULL,
+    dimension_value VARCHAR(100) NOT NULL,
+    earthquake_count INT NOT NULL,
+    magnitude_sum DECIMAL NOT NULL,
+    max_magnitude DECIMAL NOT NULL,
+    max_earthquake_id BIGINT NOT NULL,
+    PRIMARY KEY (day, dimension, dimension_value)
+);
+
+CREATE TABLE earthquake_changes (
+    change_id BIGINT GENERATED ALWAYS AS IDENTITY,
+    hour TIMESTAMPTZ NOT NULL,
+    changed_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (change_id)
+);
+
+CREATE TABLE feed_state (
+    feed_name VARCHAR(50) NOT NULL,
+    high_water_mark BIGINT,
+    feed_url VARCHAR(255),
+    etag VARCHAR(255),
+    last_modified VARCHAR(50),
+    PRIMARY KEY (feed_name)
+);
+
+CREATE TABLE rejected_earthquakes (
+    rejected_id BIGINT GENERATED ALWAYS AS IDENTITY,
+    rejected_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    stage VARCHAR(20) NOT NULL,
+    reasons VARCHAR(255) NOT NULL,
+    record JSONB NOT NULL,
+    replayed_at TIMESTAMPTZ,
+    PRIMARY KEY (rejected_id)
+);
+
+CREATE INDEX rejected_earthquakes_pending_idx
+    ON rejected_earthquakes (rejected_id) WHERE replayed_at IS NULL;
+
 CREATE TABLE users (
     user_id BIGINT GENERATED ALWAYS AS IDENTITY,
     email VARCHAR(255) UNIQUE,
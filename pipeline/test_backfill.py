@@ -0,0 +1,156 @@
+# pylint: skip-file
+
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import MagicMock, patch
+from urllib.parse import urlparse, parse_qs
+import json
+import sys
+import threading
+import pytest
+from backfill import *
+
+START = datetime(2024, 12, 1)
+
+
+def make_feature(event_id: str, at: datetime, updated_offset: int = 0) -> dict:
+    """Builds a GeoJSON feature as served by the FDSN event API"""
+    epoch_ms = int(at.replace(tzinfo=timezone.utc).timestamp() * 1000)
+    return {
+        "type": "Feature",
+        "properties": {
+            "mag": 2.5,
+            "place": f"Place {event_id}",
+            "time": epoch_ms,
+            "updated": epoch_ms + updated_offset,
+            "felt": None,
+            "cdi": None,
+            "alert": None,
+            "detail": f"http://example.com/{event_id}",
+            "net": "us",
+            "magType": "mb",
+        },
+        "geometry": {"coordinates": [-117.5, 35.7, 10.0]},
+        "id": event_id
+    }
+
+
+# One event every 6 hours over two days, one event exactly on the day boundary
+# and a revised copy of us3 that should win over the original.
+CANNED_FEATURES = [make_feature(f"us{i}", START + timedelta(hours=6 * i))
+                   for i in range(8)]
+CANNED_FEATURES.append(make_feature("us3", START + timedelta(hours=18), 5000))
+
+
+class FDSNHandler(BaseHTTPRequestHandler):
+    """Stand-in for the FDSN event query endpoint serving canned pages"""
+    requests_seen = []
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        FDSNHandler.requests_seen.append(query)
+        start = datetime.fromisoformat(query["starttime"][0])
+        end = datetime.fromisoformat(query["endtime"][0])
+        offset = int(query["offset"][0])
+        limit = int(query["limit"][0])
+
+        def event_time(feature):
+            return datetime.fromtimestamp(feature["properties"]["time"] / 1000, timezone.utc).replace(tzinfo=None)
+
+        matching = sorted((feature for feature in CANNED_FEATURES
+                           if start <= event_time(feature) <= end), key=event_time)
+        page = matching[offset - 1:offset - 1 + limit]
+
+        body = json.dumps({"type": "FeatureCollection",
+                           "metadata": {"count": len(page)},
+                           "features": page}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def fdsn_url():
+    """Runs the stand-in FDSN server for the duration of a test"""
+    FDSNHandler.requests_seen = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FDSNHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/fdsnws/event/1/query"
+    server.shutdown()
+    server.server_close()
+
+
+def test_split_windows():
+    """Test split_windows covers the range without gaps"""
+    windows = split_windows(START, START + timedelta(hours=60))
+
+    assert windows == [(START, START + timedelta(days=1)),
+                       (START + timedelta(days=1), START + timedelta(days=2)),
+                       (START + timedelta(days=2), START + timedelta(hours=60))]
+
+
+def test_split_windows_invalid_range():
+    """Test split_windows rejects an empty range"""
+    with pytest.raises(ValueError):
+        split_windows(START, START)
+
+
+def test_deduplicate_keeps_latest():
+    """Test deduplicate keeps the latest revision and drops already emitted events"""
+    records = [{"event_id": "a", "updated": 1}, {"event_id": "a", "updated": 3},
+               {"event_id": "b", "updated": 1}, {"event_id": "c", "updated": 1}]
+
+    result = deduplicate(records, {"c"})
+
+    assert result == [{"event_id": "a", "updated": 3},
+                      {"event_id": "b", "updated": 1}]
+
+
+def test_fetch_window_pages(fdsn_url):
+    """Test fetch_window follows offset pages until a short page"""
+    result = fetch_window(START, START + timedelta(days=1), 2, fdsn_url)
+
+    assert len(result) == 6
+    assert [int(query["offset"][0]) for query in FDSNHandler.requests_seen] == [1, 3, 5, 7]
+
+
+def test_fetch_window_pages_past_skipped_features(fdsn_url, monkeypatch):
+    """Test a full page is followed by the next even when some of its features were skipped"""
+    broken = make_feature("us_broken", START + timedelta(hours=1))
+    del broken["geometry"]
+    monkeypatch.setattr(sys.modules[__name__], "CANNED_FEATURES", [broken] + CANNED_FEATURES[:4])
+
+    result = fetch_window(START, START + timedelta(days=1), 2, fdsn_url)
+
+    assert [earthquake["event_id"] for earthquake in result] == [f"us{i}" for i in range(4)]
+    assert [int(query["offset"][0]) for query in FDSNHandler.requests_seen] == [1, 3, 5]
+
+
+def test_iter_backfill_merges_windows(fdsn_url):
+    """Test iter_backfill fetches windows concurrently and returns merged, deduplicated records"""
+    result = list(iter_backfill(START, START + timedelta(days=2), timedelta(hours=12),
+                                max_workers=3, limit=2, base_url=fdsn_url))
+
+    assert [earthquake["event_id"] for earthquake in result] == [
+        f"us{i}" for i in range(8)]
+    revised = next(earthquake for earthquake in result if earthquake["event_id"] == "us3")
+    assert revised["updated"] == CANNED_FEATURES[-1]["properties"]["updated"]
+
+
+@patch("backfill.load_data")
+@patch("backfill.get_connection")
+def test_run_backfill_loads_in_chunks(mock_get_connection, mock_load_data, fdsn_url):
+    """Test run_backfill transforms and loads the records chunk by chunk"""
+    total = run_backfill(START, START + timedelta(days=2), timedelta(hours=12),
+                         max_workers=2, chunk_size=3, base_url=fdsn_url)
+
+    assert total == 8
+    assert [len(call.args[0]) for call in mock_load_data.call_args_list] == [3, 3, 2]
+    assert all(call.kwargs["conn"] is mock_get_connection.return_value
+               for call in mock_load_data.call_args_list)
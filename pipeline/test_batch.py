@@ -0,0 +1,111 @@
+# pylint: skip-file
+
+import datetime
+import numpy as np
+import pytest
+from batch import *
+
+
+@pytest.fixture
+def records():
+    """Fixture for extracted records"""
+    return [{
+        'at': datetime.datetime(2024, 12, 3, 13, 42, 51, 530000),
+        'event_url': 'https://example.com/1',
+        'felt': None,
+        'location': '8 km SW of Volcano, Hawaii',
+        'magnitude': 1.79,
+        'network': 'hv',
+        'alert': None,
+        'magnitude_type': 'md',
+        'cdi': '3.4',
+        'longitude': -155.28,
+        'latitude': 19.38,
+        'depth': 13,
+        'updated': 1733233371530,
+        'event_id': 'hv1'
+    },
+        {
+        'at': datetime.datetime(2024, 12, 1, 3, 22, 15),
+        'event_url': 'https://example.com/2',
+        'felt': 4,
+        'location': '10 km NE of Ridgecrest, California',
+        'magnitude': "Invalid",
+        'network': 'ci',
+        'alert': 'yellow',
+        'magnitude_type': 'ml',
+        'cdi': 3.2,
+        'longitude': None,
+        'latitude': 35.7038,
+        'depth': 20.1,
+        'updated': 1733023335000,
+        'event_id': 'ci2'
+    }]
+
+
+def test_from_records_column_types(records):
+    """Test from_records builds one typed array per column"""
+    batch = EarthquakeBatch.from_records(iter(records))
+
+    assert len(batch) == 2
+    assert batch["at"].dtype == np.dtype("datetime64[us]")
+    assert batch["magnitude"].dtype == np.float64
+    assert batch["updated"].dtype == np.int64
+    assert batch["location"].dtype == object
+    assert batch["depth"].tolist() == [13.0, 20.1]
+    assert batch["cdi"].tolist() == [3.4, 3.2]
+
+
+def test_from_records_non_numeric_values_become_nan(records):
+    """Test missing and non-numeric values are stored as NaN"""
+    batch = EarthquakeBatch.from_records(records)
+
+    assert np.isnan(batch["felt"][0])
+    assert np.isnan(batch["magnitude"][1])
+    assert np.isnan(batch["longitude"][1])
+
+
+def test_filter(records):
+    """Test filter keeps only the masked rows"""
+    batch = EarthquakeBatch.from_records(records).filter(np.array([False, True]))
+
+    assert len(batch) == 1
+    assert batch["event_id"].tolist() == ["ci2"]
+
+
+def test_concat(records):
+    """Test concat joins batches"""
+    batch = EarthquakeBatch.concat([EarthquakeBatch.from_records(records[:1]),
+                                    EarthquakeBatch.from_records(records[1:])])
+
+    assert batch["event_id"].tolist() == ["hv1", "ci2"]
+    assert len(EarthquakeBatch.concat([])) == 0
+
+
+def test_set_column_length_mismatch(records):
+    """Test a column of the wrong length is rejected"""
+    batch = EarthquakeBatch.from_records(records)
+
+    with pytest.raises(ValueError):
+        batch["felt"] = np.zeros(3)
+
+
+def test_rows(records):
+    """Test rows yields plain Python values"""
+    rows = list(EarthquakeBatch.from_records(
+        records).rows(("at", "event_id", "depth")))
+
+    assert rows[0] == (datetime.datetime(2024, 12, 3, 13, 42, 51, 530000), "hv1", 13.0)
+    assert type(rows[0][2]) is float
+
+
+def test_to_records_stringify_datetimes(records):
+    """Test to_records formats datetimes like str(datetime)"""
+    batch = EarthquakeBatch.from_records(records)
+    batch["at"] = batch["at"].astype("datetime64[s]")
+
+    result = batch.to_records(stringify_datetimes=True)
+
+    assert result[1]["at"] == str(datetime.datetime(2024, 12, 1, 3, 22, 15))
+    assert result[0]["updated"] == 1733233371530
+    assert result[0]["alert"] is None
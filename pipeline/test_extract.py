@@ -1,13 +1,18 @@
 # pylint: skip-file
 
-from unittest.mock import patch
+from unittest.mock import patch, MagicMock
 from datetime import datetime, timedelta
-from extract import get_data
+from extract import (get_data, iter_features, stream_data, select_feed, get_high_water_mark,
+                     fetch_feed, reset_fetch_stats, request_with_retry, get_backoff, get_feeds, FEEDS,
+                     FETCH_STATS, CONNECT_TIMEOUT, READ_TIMEOUT, MAX_ATTEMPTS, BACKOFF_CAP)
+import json
+import numpy as np
+from batch import EarthquakeBatch
 import pytest
 import requests
 
 
-@patch('extract.requests.get')
+@patch('extract.SESSION.get')
 def test_get_data_valid_response(mock_get):
     """Test for get_data"""
     mock_response = {
@@ -38,14 +43,14 @@ def test_get_data_valid_response(mock_get):
     result = get_data()
 
     assert len(result) == 1
-    assert result[0]["event_url"] == "http://example.com/quake1"
-    assert result[0]["location"] == "Location A"
-    assert result[0]["magnitude"] == 4.5
-    assert result[0]["latitude"] == -35.678
-    assert result[0]["longitude"] == 120.123
+    assert result["event_url"][0] == "http://example.com/quake1"
+    assert result["location"][0] == "Location A"
+    assert result["magnitude"][0] == 4.5
+    assert result["latitude"][0] == -35.678
+    assert result["longitude"][0] == 120.123
 
 
-@patch('extract.requests.get')
+@patch('extract.SESSION.get')
 def test_get_data_no_recent_data(mock_get):
     """Test get_data when there is no data to extract"""
     mock_response = {
@@ -78,7 +83,7 @@ def test_get_data_no_recent_data(mock_get):
     assert len(result) == 0
 
 
-@patch('extract.requests.get')
+@patch('extract.SESSION.get')
 def test_get_data_missing_fields_valid(mock_get):
     """Test get_data when keys are missing"""
     mock_response = {
@@ -102,14 +107,14 @@ def test_get_data_missing_fields_valid(mock_get):
     result = get_data()
 
     assert len(result) == 1
-    assert result[0]["location"] == "Location C"
-    assert result[0]["magnitude"] == 2.5
-    assert result[0]["felt"] is None
-    assert result[0]["alert"] is None
-    assert result[0]["latitude"] == -15.678
+    assert result["location"][0] == "Location C"
+    assert result["magnitude"][0] == 2.5
+    assert np.isnan(result["felt"][0])
+    assert result["alert"][0] is None
+    assert result["latitude"][0] == -15.678
 
 
-@patch('extract.requests.get')
+@patch('extract.SESSION.get')
 def test_get_data_empty_response(mock_get):
     """Test get_data when it returns nothing"""
     mock_response = {"features": []}
@@ -118,10 +123,10 @@ def test_get_data_empty_response(mock_get):
     result = get_data()
 
     assert len(result) == 0
-    assert result == []
+    assert isinstance(result, EarthquakeBatch)
 
 
-@patch('extract.requests.get')
+@patch('extract.SESSION.get')
 def test_get_data_request_exception(mock_get):
     """Test get_data request error"""
     with pytest.raises(requests.exceptions.RequestException):
@@ -131,7 +136,7 @@ def test_get_data_request_exception(mock_get):
         get_data()
 
 
-@patch('extract.requests.get')
+@patch('extract.SESSION.get')
 def test_get_data_empty_fields_in_data(mock_get):
     """Test get_data when keys have no data"""
     mock_response = {
@@ -152,3 +157,339 @@ def test_get_data_empty_fields_in_data(mock_get):
     result = get_data()
 
     assert len(result) == 0
+
+
+@pytest.fixture
+def feature_collection():
+    """Fixture for a raw GeoJSON feed body"""
+    features = [
+        {
+            "type": "Feature",
+            "properties": {
+                "updated": 1733233371530,
+                "time": 1733233371530,
+                "detail": f"http://example.com/quake{i}",
+                "felt": None,
+                "place": "10 km NE of Peñas Blancas, Costa Rica",
+                "mag": 1.5 + i,
+                "net": "us",
+                "alert": None,
+                "magType": "mb",
+                "cdi": None,
+            },
+            "geometry": {
+                "coordinates": [-85.5, 11.2, 10.0 + i]
+            },
+            "id": f"us{i}"
+        }
+        for i in range(3)
+    ]
+    return json.dumps({
+        "type": "FeatureCollection",
+        "metadata": {"title": "USGS All Earthquakes, Past Hour", "count": 3},
+        "features": features,
+        "bbox": [-85.5, 11.2, 10.0, -85.5, 11.2, 12.0]
+    }, ensure_ascii=False, indent=1).encode("utf-8")
+
+
+def split_into_chunks(body: bytes, size: int) -> list[bytes]:
+    """Splits a body into fixed size chunks"""
+    return [body[i:i + size] for i in range(0, len(body), size)]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 64, 100000])
+def test_iter_features_chunk_boundaries(feature_collection, chunk_size):
+    """Test iter_features gives the same features however the body is split"""
+    result = list(iter_features(
+        split_into_chunks(feature_collection, chunk_size)))
+
+    assert result == json.loads(feature_collection)["features"]
+    assert result[0]["properties"]["place"] == "10 km NE of Peñas Blancas, Costa Rica"
+
+
+def test_iter_features_empty_feed():
+    """Test iter_features with a feed that has no features"""
+    body = b'{"type": "FeatureCollection", "metadata": {}, "features": []}'
+
+    assert list(iter_features(split_into_chunks(body, 5))) == []
+
+
+def test_iter_features_truncated_body(feature_collection):
+    """Test iter_features raises when the body is cut off"""
+    with pytest.raises(ValueError):
+        list(iter_features([feature_collection[:-40]]))
+
+
+def test_iter_features_is_lazy(feature_collection):
+    """Test the first feature is yielded before the whole body is read"""
+    chunks = split_into_chunks(feature_collection, 32)
+    consumed = []
+
+    def chunk_source():
+        for chunk in chunks:
+            consumed.append(chunk)
+            yield chunk
+
+    first = next(iter_features(chunk_source()))
+
+    assert first["id"] == "us0"
+    assert len(consumed) < len(chunks)
+
+
+@patch('extract.SESSION.get')
+def test_stream_data_valid_response(mock_get, feature_collection):
+    """Test stream_data yields normalised records"""
+    mock_response = mock_get.return_value.__enter__.return_value
+    mock_response.iter_content.return_value = split_into_chunks(
+        feature_collection, 50)
+
+    result = stream_data("http://example.com/all_week.geojson")
+
+    assert not mock_get.called
+    result = list(result)
+    assert len(result) == 3
+    assert result[2]["magnitude"] == 3.5
+    assert result[2]["depth"] == 12.0
+    assert result[0]["event_url"] == "http://example.com/quake0"
+    mock_get.assert_called_once_with(
+        "http://example.com/all_week.geojson", timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), stream=True)
+
+
+@patch('extract.SESSION.get')
+def test_stream_data_request_exception(mock_get):
+    """Test stream_data request error"""
+    mock_get.side_effect = requests.exceptions.RequestException(
+        "Request failed")
+
+    with pytest.raises(requests.exceptions.RequestException):
+        list(stream_data())
+
+
+@patch('extract.SESSION.get')
+def test_get_data_since_watermark(mock_get):
+    """Test get_data only keeps features updated after the watermark"""
+    watermark = int((datetime.now() - timedelta(minutes=30)).timestamp() * 1000)
+    mock_response = {
+        "features": [
+            {
+                "properties": {
+                    "updated": watermark + offset,
+                    "time": watermark,
+                    "mag": 2.0,
+                    "cdi": None,
+                },
+                "geometry": {
+                    "coordinates": [110.456, -15.678, 5.0]
+                }
+            }
+            for offset in (-1000, 0, 1000, 60000)
+        ]
+    }
+    mock_get.return_value.json.return_value = mock_response
+
+    result = get_data(watermark)
+
+    assert result["updated"].tolist() == [watermark + 1000, watermark + 60000]
+    assert get_high_water_mark(result) == watermark + 60000
+
+
+def test_get_high_water_mark_empty():
+    """Test get_high_water_mark with no records"""
+    assert get_high_water_mark(EarthquakeBatch.from_records([])) is None
+
+
+def test_select_feed():
+    """Test select_feed picks the smallest feed covering the watermark"""
+    def minutes_ago(minutes):
+        return (datetime.now() - timedelta(minutes=minutes)).timestamp() * 1000
+
+    assert select_feed(minutes_ago(5)).endswith("/all_hour.geojson")
+    assert select_feed(minutes_ago(90)).endswith("/all_day.geojson")
+    assert select_feed(minutes_ago(60 * 50)).endswith("/all_week.geojson")
+    assert select_feed(minutes_ago(60 * 24 * 10)).endswith("/all_month.geojson")
+    assert select_feed(minutes_ago(60 * 24 * 90)).endswith("/all_month.geojson")
+    assert select_feed(minutes_ago(5), "significant_hour").endswith(
+        "/significant_hour.geojson")
+    assert select_feed(minutes_ago(90), "4.5_hour").endswith("/4.5_day.geojson")
+
+
+def make_feed_feature(event_id: str, updated: float, mag: float) -> dict:
+    """Builds a summary feed feature"""
+    return {
+        "properties": {"updated": updated, "time": updated, "mag": mag, "cdi": None},
+        "geometry": {"coordinates": [110.456, -15.678, 5.0]},
+        "id": event_id
+    }
+
+
+@patch('extract.SESSION.get')
+def test_get_data_merges_feeds(mock_get):
+    """Test get_data fetches every feed once and keeps the latest copy of each event"""
+    since = (datetime.now() - timedelta(minutes=5)).timestamp() * 1000
+    bodies = {
+        "significant_hour": [make_feed_feature("us1", since + 1000, 6.1)],
+        "4.5_hour": [make_feed_feature("us1", since + 5000, 6.3),
+                     make_feed_feature("us2", since + 2000, 4.8)],
+        "all_hour": [make_feed_feature("us1", since + 3000, 6.2),
+                     make_feed_feature("us2", since + 2000, 4.8),
+                     make_feed_feature("ci3", since + 4000, 1.2)],
+    }
+
+    def respond(url, **kwargs):
+        feed = url.rsplit("/", 1)[1].removesuffix(".geojson")
+        response = MagicMock(status_code=200, headers={"ETag": f'"{feed}"'})
+        response.json.return_value = {"features": bodies[feed]}
+        return response
+    mock_get.side_effect = respond
+    validators = {}
+
+    result = get_data(since, validators, tuple(bodies))
+
+    assert mock_get.call_count == 3
+    assert sorted(zip(result["event_id"], result["magnitude"])) == [
+        ("ci3", 1.2), ("us1", 6.3), ("us2", 4.8)]
+    assert validators["4.5_hour"]["etag"] == '"4.5_hour"'
+
+
+@patch('extract.SESSION.get')
+def test_get_data_feeds_not_modified(mock_get):
+    """Test get_data merges only the feeds that changed"""
+    since = (datetime.now() - timedelta(minutes=5)).timestamp() * 1000
+
+    def respond(url, **kwargs):
+        if "significant" in url:
+            return MagicMock(status_code=304)
+        response = MagicMock(status_code=200, headers={})
+        response.json.return_value = {"features": [
+            make_feed_feature("us1", since + 1000, 2.0)]}
+        return response
+    mock_get.side_effect = respond
+
+    assert len(get_data(since, {}, ("significant_hour", "all_hour"))) == 1
+
+    mock_get.side_effect = lambda url, **kwargs: MagicMock(status_code=304)
+    assert get_data(since, {}, ("significant_hour", "all_hour")) is None
+
+
+@patch.dict('extract.os.environ', {"USGS_FEEDS": "significant_hour, all_hour"})
+def test_get_feeds_from_environment():
+    """Test get_feeds reads the configured feeds"""
+    assert get_feeds() == ("significant_hour", "all_hour")
+
+
+@patch.dict('extract.os.environ', {"USGS_FEEDS": " , "})
+def test_get_feeds_without_a_feed_uses_default():
+    """Test a setting holding only separators falls back to the default feed instead of no feeds"""
+    assert get_feeds() == FEEDS
+
+
+@patch.dict('extract.os.environ', {}, clear=True)
+def test_get_feeds_default():
+    """Test get_feeds falls back to the default feed"""
+    assert get_feeds() == FEEDS
+
+
+@patch('extract.SESSION.get')
+def test_fetch_feed_sends_validators(mock_get):
+    """Test fetch_feed sends a conditional request and stores the new validators"""
+    reset_fetch_stats()
+    mock_get.return_value.status_code = 200
+    mock_get.return_value.headers = {"ETag": '"def"',
+                                     "Last-Modified": "Tue, 03 Dec 2024 13:43:00 GMT"}
+    validators = {"feed_url": "http://example.com/feed",
+                  "etag": '"abc"',
+                  "last_modified": "Tue, 03 Dec 2024 13:42:00 GMT"}
+
+    response = fetch_feed("http://example.com/feed", validators)
+
+    assert response is mock_get.return_value
+    mock_get.assert_called_once_with("http://example.com/feed", timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), headers={
+        "If-None-Match": '"abc"',
+        "If-Modified-Since": "Tue, 03 Dec 2024 13:42:00 GMT"})
+    assert validators["etag"] == '"def"'
+    assert validators["last_modified"] == "Tue, 03 Dec 2024 13:43:00 GMT"
+    assert FETCH_STATS["cache_hits"] == 0
+    assert FETCH_STATS["cache_misses"] == 1
+
+
+@patch('extract.SESSION.get')
+def test_fetch_feed_ignores_validators_for_other_feed(mock_get):
+    """Test fetch_feed only reuses validators stored for the same URL"""
+    mock_get.return_value.status_code = 200
+    mock_get.return_value.headers = {}
+
+    fetch_feed("http://example.com/all_day",
+               {"feed_url": "http://example.com/all_hour", "etag": '"abc"'})
+
+    mock_get.assert_called_once_with(
+        "http://example.com/all_day", timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), headers={})
+
+
+@patch('extract.SESSION.get')
+def test_get_data_not_modified(mock_get):
+    """Test get_data skips parsing when the feed has not changed"""
+    reset_fetch_stats()
+    mock_get.return_value.status_code = 304
+    since = (datetime.now() - timedelta(minutes=1)).timestamp() * 1000
+    validators = {"all_hour": {"feed_url": select_feed(since), "etag": '"abc"'}}
+
+    result = get_data(since, validators)
+
+    assert result is None
+    mock_get.return_value.json.assert_not_called()
+    assert mock_get.call_args.kwargs["headers"] == {"If-None-Match": '"abc"'}
+    assert validators["all_hour"]["etag"] == '"abc"'
+    assert FETCH_STATS["cache_hits"] == 1
+    assert FETCH_STATS["cache_misses"] == 0
+
+
+@patch('extract.time.sleep')
+@patch('extract.SESSION.get')
+def test_request_with_retry_recovers(mock_get, mock_sleep):
+    """Test request_with_retry retries timeouts and retryable statuses"""
+    reset_fetch_stats()
+    unavailable = MagicMock(status_code=503)
+    ok = MagicMock(status_code=200)
+    mock_get.side_effect = [requests.exceptions.ConnectTimeout("timed out"),
+                            unavailable, ok]
+
+    response = request_with_retry("http://example.com/feed")
+
+    assert response is ok
+    assert mock_get.call_count == 3
+    assert mock_sleep.call_count == 2
+    unavailable.close.assert_called_once()
+    assert [attempt["status"] for attempt in FETCH_STATS["attempts"]] == [
+        "ConnectTimeout", 503, 200]
+    assert all(attempt["latency_ms"] >= 0 for attempt in FETCH_STATS["attempts"])
+
+
+@patch('extract.time.sleep')
+@patch('extract.SESSION.get')
+def test_request_with_retry_gives_up(mock_get, mock_sleep):
+    """Test request_with_retry re-raises once attempts run out"""
+    mock_get.side_effect = requests.exceptions.ConnectionError("refused")
+
+    with pytest.raises(requests.exceptions.ConnectionError):
+        request_with_retry("http://example.com/feed")
+
+    assert mock_get.call_count == MAX_ATTEMPTS
+    assert mock_sleep.call_count == MAX_ATTEMPTS - 1
+
+
+@patch('extract.time.sleep')
+@patch('extract.SESSION.get')
+def test_request_with_retry_returns_last_error_status(mock_get, mock_sleep):
+    """Test request_with_retry hands back the final retryable response"""
+    mock_get.return_value = MagicMock(status_code=502)
+
+    response = request_with_retry("http://example.com/feed")
+
+    assert response.status_code == 502
+    assert mock_get.call_count == MAX_ATTEMPTS
+
+
+def test_get_backoff_is_bounded():
+    """Test get_backoff stays within the jitter window"""
+    for attempt in range(1, 10):
+        assert 0 <= get_backoff(attempt) <= BACKOFF_CAP
@@ -3,8 +3,27 @@
 import pytest
 import datetime
 from unittest.mock import MagicMock, patch
+import os
+import threading
+from decimal import Decimal
 from psycopg2.extensions import connection, cursor
 from load import *
+from db import get_connection, reset_db_stats, CONNECTION
+from batch import EarthquakeBatch
+from quarantine import PENDING, reset_quarantine
+
+
+@pytest.fixture(autouse=True)
+def empty_quarantine():
+    """Fixture that empties the quarantine buffer, dimension cache and cached connection around each test."""
+    reset_quarantine()
+    reset_dimension_cache()
+    reset_db_stats()
+    CONNECTION["conn"] = None
+    yield
+    reset_quarantine()
+    reset_dimension_cache()
+    CONNECTION["conn"] = None
 
 
 @pytest.fixture
@@ -23,8 +42,8 @@ def mock_cursor():
 
 @pytest.fixture
 def valid_earthquake_list():
-    """Fixture for valid dict list"""
-    return [{
+    """Fixture for valid batch"""
+    return EarthquakeBatch.from_records([{
         'at': datetime.datetime(2024, 12, 3, 13, 42, 51),
         'event_url': 'https:example.com',
         'felt': 0,
@@ -55,7 +74,15 @@ def valid_earthquake_list():
         'longitude': -117.5245,
         'latitude': 35.7038,
         'depth': 20.1
-    }]
+    }])
+
+
+@pytest.fixture
+def dimension_rows():
+    """Fixture for the rows of the alerts, magnitude_types and networks tables"""
+    return [[{"alert_id": 1, "alert_type": "green"}, {"alert_id": 2, "alert_type": "yellow"}],
+            [{"magnitude_id": 1, "magnitude_type": "md"}, {"magnitude_id": 2, "magnitude_type": "ml"}],
+            [{"network_id": 4, "network_name": "hv"}, {"network_id": 3, "network_name": "ci"}]]
 
 
 @pytest.fixture
@@ -66,121 +93,150 @@ def valid_query():
             (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"""
 
 
-def test_get_foreign_key_valid(mock_cursor):
-    """Test get_foreign_key with valid data."""
-    mock_cursor.fetchone.return_value = {'id': 1}
-    result = get_foreign_key(mock_cursor, "alerts", "alert_type", "green")
-    assert result == 1
-    mock_cursor.execute.assert_called_once_with(
-        "SELECT * FROM alerts WHERE alert_type = 'green'"
-    )
+def test_insert_into_earthquake_valid(mock_connection, mock_cursor, valid_earthquake_list, dimension_rows):
+    """Test insert_into_earthquake with valid data"""
+    mock_cursor.fetchall.side_effect = dimension_rows
 
+    insert_into_earthquake(mock_connection, mock_cursor, valid_earthquake_list)
 
-def test_get_foreign_key_invalid(mock_cursor):
-    """Test get_foreign_key with invalid data."""
-    mock_cursor.fetchone.return_value = None
-    with pytest.raises(ValueError):
-        get_foreign_key(mock_cursor, "alerts", "alert_type", "invalid")
-    mock_cursor.execute.assert_called_once_with(
-        "SELECT * FROM alerts WHERE alert_type = 'invalid'"
-    )
+    assert mock_cursor.fetchall.call_count == 3
+    query, rows = mock_cursor.executemany.call_args[0]
+    assert query.startswith("INSERT INTO earthquake_staging")
+    assert [row[7:10] for row in rows] == [(1, 1, 4), (2, 2, 3)]
+    assert [row[12:] for row in rows] == [(None, 0), (None, 0)]
+    mock_connection.commit.assert_called_once()
 
 
-def test_insert_into_earthquake_valid(mock_connection, mock_cursor, valid_earthquake_list):
-    """Test insert_into_earthquake with valid data"""
-    mock_cursor.fetchone.side_effect = [
-        {"id": 1},
-        {"id": 2},
-        {"id": 3},
-        {"id": 4},
-        {"id": 5},
-        {"id": 6},
-    ]
+def test_insert_into_earthquake_upserts_through_staging(mock_connection, mock_cursor, valid_earthquake_list, dimension_rows):
+    """Test rows are staged and then upserted on the event id, keeping only newer revisions"""
+    mock_cursor.fetchall.side_effect = dimension_rows
 
     insert_into_earthquake(mock_connection, mock_cursor, valid_earthquake_list)
 
-    assert mock_cursor.fetchone.call_count == 6
+    create_query, mark_query, upsert_query, refresh_query = [call[0][0] for call in mock_cursor.execute.call_args_list[3:]]
+    assert "CREATE TEMP TABLE IF NOT EXISTS earthquake_staging" in create_query
+    assert "INSERT INTO rollup_hours" in mark_query
+    assert "earthquake_rollups_hourly" in refresh_query and "earthquake_rollups_daily" in refresh_query
+    assert refresh_query.startswith(f"SELECT pg_advisory_xact_lock({ROLLUP_LOCK_KEY})")
+    assert "DELETE FROM earthquake_staging" in upsert_query
+    assert "DISTINCT ON (event_id)" in upsert_query
+    assert "ON CONFLICT (event_id) DO UPDATE" in upsert_query
+    assert "earthquakes.updated < EXCLUDED.updated" in upsert_query
 
-    mock_connection.commit.assert_called_once()
 
+def test_insert_into_earthquake_uses_cached_dimensions(mock_connection, mock_cursor, valid_earthquake_list, dimension_rows):
+    """Test the lookup tables are read once, not once per record or per batch"""
+    mock_cursor.fetchall.side_effect = dimension_rows
 
-def test_insert_into_earthquake_empty_data(mock_connection, mock_cursor):
-    """Test insert_into_earthquake with empty data"""
-    insert_into_earthquake(mock_connection, mock_cursor, [])
-    mock_cursor.fetchone.assert_not_called()
-    mock_connection.commit.assert_not_called()
+    insert_into_earthquake(mock_connection, mock_cursor, valid_earthquake_list)
+    insert_into_earthquake(mock_connection, mock_cursor, valid_earthquake_list)
 
+    assert mock_cursor.fetchall.call_count == 3
+    assert mock_cursor.executemany.call_count == 2
 
-@patch('psycopg2.connect')
-def test_get_connection_success(mock_connect):
-    """Test get_connection with a successful connection."""
 
-    mock_conn = MagicMock()
-    mock_connect.return_value = mock_conn
+def test_get_dimension_keys_reloads_on_miss(mock_cursor, dimension_rows):
+    """Test a value missing from the cache reloads the table once"""
+    mock_cursor.fetchall.side_effect = [dimension_rows[0],
+                                        dimension_rows[0] + [{"alert_id": 3, "alert_type": "orange"}]]
+
+    assert get_dimension_keys(mock_cursor, "alert", {"green"}) == {"green": 1, "yellow": 2}
+    assert get_dimension_keys(mock_cursor, "alert", {"green", "orange"})["orange"] == 3
+    assert get_dimension_keys(mock_cursor, "alert", {"orange"})["orange"] == 3
+    assert mock_cursor.execute.call_count == 2
+    mock_cursor.execute.assert_called_with("SELECT alert_id, alert_type FROM alerts")
 
-    conn = get_connection()
 
-    assert conn == mock_conn
+def test_get_dimension_keys_does_not_reload_twice(mock_cursor, dimension_rows):
+    """Test an unknown alert level on a cold cache costs a single query"""
+    mock_cursor.fetchall.side_effect = [dimension_rows[0]]
 
-    mock_connect.assert_called_once_with(
-        dbname=os.getenv("DB_NAME"),
-        user=os.getenv("DB_USER"),
-        password=os.getenv("DB_PASSWORD"),
-        host=os.getenv("DB_HOST"),
-        port=os.getenv("DB_PORT")
-    )
+    assert "purple" not in get_dimension_keys(mock_cursor, "alert", {"purple"})
+    assert mock_cursor.execute.call_count == 1
 
 
-@patch('psycopg2.connect')
-def test_get_connection_db_error(mock_connect):
-    """Test get_connection with a database error (OperationalError)."""
+def test_get_dimension_keys_creates_missing_values(mock_cursor, dimension_rows):
+    """Test unknown networks are inserted and reloaded with one statement"""
+    mock_cursor.fetchall.side_effect = [dimension_rows[2],
+                                        dimension_rows[2] + [{"network_id": 17, "network_name": "ok"}]]
 
-    mock_connect.side_effect = psycopg2.OperationalError("Connection error")
+    get_dimension_keys(mock_cursor, "network", {"hv"})
+    keys = get_dimension_keys(mock_cursor, "network", {"hv", "ok", None, "x" * 30})
 
-    with pytest.raises(psycopg2.OperationalError):
-        get_connection()
+    assert keys["ok"] == 17
+    assert mock_cursor.execute.call_count == 2
+    query, params = mock_cursor.execute.call_args[0]
+    assert "INSERT INTO networks (network_name)" in query
+    assert "ON CONFLICT (network_name)" in query
+    assert params == (["ok"],)
+    assert get_dimension_keys(mock_cursor, "network", {"ok"})["ok"] == 17
+    assert mock_cursor.execute.call_count == 2
 
 
-@patch('psycopg2.connect')
-def test_get_connection_missing_env(mock_connect):
-    """Test get_connection with missing environment variables."""
+def test_get_dimension_keys_remembers_absent_values(mock_cursor, dimension_rows):
+    """Test values that cannot be created reload the table once, not on every batch"""
+    mock_cursor.fetchall.side_effect = [dimension_rows[0], dimension_rows[0],
+                                        dimension_rows[2], dimension_rows[2]]
 
-    mock_connect.side_effect = KeyError('DB_NAME')
+    get_dimension_keys(mock_cursor, "alert", {"green"})
+    for _ in range(3):
+        assert "purple" not in get_dimension_keys(mock_cursor, "alert", {"green", "purple"})
+    assert mock_cursor.execute.call_count == 2
 
-    with pytest.raises(KeyError):
-        get_connection()
+    get_dimension_keys(mock_cursor, "network", {"hv"})
+    for _ in range(3):
+        keys = get_dimension_keys(mock_cursor, "network", {"hv", None, float("nan"), "x" * 30})
+        assert keys == {"hv": 4, "ci": 3}
+    assert mock_cursor.execute.call_count == 4
 
 
-@patch('load.logging.error')
-def test_get_cursor_creation_error(mock_connection):
-    """Test get_cursor when cursor creation fails"""
-    mock_connection.cursor.side_effect = Exception("Cursor creation failed")
+@patch('load.time.monotonic')
+def test_get_dimension_keys_forgets_absent_values_after_ttl(mock_monotonic, mock_cursor, dimension_rows):
+    """Test a value remembered as absent is looked up again once the cache expires"""
+    mock_cursor.fetchall.side_effect = [dimension_rows[0],
+                                        dimension_rows[0] + [{"alert_id": 3, "alert_type": "orange"}]]
+    mock_monotonic.side_effect = [0, 10, DIMENSION_TTL + 1, DIMENSION_TTL + 1]
 
-    with pytest.raises(Exception):
-        get_cursor(mock_connection)
+    assert "orange" not in get_dimension_keys(mock_cursor, "alert", {"orange"})
+    assert "orange" not in get_dimension_keys(mock_cursor, "alert", {"orange"})
+    assert get_dimension_keys(mock_cursor, "alert", {"orange"})["orange"] == 3
+    assert mock_cursor.execute.call_count == 2
+
+
+@patch('load.time.monotonic')
+def test_get_dimension_keys_reloads_after_ttl(mock_monotonic, mock_cursor, dimension_rows):
+    """Test the cache is reloaded once it is older than DIMENSION_TTL"""
+    mock_cursor.fetchall.side_effect = [dimension_rows[0], dimension_rows[0]]
+    mock_monotonic.side_effect = [0, 10, DIMENSION_TTL + 1, DIMENSION_TTL + 1]
+
+    get_dimension_keys(mock_cursor, "alert", {"green"})
+    get_dimension_keys(mock_cursor, "alert", {"green"})
+    assert mock_cursor.execute.call_count == 1
+
+    get_dimension_keys(mock_cursor, "alert", {"green"})
+    assert mock_cursor.execute.call_count == 2
+
+
+def test_insert_into_earthquake_empty_data(mock_connection, mock_cursor):
+    """Test insert_into_earthquake with empty data"""
+    insert_into_earthquake(mock_connection, mock_cursor,
+                           EarthquakeBatch.from_records([]))
+    mock_cursor.execute.assert_not_called()
+    mock_connection.commit.assert_not_called()
 
 
 @patch('load.logging.warning')
-def test_insert_into_earthquake_no_valid_data(mock_warning, mock_connection, mock_cursor, valid_earthquake_list):
+def test_insert_into_earthquake_no_valid_data(mock_warning, mock_connection, mock_cursor, valid_earthquake_list, dimension_rows):
     """Test insert_into_earthquake when no valid records exist"""
-    mock_cursor.fetchone.side_effect = [None, None]
+    mock_cursor.fetchall.side_effect = [[], dimension_rows[1], dimension_rows[2]]
     insert_into_earthquake(mock_connection, mock_cursor, valid_earthquake_list)
     mock_warning.assert_called_once_with("No valid records to insert.")
 
 
-def test_insert_into_earthquake_db_error(mock_connection, mock_cursor, valid_earthquake_list):
+def test_insert_into_earthquake_db_error(mock_connection, mock_cursor, valid_earthquake_list, dimension_rows):
     """Test insert_into_earthquake when DB insertion fails"""
 
-    mock_cursor.fetchone.side_effect = [
-        {"id": 1},
-        {"id": 2},
-        {"id": 3},
-        {"id": 4},
-        {"id": 5},
-        {"id": 6},
-        {"id": 7},
-        {"id": 8}
-    ]
+    mock_cursor.fetchall.side_effect = dimension_rows
 
     mock_cursor.executemany.side_effect = psycopg2.Error("DB error")
 
@@ -189,18 +245,288 @@ def test_insert_into_earthquake_db_error(mock_connection, mock_cursor, valid_ear
             mock_connection, mock_cursor, valid_earthquake_list)
 
 
-def test_get_foreign_key_psycopg2_error(mock_cursor):
-    """Test get_foreign_key when a psycopg2 error occurs."""
+def test_get_watermark(mock_cursor):
+    """Test get_watermark returns the stored value"""
+    mock_cursor.fetchone.return_value = {"high_water_mark": 1733233371530}
+
+    assert get_watermark(mock_cursor, "usgs_summary") == 1733233371530
+    mock_cursor.execute.assert_called_once_with(
+        "SELECT high_water_mark FROM feed_state WHERE feed_name = %s", ("usgs_summary",))
+
+
+def test_get_watermark_missing(mock_cursor):
+    """Test get_watermark when nothing has been ingested yet"""
+    mock_cursor.fetchone.return_value = None
+
+    assert get_watermark(mock_cursor, "usgs_summary") is None
+
+
+def test_set_watermark(mock_connection, mock_cursor):
+    """Test set_watermark upserts and commits"""
+    set_watermark(mock_connection, mock_cursor, "usgs_summary", 1733233371530)
+
+    query, params = mock_cursor.execute.call_args[0]
+    assert "GREATEST" in query
+    assert params == ("usgs_summary", 1733233371530)
+    mock_connection.commit.assert_called_once()
+
+
+@patch('load.insert_into_earthquake')
+@patch('load.get_shared_connection')
+def test_load_data_advances_watermark(mock_get_connection, mock_insert, mock_connection, valid_earthquake_list):
+    """Test load_data stores the watermark after inserting"""
+    load_data(valid_earthquake_list, "usgs_summary",
+              1733233371530, mock_connection)
 
-    mock_cursor.execute.side_effect = psycopg2.Error("DB error")
+    mock_get_connection.assert_not_called()
+    mock_insert.assert_called_once()
+    mock_connection.commit.assert_called_once()
+
+
+def test_get_feed_validators(mock_cursor):
+    """Test get_feed_validators returns the stored headers of each feed"""
+    mock_cursor.fetchall.return_value = [{"feed_name": "all_hour",
+                                          "feed_url": "http://example.com/feed",
+                                          "etag": '"abc"',
+                                          "last_modified": None}]
+
+    assert get_feed_validators(mock_cursor, ("all_hour", "significant_hour")) == {
+        "all_hour": {"feed_url": "http://example.com/feed", "etag": '"abc"', "last_modified": None}}
+    assert mock_cursor.execute.call_args[0][1] == (["all_hour", "significant_hour"],)
+
+
+def test_get_feed_validators_missing(mock_cursor):
+    """Test get_feed_validators when nothing has been fetched yet"""
+    mock_cursor.fetchall.return_value = []
+
+    assert get_feed_validators(mock_cursor, ("all_hour",)) == {}
+
+
+def test_set_feed_validators(mock_connection, mock_cursor):
+    """Test set_feed_validators upserts every feed and commits"""
+    set_feed_validators(mock_connection, mock_cursor,
+                        {"all_hour": {"feed_url": "http://example.com/feed", "etag": '"abc"'},
+                         "significant_hour": {}})
+
+    _, params = mock_cursor.executemany.call_args[0]
+    assert params == [("all_hour", "http://example.com/feed", '"abc"', None),
+                      ("significant_hour", None, None, None)]
+    mock_connection.commit.assert_called_once()
+
+
+def test_insert_into_earthquake_quarantines_missing_foreign_keys(mock_connection, mock_cursor, valid_earthquake_list, dimension_rows):
+    """Test rows whose foreign keys are missing are quarantined rather than dropped"""
+    mock_cursor.fetchall.side_effect = [dimension_rows[0][:1], dimension_rows[1], dimension_rows[2]]
+
+    insert_into_earthquake(mock_connection, mock_cursor, valid_earthquake_list)
+
+    assert len(mock_cursor.executemany.call_args[0][1]) == 1
+    rejected, reasons, stage = PENDING[0]
+    assert rejected["network"].tolist() == ["ci"]
+    assert reasons == ["foreign_key: alert 'yellow' not in alerts"]
+    assert stage == "load"
+
+
+@patch('load.flush_quarantine')
+@patch('load.insert_into_earthquake')
+def test_load_data_flushes_quarantine(mock_insert, mock_flush, mock_connection, valid_earthquake_list):
+    """Test load_data writes the quarantined rows once, after the insert"""
+    load_data(valid_earthquake_list, conn=mock_connection)
+
+    mock_flush.assert_called_once_with(mock_connection.cursor.return_value)
+
+
+def test_insert_into_earthquake_keeps_new_networks(mock_connection, mock_cursor, valid_earthquake_list, dimension_rows):
+    """Test an event from a network missing from the seed list is inserted, not skipped"""
+    mock_cursor.fetchall.side_effect = [dimension_rows[0], dimension_rows[1], dimension_rows[2][:1],
+                                        dimension_rows[2][:1] + [{"network_id": 17, "network_name": "ci"}]]
+
+    insert_into_earthquake(mock_connection, mock_cursor, valid_earthquake_list)
+
+    rows = mock_cursor.executemany.call_args[0][1]
+    assert [row[9] for row in rows] == [4, 17]
+    assert PENDING == []
+    assert mock_cursor.fetchall.call_count == 4
+
+
+def test_insert_into_earthquake_db_error_forgets_created_values(mock_connection, mock_cursor, valid_earthquake_list, dimension_rows):
+    """Test a failed insert drops the cache, as values created for the batch are rolled back"""
+    mock_cursor.fetchall.side_effect = dimension_rows
+    mock_cursor.executemany.side_effect = psycopg2.Error("DB error")
 
     with pytest.raises(psycopg2.Error):
-        get_foreign_key(mock_cursor, "mock_table", "mock_column", "mock_value")
+        insert_into_earthquake(mock_connection, mock_cursor, valid_earthquake_list)
 
+    assert DIMENSION_CACHE == {}
 
-def test_get_foreign_key_unexpected_error(mock_cursor):
-    """Test get_foreign_key when an unexpected error occurs."""
-    mock_cursor.execute.side_effect = Exception("Unexpected error")
 
-    with pytest.raises(Exception):
-        get_foreign_key(mock_cursor, "mock_table", "mock_column", "mock_value")
+def test_to_copy_field():
+    """Test values are written in COPY's text format"""
+    assert to_copy_field(None) == "\\N"
+    assert to_copy_field(1.79) == "1.79"
+    assert to_copy_field(datetime.datetime(2024, 12, 3, 13, 42, 51)) == "2024-12-03 13:42:51"
+    assert to_copy_field("a\tb\nc\\d") == "a\\tb\\nc\\\\d"
+
+
+def test_insert_into_earthquake_copies_large_batches(mock_connection, mock_cursor, valid_earthquake_list, dimension_rows, monkeypatch):
+    """Test batches of COPY_MIN_ROWS or more are streamed through COPY instead of executemany"""
+    monkeypatch.setattr("load.COPY_MIN_ROWS", 2)
+    mock_cursor.fetchall.side_effect = dimension_rows
+
+    insert_into_earthquake(mock_connection, mock_cursor, valid_earthquake_list)
+
+    mock_cursor.executemany.assert_not_called()
+    query, buffer = mock_cursor.copy_expert.call_args[0]
+    assert query == ("COPY earthquake_staging (time, felt_report_count, magnitude, cdi, latitude, longitude, "
+                     "detail_url, alert_id, magnitude_id, network_id, depth, place, event_id, updated) FROM STDIN")
+    lines = buffer.getvalue().splitlines()
+    assert lines[0] == "\t".join(["2024-12-03 13:42:51", "0", "1.79", "2.0", "19.38", "-155.28",
+                                  "https:example.com", "1", "1", "4", "20.1", "8 km SW of Volcano, Hawaii",
+                                  "\\N", "0"])
+    assert len(lines) == 2
+    mock_connection.commit.assert_called_once()
+
+
+@pytest.mark.skipif(not os.getenv("DB_HOST"), reason="needs a Postgres database with schema.sql applied")
+def test_upsert_earthquakes_is_idempotent():
+    """Test replaying rows keeps one row per event and only newer revisions replace it"""
+    conn = get_connection()
+    db_cursor = get_cursor(conn)
+    try:
+        keys = {column: get_dimension_keys(db_cursor, column, {value})[value]
+                for column, value in (("alert", "green"), ("magnitude_type", "md"), ("network", "hv"))}
+        row = (datetime.datetime(2024, 12, 3, 13, 42, 51), 0, 1.79, 0.0, 19.38, -155.28, "https://example.com",
+               keys["alert"], keys["magnitude_type"], keys["network"], 13.05, "Somewhere", "test_upsert_1", 1000)
+        revised = row[:2] + (2.5,) + row[3:13] + (2000,)
+
+        upsert_earthquakes(db_cursor, [row, row])
+        upsert_earthquakes(db_cursor, [revised])
+        upsert_earthquakes(db_cursor, [row])
+
+        db_cursor.execute("SELECT magnitude, updated FROM earthquakes WHERE event_id = %s", ("test_upsert_1",))
+        assert db_cursor.fetchall() == [{"magnitude": Decimal("2.5"), "updated": 2000}]
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+@pytest.mark.skipif(not os.getenv("DB_HOST"), reason="needs a Postgres database with schema.sql applied")
+def test_upsert_earthquakes_refreshes_rollups():
+    """Test a revised event moves between hours in the rollups and the change log, and the rollups match the earthquakes"""
+    conn = get_connection()
+    db_cursor = get_cursor(conn)
+    try:
+        keys = {column: get_dimension_keys(db_cursor, column, {value})[value]
+                for column, value in (("alert", "green"), ("magnitude_type", "md"), ("network", "hv"))}
+        row = (datetime.datetime(2024, 12, 3, 13, 42, 51, tzinfo=datetime.timezone.utc), 0, 1.79, 0.0, 19.38, -155.28,
+               "https://example.com", keys["alert"], keys["magnitude_type"], keys["network"], 13.05, "Somewhere",
+               "test_rollup_1", 1000)
+        moved = (row[0] + datetime.timedelta(hours=1),) + row[1:13] + (2000,)
+
+        upsert_earthquakes(db_cursor, [row])
+        upsert_earthquakes(db_cursor, [moved])
+
+        for hour in (row[0].replace(minute=0, second=0), moved[0].replace(minute=0, second=0)):
+            db_cursor.execute("""SELECT count(*) AS earthquake_count, max(magnitude) AS max_magnitude FROM earthquakes
+                                 WHERE time >= %s AND time < %s + interval '1 hour'""", (hour, hour))
+            expected = db_cursor.fetchone()
+            db_cursor.execute("""SELECT earthquake_count, max_magnitude FROM earthquake_rollups_hourly
+                                 WHERE hour = %s AND dimension = 'all'""", (hour,))
+            assert (db_cursor.fetchone() or {"earthquake_count": 0, "max_magnitude": None}) == expected
+        db_cursor.execute("SELECT hour FROM earthquake_changes ORDER BY change_id DESC LIMIT 2")
+        assert {row["hour"] for row in db_cursor.fetchall()} == {row[0].replace(minute=0, second=0),
+                                                                 moved[0].replace(minute=0, second=0)}
+        db_cursor.execute("""SELECT d.earthquake_count = sum(h.earthquake_count) AS matches
+                             FROM earthquake_rollups_daily d JOIN earthquake_rollups_hourly h
+                             ON h.hour >= d.day AND h.hour < d.day + interval '24 hours' AND h.dimension = d.dimension
+                             AND h.dimension_value = d.dimension_value
+                             WHERE d.day = '2024-12-03 00:00+00' AND d.dimension = 'all' GROUP BY d.earthquake_count""")
+        assert db_cursor.fetchone()["matches"]
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+def make_rollup_row(keys: dict, event_id: str, minute: int) -> tuple:
+    """Builds an earthquakes row in a quiet hour of 2001, away from any real data"""
+    return (datetime.datetime(2001, 1, 1, 5, minute, tzinfo=datetime.timezone.utc), 0, 2.0, 0.0, 19.38, -155.28,
+            "https://example.com", keys["alert"], keys["magnitude_type"], keys["network"], 13.05, "Somewhere",
+            event_id, 1000)
+
+
+def get_rollup_keys(db_cursor: cursor) -> dict:
+    """Looks up the foreign keys of the rows built by make_rollup_row"""
+    return {column: get_dimension_keys(db_cursor, column, {value})[value]
+            for column, value in (("alert", "green"), ("magnitude_type", "md"), ("network", "hv"))}
+
+
+@pytest.mark.skipif(not os.getenv("DB_HOST"), reason="needs a Postgres database with schema.sql applied")
+def test_refresh_rollups_twice_over_the_same_hour():
+    """Test a second batch in the same hour replaces that hour's rollups instead of colliding with them"""
+    conn = get_connection()
+    db_cursor = get_cursor(conn)
+    try:
+        keys = get_rollup_keys(db_cursor)
+        upsert_earthquakes(db_cursor, [make_rollup_row(keys, "test_rollup_twice_1", 10)])
+        upsert_earthquakes(db_cursor, [make_rollup_row(keys, "test_rollup_twice_2", 20)])
+
+        db_cursor.execute("""SELECT earthquake_count FROM earthquake_rollups_hourly
+                             WHERE hour = '2001-01-01 05:00+00' AND dimension = 'all'""")
+        assert db_cursor.fetchone()["earthquake_count"] == 2
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+@pytest.mark.skipif(not os.getenv("DB_HOST"), reason="needs a Postgres database with schema.sql applied")
+def test_overlapping_loads_refresh_rollups_in_turn():
+    """Test a load refreshing an hour another open load has refreshed waits for it, then counts both batches"""
+    first_conn, second_conn = get_connection(), get_connection()
+    first_cursor, second_cursor = get_cursor(first_conn), get_cursor(second_conn)
+    errors = []
+
+    def second_load():
+        try:
+            upsert_earthquakes(second_cursor, [make_rollup_row(keys, "test_rollup_overlap_2", 20)])
+            second_conn.commit()
+        except Exception as e:
+            errors.append(e)
+
+    try:
+        keys = get_rollup_keys(first_cursor)
+        first_conn.commit()
+        upsert_earthquakes(first_cursor, [make_rollup_row(keys, "test_rollup_overlap_1", 10)])
+        second = threading.Thread(target=second_load)
+        second.start()
+        second.join(timeout=1)
+        assert second.is_alive()
+        first_conn.commit()
+        second.join(timeout=30)
+
+        assert errors == []
+        first_cursor.execute("""SELECT earthquake_count FROM earthquake_rollups_hourly
+                                WHERE hour = '2001-01-01 05:00+00' AND dimension = 'all'""")
+        assert first_cursor.fetchone()["earthquake_count"] == 2
+    finally:
+        first_conn.rollback()
+        second_conn.rollback()
+        first_cursor.execute("DELETE FROM earthquakes WHERE event_id LIKE 'test_rollup_overlap_%'")
+        first_cursor.execute(f"CREATE TEMP TABLE IF NOT EXISTS {ROLLUP_HOURS_TABLE} (hour TIMESTAMPTZ PRIMARY KEY)")
+        first_cursor.execute(f"INSERT INTO {ROLLUP_HOURS_TABLE} VALUES ('2001-01-01 05:00+00')")
+        first_cursor.execute(REFRESH_ROLLUPS_QUERY)
+        first_conn.commit()
+        first_conn.close()
+        second_conn.close()
+
+
+@patch('load.insert_into_earthquake')
+def test_load_data_rolls_back_batch_when_watermark_fails(mock_insert, mock_connection, valid_earthquake_list):
+    """Test the earthquakes and watermark of a batch are committed together or not at all"""
+    mock_connection.cursor.return_value.execute.side_effect = psycopg2.Error("DB error")
+
+    with pytest.raises(psycopg2.Error):
+        load_data(valid_earthquake_list, "usgs_summary", 1733233371530, mock_connection)
+
+    mock_insert.assert_called_once()
+    mock_connection.commit.assert_not_called()
+    mock_connection.rollback.assert_called_once()
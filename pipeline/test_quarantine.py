@@ -0,0 +1,114 @@
+# pylint: skip-file
+
+import pytest
+import json
+from datetime import datetime
+from unittest.mock import MagicMock, patch
+from quarantine import *
+from batch import EarthquakeBatch
+
+
+@pytest.fixture(autouse=True)
+def empty_quarantine():
+    """Fixture that empties the quarantine buffer around each test."""
+    reset_quarantine()
+    yield
+    reset_quarantine()
+
+
+@pytest.fixture
+def rejected_batch():
+    """Fixture for a batch of two rejected rows"""
+    return EarthquakeBatch.from_records([
+        {'at': datetime(2024, 12, 3, 13, 42, 51), 'latitude': 119.38, 'felt': None,
+         'magnitude': 1.79, 'event_id': 'hv1'},
+        {'at': datetime(2024, 12, 3, 14, 0, 0), 'latitude': 19.38, 'felt': 2,
+         'magnitude': None, 'event_id': 'hv2'},
+    ])
+
+
+def test_quarantine_requires_a_reason_per_row(rejected_batch):
+    """Test quarantine rejects mismatched reasons"""
+    with pytest.raises(ValueError):
+        quarantine(rejected_batch, ["latitude"], "validate")
+
+
+def test_quarantine_ignores_empty_batches():
+    """Test an empty batch is not buffered"""
+    quarantine(EarthquakeBatch.from_records([]), [], "validate")
+
+    assert PENDING == []
+
+
+def test_quarantine_truncates_long_reasons(rejected_batch):
+    """Test reasons are cut to the width of the reasons column"""
+    quarantine(rejected_batch, ["load: " + "x" * 1000, "latitude"], "load")
+
+    assert [len(reason) for reason in PENDING[0][1]] == [MAX_REASON_LENGTH, len("latitude")]
+
+
+def test_get_pending_is_json_ready(rejected_batch):
+    """Test buffered rows become JSON entries, with NaN as null and datetimes as strings"""
+    quarantine(rejected_batch, ["latitude", "magnitude"], "validate")
+
+    entries = get_pending()
+
+    assert [entry["reasons"] for entry in entries] == ["latitude", "magnitude"]
+    assert entries[0]["stage"] == "validate"
+    assert entries[0]["record"]["at"] == "2024-12-03 13:42:51"
+    assert entries[0]["record"]["felt"] is None
+    assert entries[1]["record"]["magnitude"] is None
+    json.dumps(entries, allow_nan=False)
+
+
+@patch('quarantine.execute_values')
+def test_flush_quarantine_table(mock_execute_values, rejected_batch, monkeypatch):
+    """Test flushing writes every buffered row with one statement and empties the buffer"""
+    monkeypatch.delenv("QUARANTINE_FILE", raising=False)
+    cur = MagicMock()
+    quarantine(rejected_batch.filter([0]), ["latitude"], "validate")
+    quarantine(rejected_batch.filter([1]), ["foreign_key: Invalid Data!"], "load")
+
+    assert flush_quarantine(cur) == 2
+
+    mock_execute_values.assert_called_once()
+    query, rows = mock_execute_values.call_args[0][1:]
+    assert "rejected_earthquakes" in query
+    assert [(stage, reasons) for stage, reasons, _ in rows] == [
+        ("validate", "latitude"), ("load", "foreign_key: Invalid Data!")]
+    assert mock_execute_values.call_args[1]["page_size"] == 2
+    assert PENDING == []
+
+
+def test_flush_quarantine_file(rejected_batch, monkeypatch, tmp_path):
+    """Test flushing to a newline-delimited JSON file appends one line per row"""
+    path = tmp_path / "rejected.ndjson"
+    monkeypatch.setenv("QUARANTINE_FILE", str(path))
+    quarantine(rejected_batch, ["latitude", "magnitude"], "validate")
+    flush_quarantine()
+    quarantine(rejected_batch.filter([0]), ["latitude"], "validate")
+    flush_quarantine()
+
+    entries = read_quarantine_file(str(path))
+
+    assert [entry["record"]["event_id"] for entry in entries] == ["hv1", "hv2", "hv1"]
+    assert all("rejected_at" in entry for entry in entries)
+
+
+def test_flush_quarantine_nothing_pending():
+    """Test flushing an empty buffer does not touch the database"""
+    cur = MagicMock()
+
+    assert flush_quarantine(cur) == 0
+    cur.execute.assert_not_called()
+
+
+def test_read_quarantine_table():
+    """Test only rows that have not been replayed are read"""
+    cur = MagicMock()
+    cur.fetchall.return_value = [{"rejected_id": 3, "record": {"event_id": "hv1"}}]
+
+    assert read_quarantine_table(cur, 100) == [(3, {"event_id": "hv1"})]
+    query, params = cur.execute.call_args[0]
+    assert "replayed_at IS NULL" in query
+    assert params == (100,)
@@ -0,0 +1,67 @@
+# pylint: skip-file
+
+import pytest
+import json
+from unittest.mock import MagicMock, patch
+from replay import *
+from quarantine import PENDING, read_quarantine_file
+
+
+def make_record(event_id, latitude):
+    """Builds a quarantined record as it is stored as JSON"""
+    return {'at': '2024-12-03 13:42:51', 'event_url': 'https:example.com', 'felt': None,
+            'location': 'Somewhere', 'magnitude': 1.79, 'network': 'hv', 'alert': None,
+            'magnitude_type': 'md', 'cdi': None, 'longitude': -155.28, 'latitude': latitude,
+            'depth': 13.05, 'updated': 1733233371530, 'event_id': event_id}
+
+
+@patch('replay.insert_into_earthquake')
+def test_revalidate(mock_insert):
+    """Test records passing the current rules are loaded and the rest reported by position"""
+    still_rejected = revalidate(MagicMock(), MagicMock(), [make_record("hv1", 19.38),
+                                                          make_record("hv2", 119.38),
+                                                          make_record("hv3", 20.1)])
+
+    assert still_rejected == {1: "latitude"}
+    loaded = mock_insert.call_args[0][2]
+    assert loaded["event_id"].tolist() == ["hv1", "hv3"]
+    assert PENDING == []
+
+
+@patch('replay.execute_values')
+@patch('replay.insert_into_earthquake')
+def test_replay_table(mock_insert, mock_execute_values):
+    """Test replayed rows are marked and still rejected rows get their new reasons"""
+    conn, cur = MagicMock(), MagicMock()
+    cur.fetchall.return_value = [{"rejected_id": 7, "record": make_record("hv1", 19.38)},
+                                 {"rejected_id": 9, "record": make_record("hv2", 119.38)}]
+
+    assert replay_table(conn, cur, 100) == (1, 1)
+
+    query, params = cur.execute.call_args[0]
+    assert "replayed_at = NOW()" in query
+    assert params == ([7],)
+    assert mock_execute_values.call_args[0][2] == [(9, "latitude")]
+    conn.commit.assert_called_once()
+
+
+def test_replay_table_empty():
+    """Test replaying an empty quarantine does nothing"""
+    conn, cur = MagicMock(), MagicMock()
+    cur.fetchall.return_value = []
+
+    assert replay_table(conn, cur, 100) == (0, 0)
+    cur.execute.assert_called_once()
+
+
+@patch('replay.insert_into_earthquake')
+def test_replay_file(mock_insert, tmp_path):
+    """Test the quarantine file is rewritten with only the rows that are still rejected"""
+    path = tmp_path / "rejected.ndjson"
+    path.write_text("".join(json.dumps({"stage": "validate", "reasons": "latitude", "record": record}) + "\n"
+                            for record in (make_record("hv1", 19.38), make_record("hv2", 119.38))))
+
+    assert replay_file(MagicMock(), MagicMock(), str(path)) == (1, 1)
+
+    entries = read_quarantine_file(str(path))
+    assert [entry["record"]["event_id"] for entry in entries] == ["hv2"]
@@ -1,14 +1,26 @@
 # pylint: skip-file
 
 from transform import *
+from batch import EarthquakeBatch
+from quarantine import PENDING, reset_quarantine
 import pytest
 import datetime
+import time
+import numpy as np
+
+
+@pytest.fixture(autouse=True)
+def empty_quarantine():
+    """Fixture that empties the quarantine buffer around each test."""
+    reset_quarantine()
+    yield
+    reset_quarantine()
 
 
 @pytest.fixture
 def valid_earthquake_dict():
-    """Fixture for valid dict"""
-    return [{
+    """Fixture for valid batch"""
+    return EarthquakeBatch.from_records([{
         'at': datetime.datetime(2024, 12, 3, 13, 42, 51, 530000),
         'event_url': 'https:example.com',
         'felt': None,
@@ -23,13 +35,13 @@ def valid_earthquake_dict():
         'longitude': -155.28,
         'latitude': 19.38,
         'depth': 13.05
-    }]
+    }])
 
 
 @pytest.fixture
 def invalid_earthquake_dict():
-    """Fixture for invalid dict"""
-    return [{
+    """Fixture for invalid batch"""
+    return EarthquakeBatch.from_records([{
         'at': datetime.datetime(2024, 12, 3, 13, 42, 51, 530000),
         'event_url': 'https:example.com',
         'felt': 0,
@@ -44,52 +56,12 @@ def invalid_earthquake_dict():
         'longitude': -155.28,
         'latitude': 119.38,
         'depth': 99999
-    }]
-
-
-def test_is_valid_latitude():
-    """Tests for is_valid_latitude"""
-    assert is_valid_latitude(0) == True
-    assert is_valid_latitude(-18.76) == True
-    assert is_valid_latitude(999) == False
-    assert is_valid_latitude("Inavlid") == False
-
-
-def test_is_valid_longitude():
-    """Tests for is_valid_longitude"""
-    assert is_valid_longitude(180) == True
-    assert is_valid_longitude(-175.76) == True
-    assert is_valid_longitude(999) == False
-    assert is_valid_longitude("Inavlid") == False
-
-
-def test_is_valid_magnitude():
-    """Tests for is_valid_magnitude"""
-    assert is_valid_magnitude(-5.34) == True
-    assert is_valid_magnitude(12) == True
-    assert is_valid_magnitude(20) == False
-    assert is_valid_magnitude("Inavlid") == False
-
-
-def test_is_valid_cdi():
-    """Tests for is_valid_cdi"""
-    assert is_valid_cdi(3) == True
-    assert is_valid_cdi(6.78) == True
-    assert is_valid_cdi(-1) == False
-    assert is_valid_cdi("Inavlid") == False
-
-
-def test_is_valid_depth():
-    """Tests for is_valid_depth"""
-    assert is_valid_depth(3) == True
-    assert is_valid_depth(69.78) == True
-    assert is_valid_depth(-1111) == False
-    assert is_valid_depth("Inavlid") == False
+    }])
 
 
 def test_clean_data_valid(valid_earthquake_dict):
     """Tests for clean_data"""
-    result = clean_data(valid_earthquake_dict)
+    result = clean_data(valid_earthquake_dict).to_records()
 
     assert result[0]["at"] == datetime.datetime(2024, 12, 3, 13, 42, 51)
     assert result[0]["felt"] == 0
@@ -103,7 +75,7 @@ def test_clean_data_invalid(invalid_earthquake_dict):
     result = clean_data(invalid_earthquake_dict)
 
     assert len(result) == 0
-    assert result == []
+    assert result.to_records() == []
 
 
 def test_clean_data_empty_input():
@@ -112,7 +84,188 @@ def test_clean_data_empty_input():
         clean_data([])
 
 
+def test_clean_data_empty_batch():
+    """Test clean_data when given a batch with no rows"""
+    with pytest.raises(ValueError):
+        clean_data(EarthquakeBatch.from_records([]))
+
+
 def test_clean_data_invalid_input():
     """Test clean_data when given invalid input"""
     with pytest.raises(ValueError):
         clean_data("Not a list")
+
+
+def make_record(latitude, longitude, magnitude, cdi, depth):
+    """Builds a record with the given validated fields"""
+    return {'at': datetime.datetime(2024, 12, 3, 13, 42, 51), 'event_url': 'https:example.com',
+            'felt': None, 'location': 'Somewhere', 'magnitude': magnitude, 'network': 'hv',
+            'alert': None, 'magnitude_type': 'md', 'cdi': cdi, 'longitude': longitude,
+            'latitude': latitude, 'depth': depth}
+
+
+@pytest.mark.parametrize("column, values, expected", [
+    ("latitude", [0, -18.76, 90, -90, 90.1, 999, None, "Invalid", "5", float("nan")],
+     [True, True, True, True, False, False, False, False, False, False]),
+    ("longitude", [180, -175.76, -180, 180.1, -180.2, 999, None, "Invalid"],
+     [True, True, True, False, False, False, False, False]),
+    ("magnitude", [-5.34, 12, -10, 12.0001, -10.5, 20, None, "Invalid"],
+     [True, True, True, False, False, False, False, False]),
+    ("cdi", [3, 6.78, 0, 12, -1, 12.1, "Invalid"],
+     [True, True, True, True, False, False, False]),
+    ("depth", [3, 69.78, -100, 1000, -1111, 1001, float("inf"), "Invalid"],
+     [True, True, True, True, False, False, False, False]),
+])
+def test_rule_masks(column, values, expected):
+    """Test each default rule accepts in-range numbers and rejects out-of-range, missing and non-numeric values"""
+    batch = EarthquakeBatch.from_records([make_record(19.38, -155.28, 1.79, 2, 13.05) for _ in values])
+    batch[column] = np.array(values, dtype=object)
+
+    assert compile_rule(RULES[column])(batch).tolist() == expected
+
+
+def test_validate_data_rejection_counts():
+    """Test validate_data counts rejections per rule"""
+    batch = EarthquakeBatch.from_records([
+        make_record(19.38, -155.28, 1.79, 2, 13.05),
+        make_record(119.38, -155.28, None, 2, 13.05),
+        make_record(19.38, 999, 1.79, 2, 99999),
+        make_record(19.38, -155.28, 1.79, 111, 13.05),
+    ])
+
+    valid, report = validate_data(batch)
+
+    assert len(valid) == 1
+    assert report["rows"] == 4
+    assert report["rejected"] == 3
+    assert report["rejected_by_rule"] == {"latitude": 1, "longitude": 1, "magnitude": 1,
+                                          "cdi": 1, "depth": 1}
+    assert set(report["seconds_by_rule"]) == set(RULES)
+
+
+def test_validate_data_coerces_object_columns():
+    """Test validate_data coerces columns that are not float arrays"""
+    batch = EarthquakeBatch.from_records([make_record(19.38, -155.28, 1.79, 2, 13.05),
+                                          make_record(19.38, -155.28, 1.79, 2, 13.05)])
+    batch["depth"] = np.array([13.05, "deep"], dtype=object)
+
+    valid, report = validate_data(batch)
+
+    assert len(valid) == 1
+    assert report["rejected_by_rule"]["depth"] == 1
+
+
+def test_clean_data_accumulates_validation_stats(valid_earthquake_dict, invalid_earthquake_dict):
+    """Test clean_data records rejections for the ETL response"""
+    reset_validation_stats()
+    clean_data(valid_earthquake_dict)
+    clean_data(invalid_earthquake_dict)
+
+    assert VALIDATION_STATS["rejected"] == 1
+    assert VALIDATION_STATS["rejected_by_rule"]["latitude"] == 1
+    assert VALIDATION_STATS["rejected_by_rule"]["magnitude"] == 1
+    assert set(VALIDATION_STATS["seconds_by_rule"]) == set(RULES)
+
+
+def test_validate_data_rejects_bad_times(monkeypatch):
+    """Test the opt-in time sanity rule rejects missing, ancient and future event times"""
+    monkeypatch.setenv("VALIDATE_EVENT_TIME", "true")
+    records = [make_record(19.38, -155.28, 1.79, 2, 13.05) for _ in range(4)]
+    records[1]["at"] = None
+    records[2]["at"] = datetime.datetime(1700, 1, 1)
+    records[3]["at"] = datetime.datetime.now() + datetime.timedelta(days=2)
+
+    valid, report = validate_data(EarthquakeBatch.from_records(records))
+
+    assert len(valid) == 1
+    assert report["rejected_by_rule"]["at"] == 3
+
+
+def test_event_time_rule_is_opt_in():
+    """Test the default rules accept any event time, as they always have"""
+    record = make_record(19.38, -155.28, 1.79, 2, 13.05)
+    record["at"] = datetime.datetime(1700, 1, 1)
+
+    valid, report = validate_data(EarthquakeBatch.from_records([record]))
+
+    assert len(valid) == 1
+    assert "at" not in report["rejected_by_rule"]
+
+
+@pytest.mark.parametrize("zone", ["Asia/Tokyo", "America/Los_Angeles", "UTC"])
+def test_event_time_rule_uses_local_clock(zone, monkeypatch):
+    """Test a fresh event, timed in local time as extract does, is accepted whatever the host's time zone"""
+    monkeypatch.setenv("VALIDATE_EVENT_TIME", "true")
+    monkeypatch.setenv("TZ", zone)
+    time.tzset()
+    try:
+        record = make_record(19.38, -155.28, 1.79, 2, 13.05)
+        record["at"] = datetime.datetime.fromtimestamp(time.time() - 60)
+
+        valid, report = validate_data(EarthquakeBatch.from_records([record]))
+
+        assert len(valid) == 1
+        assert report["rejected_by_rule"]["at"] == 0
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+
+
+def test_validate_data_custom_rules():
+    """Test rules passed in are compiled with their type, pattern, check and nullability"""
+    records = [make_record(19.38, -155.28, 1.79, 2, 13.05) for _ in range(4)]
+    records[0]["event_url"] = "https://earthquake.usgs.gov/earthquakes/eventpage/us1"
+    records[1]["event_url"] = None
+    records[2]["event_url"] = 5
+    records[3]["felt"] = 3
+    rules = {"event_url": {"column": "event_url", "type": "string",
+                           "pattern": r"https://earthquake\.usgs\.gov/", "nullable": True},
+             "felt": {"column": "felt", "nullable": True, "check": lambda values: values % 2 == 0}}
+
+    valid, report = validate_data(EarthquakeBatch.from_records(records), rules)
+
+    assert len(valid) == 2
+    assert report["rejected_by_rule"] == {"event_url": 2, "felt": 1}
+
+
+def test_register_rule():
+    """Test register_rule adds a rule used by validate_data and rejects unknown types"""
+    batch = EarthquakeBatch.from_records([make_record(19.38, -155.28, 1.79, 2, 13.05)])
+    try:
+        register_rule("network", "network", type="string", pattern=r"us$")
+        valid, report = validate_data(batch)
+    finally:
+        RULES.pop("network", None)
+
+    assert len(valid) == 0
+    assert report["rejected_by_rule"]["network"] == 1
+
+    with pytest.raises(ValueError):
+        register_rule("network", "network", type="geometry")
+    assert "network" not in RULES
+
+
+def test_validate_data_reports_rejected_rows():
+    """Test validate_data returns the rejected rows with the rules each one failed"""
+    batch = EarthquakeBatch.from_records([
+        make_record(19.38, -155.28, 1.79, 2, 13.05),
+        make_record(119.38, -155.28, None, 2, 13.05),
+        make_record(19.38, -155.28, 1.79, 2, 99999),
+    ])
+
+    _, report = validate_data(batch)
+
+    assert report["rejected_rows"]["latitude"].tolist() == [119.38, 19.38]
+    assert report["reasons"] == ["latitude,magnitude", "depth"]
+
+
+def test_clean_data_quarantines_rejected_rows(valid_earthquake_dict, invalid_earthquake_dict):
+    """Test clean_data buffers the rows it drops instead of discarding them"""
+    clean_data(valid_earthquake_dict)
+    clean_data(invalid_earthquake_dict)
+
+    assert len(PENDING) == 1
+    rejected, reasons, stage = PENDING[0]
+    assert len(rejected) == 1
+    assert reasons == ["latitude,magnitude,cdi,depth"]
+    assert stage == "validate"
@@ -6,7 +6,15 @@ Ready to be loaded into the database
 '''
 
 import logging
+import os
+import re
+import time
+from datetime import datetime
+from typing import Callable
+import numpy as np
 import pandas as pd
+from batch import EarthquakeBatch, to_float_array
+from quarantine import quarantine
 
 MAX_MAGNITUDE = 12.0
 MIN_MAGNITUDE = -10.0
@@ -18,55 +26,43 @@ MAX_CDI = 12.0
 MIN_CDI = 0.0
 MAX_DEPTH = 1000
 MIN_DEPTH = -100
+MIN_TIME = np.datetime64("1800-01-01")
+MAX_CLOCK_SKEW = np.timedelta64(1, "h")
 
 GREEN = "green"
 ZERO = 0
 
+RULE_TYPES = ("float", "datetime", "string")
+VALIDATION_STATS = {"rejected": 0, "rejected_by_rule": {}, "seconds_by_rule": {}}
+
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
 
-def is_valid_latitude(lat: float) -> bool:
-    """Checks if latitude is valid"""
-    if not isinstance(lat, (float, int)):
-        logging.error("Invalid latitude type: %s", type(lat))
-        return False
-    return MIN_LAT <= lat <= MAX_LAT
-
-
-def is_valid_longitude(lon: float) -> bool:
-    """Checks if longitude is valid"""
-    if not isinstance(lon, (float, int)):
-        logging.error("Invalid longitude type: %s", type(lon))
-        return False
-    return MIN_LON <= lon <= MAX_LON
-
-
-def is_valid_magnitude(mag: float) -> bool:
-    """Checks if magnitude is valid"""
-    if not isinstance(mag, (float, int)):
-        logging.error("Invalid magnitude type: %s", type(mag))
-        return False
-    return MIN_MAGNITUDE <= mag <= MAX_MAGNITUDE
-
-
-def is_valid_cdi(cdi: float) -> bool:
-    """Checks if cdi is valid"""
-    if not isinstance(cdi, (float, int)):
-        logging.error("Invalid CDI type: %s", type(cdi))
-        return False
-    return MIN_CDI <= cdi <= MAX_CDI
+def get_latest_valid_time() -> np.datetime64:
+    """
+    Returns the latest event time accepted, allowing for a little clock skew at the source.
+    Event times are naive local times (see extract.format_earthquake), so this is measured on the local clock too.
+    """
+    return np.datetime64(datetime.now(), "us") + MAX_CLOCK_SKEW
 
 
-def is_valid_depth(depth: float) -> bool:
-    """Checks if depth is valid"""
-    if not isinstance(depth, (float, int)):
-        logging.error("Invalid latitude type: %s", type(depth))
-        return False
-    return MIN_DEPTH <= depth <= MAX_DEPTH
+# Each rule checks one column. "type" is one of RULE_TYPES; "min"/"max" bound the value and may be
+# callables evaluated when the rules are compiled; "pattern" is a regex strings must match;
+# "check" is an extra vectorised function returning a boolean mask; "nullable" lets missing values pass.
+RULES = {
+    "latitude": {"column": "latitude", "type": "float", "min": MIN_LAT, "max": MAX_LAT},
+    "longitude": {"column": "longitude", "type": "float", "min": MIN_LON, "max": MAX_LON},
+    "magnitude": {"column": "magnitude", "type": "float", "min": MIN_MAGNITUDE, "max": MAX_MAGNITUDE},
+    "cdi": {"column": "cdi", "type": "float", "min": MIN_CDI, "max": MAX_CDI},
+    "depth": {"column": "depth", "type": "float", "min": MIN_DEPTH, "max": MAX_DEPTH},
+}
+# Rejects missing, ancient and future event times. Opt-in through VALIDATE_EVENT_TIME=true,
+# as the default rules accept the same rows the pipeline always has.
+EVENT_TIME_RULE = {"column": "at", "type": "datetime", "min": MIN_TIME, "max": get_latest_valid_time}
 
 
-def clean_data(earthquake_data: list[dict]) -> list[dict]:
+def clean_data(earthquake_data: EarthquakeBatch) -> EarthquakeBatch:
     '''
     Function to clean the data extracted from the earthquake API.
     - Converts 'felt' and 'cdi' columns to numeric values, replacing invalid or missing values with defaults.
@@ -74,58 +70,145 @@ def clean_data(earthquake_data: list[dict]) -> list[dict]:
     - Gets rid of milliseconds in timestamp.
     '''
 
-    if not earthquake_data or not isinstance(earthquake_data, list):
-        logging.error("Expected list for earthquake_data, got %s",
+    if not isinstance(earthquake_data, EarthquakeBatch) or len(earthquake_data) == 0:
+        logging.error("Expected a non-empty EarthquakeBatch for earthquake_data, got %s",
                       type(earthquake_data))
         raise ValueError(
-            "Earthquake data list is empty or not a list. Transformation cannot proceed.")
+            "Earthquake data batch is empty or not a batch. Transformation cannot proceed.")
 
     logging.info("Cleaning earthquake data...")
-    earthquake_df = pd.DataFrame(earthquake_data)
 
-    earthquake_df["felt"] = pd.to_numeric(
-        earthquake_df["felt"], errors="coerce").fillna(ZERO)
-    earthquake_df["alert"] = earthquake_df["alert"].fillna(GREEN)
-    earthquake_df["cdi"] = pd.to_numeric(
-        earthquake_df["cdi"], errors="coerce").fillna(MIN_CDI)
+    earthquake_data["felt"] = np.nan_to_num(earthquake_data["felt"], nan=ZERO)
+    earthquake_data["alert"] = np.where(pd.isna(earthquake_data["alert"]),
+                                        GREEN, earthquake_data["alert"]).astype(object)
+    earthquake_data["cdi"] = np.nan_to_num(earthquake_data["cdi"], nan=MIN_CDI)
 
-    earthquake_df = validate_data(earthquake_df)
+    earthquake_data, report = validate_data(earthquake_data)
+    quarantine(report["rejected_rows"], report["reasons"], "validate")
+    VALIDATION_STATS["rejected"] += report["rejected"]
+    for key in ("rejected_by_rule", "seconds_by_rule"):
+        for rule, value in report[key].items():
+            VALIDATION_STATS[key][rule] = VALIDATION_STATS[key].get(rule, 0) + value
 
-    earthquake_df["at"] = earthquake_df['at'].apply(
-        lambda x: x.replace(microsecond=ZERO))
+    earthquake_data["at"] = earthquake_data["at"].astype(
+        "datetime64[s]").astype("datetime64[us]")
 
     logging.info("Data cleaning complete.")
-    return earthquake_df.to_dict(orient='records')
-
-
-def validate_data(earthquake_df: pd.DataFrame) -> pd.DataFrame:
-    """Ensures that long, lat, magnitude, cdi readings are within a valid range"""
+    return earthquake_data
+
+
+def reset_validation_stats() -> None:
+    """Resets the rejection counters at the start of a run, as they survive warm Lambda invocations."""
+    VALIDATION_STATS.update(rejected=0, rejected_by_rule={}, seconds_by_rule={})
+
+
+def get_rules() -> dict[str, dict]:
+    """Returns the rules validate_data applies by default: RULES, plus the event time rule if VALIDATE_EVENT_TIME is true."""
+    if os.getenv("VALIDATE_EVENT_TIME", "false").lower() == "true":
+        return {**RULES, "at": EVENT_TIME_RULE}
+    return RULES
+
+
+def register_rule(name: str, column: str, **spec) -> None:
+    """
+    Adds or replaces a rule in RULES, e.g.
+    register_rule("event_url", "event_url", type="string", pattern=r"https://").
+    The spec is compiled straight away so a bad rule fails at registration, not mid-run.
+    """
+    rule = {"column": column, **spec}
+    compile_rule(rule)
+    RULES[name] = rule
+
+
+def coerce_values(rule_type: str, values: np.ndarray) -> np.ndarray:
+    """Converts a column to the array type a rule compares against. Values of the wrong type become NaN/NaT."""
+    if rule_type == "float":
+        return values if values.dtype == np.float64 else to_float_array(values.tolist())
+    if rule_type == "datetime":
+        if np.issubdtype(values.dtype, np.datetime64):
+            return values
+        return pd.to_datetime(pd.Series(values, dtype=object), errors="coerce").to_numpy("datetime64[us]")
+    return values
+
+
+def has_type(rule_type: str, values: np.ndarray) -> np.ndarray:
+    """Returns a mask of the coerced values that hold a usable value of the rule's type."""
+    if rule_type == "float":
+        return ~np.isnan(values)
+    if rule_type == "datetime":
+        return ~np.isnat(values)
+    return np.fromiter((isinstance(value, str) for value in values), dtype=bool, count=len(values))
+
+
+def compile_rule(rule: dict) -> Callable[[EarthquakeBatch], np.ndarray]:
+    """
+    Turns a rule spec into a function that returns the mask of rows passing it.
+    Bounds given as callables are resolved here, once per compilation.
+    """
+    rule_type = rule.get("type", "float")
+    if rule_type not in RULE_TYPES:
+        raise ValueError(f"Unknown rule type {rule_type}, expected one of {RULE_TYPES}.")
+
+    column = rule["column"]
+    minimum = rule["min"]() if callable(rule.get("min")) else rule.get("min")
+    maximum = rule["max"]() if callable(rule.get("max")) else rule.get("max")
+    pattern = re.compile(rule["pattern"]) if rule.get("pattern") else None
+    check = rule.get("check")
+    nullable = rule.get("nullable", False)
+
+    def run(earthquake_data: EarthquakeBatch) -> np.ndarray:
+        raw = earthquake_data[column]
+        values = coerce_values(rule_type, raw)
+        passed = has_type(rule_type, values)
+        if minimum is not None:
+            passed &= values >= minimum
+        if maximum is not None:
+            passed &= values <= maximum
+        if pattern is not None:
+            passed &= pd.Series(values, dtype=object).str.match(pattern).fillna(False).to_numpy(dtype=bool)
+        if check is not None:
+            passed &= check(values)
+        if nullable:
+            passed |= pd.isna(raw)
+        return passed
+
+    return run
+
+
+def compile_rules(rules: dict[str, dict]) -> list[tuple[str, Callable[[EarthquakeBatch], np.ndarray]]]:
+    """Compiles every rule spec, returning (name, check) pairs."""
+    return [(name, compile_rule(rule)) for name, rule in rules.items()]
+
+
+def validate_data(earthquake_data: EarthquakeBatch,
+                  rules: dict[str, dict] = None) -> tuple[EarthquakeBatch, dict]:
+    """
+    Ensures that every column covered by the rule registry (get_rules() by default) is valid.
+    Each compiled rule adds one vectorised mask to a single pass over the batch. Returns the
+    valid rows and a report with the rows rejected and seconds spent per rule (a row can fail several),
+    plus the rejected rows themselves and, for each, the comma-separated names of the rules it failed.
+    """
     logging.info("Validating data...")
 
-    earthquake_df["latitude_valid"] = earthquake_df["latitude"].apply(
-        is_valid_latitude)
-    earthquake_df["longitude_valid"] = earthquake_df["longitude"].apply(
-        is_valid_longitude)
-    earthquake_df["magnitude_valid"] = earthquake_df["magnitude"].apply(
-        is_valid_magnitude)
-    earthquake_df["cdi_valid"] = earthquake_df["cdi"].apply(is_valid_cdi)
-    earthquake_df["depth_valid"] = earthquake_df["depth"].apply(is_valid_depth)
-
-    valid_earthquake_df = earthquake_df[earthquake_df["latitude_valid"] &
-                                        earthquake_df["longitude_valid"] &
-                                        earthquake_df["magnitude_valid"] &
-                                        earthquake_df["cdi_valid"] &
-                                        earthquake_df["depth_valid"]]
-
-    invalid_count = len(earthquake_df) - len(valid_earthquake_df)
-    if invalid_count > 0:
-        logging.warning(
-            "Removed %s invalid earthquake records.", invalid_count)
-
-    columns_to_exclude = ["latitude_valid",
-                          "longitude_valid", "magnitude_valid", "cdi_valid", "depth_valid"]
-
-    valid_earthquake_df = valid_earthquake_df.drop(columns=columns_to_exclude)
+    valid = np.ones(len(earthquake_data), dtype=bool)
+    report = {"rows": len(earthquake_data), "rejected": 0,
+              "rejected_by_rule": {}, "seconds_by_rule": {}}
+    failures = []
+    for name, run in compile_rules(get_rules() if rules is None else rules):
+        start = time.perf_counter()
+        passed = run(earthquake_data)
+        valid &= passed
+        failures.append((name, ~passed))
+        report["seconds_by_rule"][name] = time.perf_counter() - start
+        report["rejected_by_rule"][name] = len(passed) - int(passed.sum())
+
+    report["rejected"] = len(earthquake_data) - int(valid.sum())
+    report["rejected_rows"] = earthquake_data.filter(~valid)
+    report["reasons"] = [",".join(name for name, failed in failures if failed[row])
+                         for row in np.flatnonzero(~valid)]
+    if report["rejected"] > 0:
+        logging.warning("Removed %s invalid earthquake records: %s",
+                        report["rejected"], report["rejected_by_rule"])
 
     logging.info("Data validation complete.")
-    return valid_earthquake_df
+    return earthquake_data.filter(valid), report
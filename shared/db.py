@@ -0,0 +1,316 @@
+# pylint: disable=line-too-long
+
+'''
+Module that every component uses to reach the RDS.
+Connections, the connection pool, statement timeouts and query timing are configured here once,
+through environment variables, instead of in a copy of get_connection per component.
+'''
+
+import os
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator
+import psycopg2
+from psycopg2 import sql
+from psycopg2.extensions import connection, cursor
+from psycopg2.extras import RealDictCursor
+from psycopg2.pool import PoolError, ThreadedConnectionPool
+
+DEFAULT_POOL_MIN = 1
+DEFAULT_POOL_MAX = 10
+DEFAULT_POOL_TIMEOUT = 5
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_STATEMENT_TIMEOUT_MS = 30000
+DEFAULT_SLOW_QUERY_MS = 500
+# Longest part of a query written to the slow-query log.
+MAX_LOGGED_QUERY = 500
+# The pool, and a semaphore holding one slot per connection so checkouts wait instead of failing.
+POOL = {"pool": None, "slots": None}
+POOL_LOCK = threading.Lock()
+# The connection kept open across warm Lambda invocations, and the connections inside a transaction block.
+CONNECTION = {"conn": None}
+OPEN_TRANSACTIONS = set()
+# Callables run after every query with the query and the seconds it took.
+QUERY_HOOKS = []
+DB_STATS = {"handshake_ms": 0.0, "ping_ms": 0.0, "query_ms": 0.0, "queries": 0,
+            "slow_queries": 0, "reused_connection": False}
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+def reset_db_stats() -> None:
+    """Resets the connection and query timings at the start of a run, as they survive warm Lambda invocations."""
+    DB_STATS.update(handshake_ms=0.0, ping_ms=0.0, query_ms=0.0, queries=0,
+                    slow_queries=0, reused_connection=False)
+
+
+def add_query_hook(hook: Callable[[str, float], None]) -> None:
+    """Registers a callable run after every query with the query text and its duration in seconds."""
+    QUERY_HOOKS.append(hook)
+
+
+def remove_query_hook(hook: Callable[[str, float], None]) -> None:
+    """Unregisters a query hook."""
+    QUERY_HOOKS.remove(hook)
+
+
+def get_query_text(query) -> str:
+    """Returns the text of a query given as a string, bytes or psycopg2.sql object."""
+    if isinstance(query, bytes):
+        return query.decode("utf-8", errors="replace")
+    if isinstance(query, str):
+        return query
+    return repr(query)
+
+
+def record_query(query, seconds: float) -> None:
+    """Adds a query to DB_STATS, logs it if it is slower than DB_SLOW_QUERY_MS and runs the query hooks."""
+    elapsed_ms = seconds * 1000
+    DB_STATS["queries"] += 1
+    DB_STATS["query_ms"] += elapsed_ms
+
+    query_text = get_query_text(query)
+    if elapsed_ms >= float(os.getenv("DB_SLOW_QUERY_MS", str(DEFAULT_SLOW_QUERY_MS))):
+        DB_STATS["slow_queries"] += 1
+        logging.warning("Slow query (%.0f ms): %s", elapsed_ms,
+                        " ".join(query_text.split())[:MAX_LOGGED_QUERY])
+
+    for hook in QUERY_HOOKS:
+        try:
+            hook(query_text, seconds)
+        except Exception as e:
+            logging.error("Query hook failed: %s", e)
+
+
+class TimedCursorMixin:
+    """Times every execute, executemany and COPY of a cursor. Only the query template is logged, never its values."""
+
+    def execute(self, query, variables=None):
+        """Runs a query and records how long it took."""
+        start = time.perf_counter()
+        try:
+            return super().execute(query, variables)
+        finally:
+            record_query(query.as_string(self) if isinstance(query, sql.Composable) else query,
+                         time.perf_counter() - start)
+
+    def executemany(self, query, vars_list):
+        """Runs a query once per set of values and records how long they took together."""
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            record_query(query, time.perf_counter() - start)
+
+    def copy_expert(self, query, file, size=8192):
+        """Runs a COPY and records how long it took."""
+        start = time.perf_counter()
+        try:
+            return super().copy_expert(query, file, size)
+        finally:
+            record_query(query, time.perf_counter() - start)
+
+
+class PreparedConnection(connection):
+    """Connection that remembers the server-side prepared statements created on its session."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared_statements = set()
+
+
+class TimedCursor(TimedCursorMixin, cursor):
+    """Default cursor of every connection, returning rows as tuples (as pandas expects)."""
+
+
+class TimedDictCursor(TimedCursorMixin, RealDictCursor):
+    """Cursor returned by get_cursor, returning rows as dictionaries."""
+
+
+def get_connect_kwargs() -> dict:
+    """Returns the psycopg2.connect arguments, with the statement timeout set for the whole session."""
+    statement_timeout = int(os.getenv("DB_STATEMENT_TIMEOUT_MS",
+                                      str(DEFAULT_STATEMENT_TIMEOUT_MS)))
+    return {"dbname": os.getenv("DB_NAME"),
+            "user": os.getenv("DB_USER"),
+            "password": os.getenv("DB_PASSWORD"),
+            "host": os.getenv("DB_HOST"),
+            "port": os.getenv("DB_PORT"),
+            "connect_timeout": int(os.getenv("DB_CONNECT_TIMEOUT", str(DEFAULT_CONNECT_TIMEOUT))),
+            "options": f"-c statement_timeout={statement_timeout}",
+            "connection_factory": PreparedConnection,
+            "cursor_factory": TimedCursor}
+
+
+def get_connection() -> connection:
+    """ Establishes a connection with database. """
+    logging.info("Attempting to connect to the database")
+    try:
+        conn = psycopg2.connect(**get_connect_kwargs())
+        logging.info("Database connection successful.")
+        return conn
+    except KeyError as e:
+        logging.error("%s missing from environment variables.", e)
+        raise
+    except psycopg2.OperationalError as e:
+        logging.error("Error connecting to database: %s", e)
+        raise
+    except Exception as e:
+        logging.error("Unexpected error while connecting to database: %s", e)
+        raise
+
+
+def get_cursor(connect: connection, name: str = None) -> cursor:
+    """ Create a cursor to send and receive data. Named cursors keep their result on the server. """
+    logging.info("Creating database cursor")
+    try:
+        return connect.cursor(name=name, cursor_factory=TimedDictCursor)
+    except Exception as e:
+        logging.error("Failed to create cursor: %s", e)
+        raise
+
+
+def execute_prepared(db_cursor: cursor, name: str, query, params: tuple = ()) -> None:
+    """
+    Runs a query written with $1, $2... placeholders as a named server-side prepared statement.
+    The statement is prepared the first time each connection runs it, so later calls skip parsing and planning.
+    """
+    prepared = db_cursor.connection.prepared_statements
+    if name not in prepared:
+        if not isinstance(query, sql.Composable):
+            query = sql.SQL(query)
+        db_cursor.execute(sql.SQL("PREPARE {} AS ").format(sql.Identifier(name)) + query)
+        prepared.add(name)
+
+    if params:
+        db_cursor.execute(sql.SQL("EXECUTE {} ({})").format(
+            sql.Identifier(name), sql.SQL(", ").join(sql.Placeholder() * len(params))), params)
+    else:
+        db_cursor.execute(sql.SQL("EXECUTE {}").format(sql.Identifier(name)))
+
+
+def get_pool() -> ThreadedConnectionPool:
+    """Returns the process-wide connection pool, creating it with DB_POOL_MIN to DB_POOL_MAX connections."""
+    with POOL_LOCK:
+        if POOL["pool"] is None:
+            min_connections = int(os.getenv("DB_POOL_MIN", str(DEFAULT_POOL_MIN)))
+            max_connections = int(os.getenv("DB_POOL_MAX", str(DEFAULT_POOL_MAX)))
+            logging.info("Creating database pool of %s to %s connections",
+                         min_connections, max_connections)
+            POOL["slots"] = threading.BoundedSemaphore(max_connections)
+            POOL["pool"] = ThreadedConnectionPool(min_connections, max_connections,
+                                                  **get_connect_kwargs())
+        return POOL["pool"]
+
+
+def close_pool() -> None:
+    """Closes every pooled connection, so the next checkout creates a new pool."""
+    if POOL["pool"] is not None:
+        POOL["pool"].closeall()
+        POOL.update(pool=None, slots=None)
+
+
+def checkout_connection() -> connection:
+    """
+    Takes a connection from the pool, waiting up to DB_POOL_TIMEOUT seconds for one to be returned
+    when all DB_POOL_MAX are in use. Connections the server has closed are replaced.
+    """
+    pool = get_pool()
+    if not POOL["slots"].acquire(timeout=float(os.getenv("DB_POOL_TIMEOUT", str(DEFAULT_POOL_TIMEOUT)))):
+        raise PoolError("No database connection became free in time")
+    try:
+        db_conn = pool.getconn()
+        if db_conn.closed:
+            pool.putconn(db_conn, close=True)
+            db_conn = pool.getconn()
+        return db_conn
+    except Exception:
+        POOL["slots"].release()
+        raise
+
+
+def return_connection(db_conn: connection, broken: bool = False) -> None:
+    """Puts a connection back in the pool, which rolls back anything left uncommitted. Broken connections are closed."""
+    try:
+        POOL["pool"].putconn(db_conn, close=broken or bool(db_conn.closed))
+    finally:
+        POOL["slots"].release()
+
+
+@contextmanager
+def pooled_connection() -> Iterator[connection]:
+    """Checks a connection out of the pool for the block and returns it afterwards, discarding it if it broke."""
+    db_conn = checkout_connection()
+    broken = False
+    try:
+        yield db_conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    finally:
+        return_connection(db_conn, broken)
+
+
+def is_connection_alive(db_conn: connection) -> bool:
+    """Checks a cached connection with a single SELECT 1, rolling back anything a failed run left open."""
+    if db_conn.closed:
+        return False
+    try:
+        db_conn.rollback()
+        db_conn.autocommit = True
+        # A plain cursor, so the ping is not counted as a query.
+        with db_conn.cursor(cursor_factory=cursor) as ping_cursor:
+            ping_cursor.execute("SELECT 1")
+        db_conn.autocommit = False
+        return True
+    except psycopg2.Error as e:
+        logging.warning("Cached database connection is stale: %s", e)
+        return False
+
+
+def get_shared_connection() -> connection:
+    """
+    Returns the connection cached at module level, so warm Lambda invocations skip the TCP, TLS and auth handshake.
+    The cached connection is checked first and replaced if it has gone stale.
+    """
+    db_conn = CONNECTION["conn"]
+    if db_conn is not None:
+        start = time.perf_counter()
+        alive = is_connection_alive(db_conn)
+        DB_STATS["ping_ms"] += (time.perf_counter() - start) * 1000
+        if alive:
+            DB_STATS["reused_connection"] = True
+            return db_conn
+        try:
+            db_conn.close()
+        except psycopg2.Error:
+            pass
+
+    start = time.perf_counter()
+    CONNECTION["conn"] = get_connection()
+    DB_STATS["handshake_ms"] += (time.perf_counter() - start) * 1000
+    return CONNECTION["conn"]
+
+
+@contextmanager
+def transaction(db_conn: connection) -> Iterator[connection]:
+    """
+    Runs the block in one explicit transaction, committing if it succeeds and rolling back if it raises.
+    Nested blocks join the outermost one, so a whole batch commits once.
+    """
+    if id(db_conn) in OPEN_TRANSACTIONS:
+        yield db_conn
+        return
+
+    OPEN_TRANSACTIONS.add(id(db_conn))
+    try:
+        yield db_conn
+        db_conn.commit()
+    except Exception:
+        db_conn.rollback()
+        raise
+    finally:
+        OPEN_TRANSACTIONS.discard(id(db_conn))
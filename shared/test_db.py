@@ -0,0 +1,392 @@
+# pylint: skip-file
+
+import pytest
+import os
+import threading
+from unittest.mock import MagicMock, patch
+import psycopg2
+from db import *
+
+
+@pytest.fixture(autouse=True)
+def reset_db_state():
+    """Fixture that resets the pool, cached connection, stats and hooks around each test."""
+    reset_db_stats()
+    CONNECTION["conn"] = None
+    POOL.update(pool=None, slots=None)
+    QUERY_HOOKS.clear()
+    yield
+    CONNECTION["conn"] = None
+    POOL.update(pool=None, slots=None)
+    QUERY_HOOKS.clear()
+
+
+def use_pool(pool: MagicMock, size: int = 1) -> None:
+    """Installs a mocked pool with the given number of connection slots."""
+    POOL.update(pool=pool, slots=threading.BoundedSemaphore(size))
+
+
+@pytest.fixture
+def mock_connection():
+    """Fixture for mocking a database connection."""
+    mock_conn = MagicMock()
+    return mock_conn
+
+
+class FakeCursor:
+    """Stands in for a psycopg2 cursor underneath the timing mixin."""
+
+    def execute(self, query, variables=None):
+        return None
+
+    def executemany(self, query, vars_list):
+        return None
+
+    def copy_expert(self, sql, file, size=8192):
+        return None
+
+
+class FakeTimedCursor(TimedCursorMixin, FakeCursor):
+    pass
+
+
+@patch('psycopg2.connect')
+def test_get_connection_success(mock_connect):
+    """Test get_connection with a successful connection."""
+
+    mock_conn = MagicMock()
+    mock_connect.return_value = mock_conn
+
+    conn = get_connection()
+
+    assert conn == mock_conn
+
+    mock_connect.assert_called_once_with(
+        dbname=os.getenv("DB_NAME"),
+        user=os.getenv("DB_USER"),
+        password=os.getenv("DB_PASSWORD"),
+        host=os.getenv("DB_HOST"),
+        port=os.getenv("DB_PORT"),
+        connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+        options=f"-c statement_timeout={DEFAULT_STATEMENT_TIMEOUT_MS}",
+        connection_factory=PreparedConnection,
+        cursor_factory=TimedCursor
+    )
+
+
+@patch('psycopg2.connect')
+def test_get_connection_db_error(mock_connect):
+    """Test get_connection with a database error (OperationalError)."""
+
+    mock_connect.side_effect = psycopg2.OperationalError("Connection error")
+
+    with pytest.raises(psycopg2.OperationalError):
+        get_connection()
+
+
+@patch('psycopg2.connect')
+def test_get_connection_missing_env(mock_connect):
+    """Test get_connection with missing environment variables."""
+
+    mock_connect.side_effect = KeyError('DB_NAME')
+
+    with pytest.raises(KeyError):
+        get_connection()
+
+
+def test_get_cursor_creation_error(mock_connection):
+    """Test get_cursor when cursor creation fails"""
+    mock_connection.cursor.side_effect = Exception("Cursor creation failed")
+
+    with pytest.raises(Exception):
+        get_cursor(mock_connection)
+
+
+def test_get_cursor_returns_timed_dict_cursor(mock_connection):
+    """Test get_cursor asks for a cursor that returns dictionaries and times its queries"""
+    get_cursor(mock_connection)
+    mock_connection.cursor.assert_called_once_with(name=None, cursor_factory=TimedDictCursor)
+
+
+def test_get_connect_kwargs_reads_timeouts(monkeypatch):
+    """Test the statement and connect timeouts come from the environment"""
+    monkeypatch.setenv("DB_STATEMENT_TIMEOUT_MS", "2500")
+    monkeypatch.setenv("DB_CONNECT_TIMEOUT", "3")
+
+    kwargs = get_connect_kwargs()
+
+    assert kwargs["options"] == "-c statement_timeout=2500"
+    assert kwargs["connect_timeout"] == 3
+
+
+def test_timed_cursor_records_queries():
+    """Test every execute, executemany and COPY is counted and timed"""
+    timed_cursor = FakeTimedCursor()
+    timed_cursor.execute("SELECT 1")
+    timed_cursor.executemany("INSERT INTO alerts VALUES (%s)", [(1,), (2,)])
+    timed_cursor.copy_expert("COPY alerts FROM STDIN", None)
+
+    assert DB_STATS["queries"] == 3
+    assert DB_STATS["query_ms"] >= 0
+    assert DB_STATS["slow_queries"] == 0
+
+
+def test_timed_cursor_records_failed_queries():
+    """Test a query that raises is still timed"""
+    with patch.object(FakeCursor, "execute", side_effect=psycopg2.Error("failed")):
+        with pytest.raises(psycopg2.Error):
+            FakeTimedCursor().execute("SELECT 1")
+
+    assert DB_STATS["queries"] == 1
+
+
+def test_query_hooks_get_query_and_duration():
+    """Test query hooks receive the query text and its duration in seconds"""
+    hook = MagicMock()
+    add_query_hook(hook)
+
+    FakeTimedCursor().execute(b"SELECT 1")
+    remove_query_hook(hook)
+    FakeTimedCursor().execute("SELECT 2")
+
+    hook.assert_called_once()
+    query, seconds = hook.call_args.args
+    assert query == "SELECT 1"
+    assert seconds >= 0
+
+
+def test_failing_query_hook_does_not_fail_the_query():
+    """Test an exception in a hook is logged instead of raised"""
+    add_query_hook(MagicMock(side_effect=ValueError("hook failed")))
+    FakeTimedCursor().execute("SELECT 1")
+    assert DB_STATS["queries"] == 1
+
+
+@patch('db.logging.warning')
+def test_slow_queries_are_logged(mock_warning, monkeypatch):
+    """Test queries slower than DB_SLOW_QUERY_MS are logged and counted, without their values"""
+    monkeypatch.setenv("DB_SLOW_QUERY_MS", "0")
+
+    FakeTimedCursor().execute("SELECT *\n   FROM earthquakes WHERE earthquake_id = %s", (1,))
+
+    assert DB_STATS["slow_queries"] == 1
+    mock_warning.assert_called_once()
+    assert mock_warning.call_args.args[2] == "SELECT * FROM earthquakes WHERE earthquake_id = %s"
+
+
+def test_execute_prepared_prepares_once_per_connection():
+    """Test a statement is prepared on first use and only executed afterwards"""
+    mock_cursor = MagicMock()
+    mock_cursor.connection.prepared_statements = set()
+
+    execute_prepared(mock_cursor, "earthquake_by_id", "SELECT * FROM earthquakes WHERE earthquake_id = $1", (1,))
+    execute_prepared(mock_cursor, "earthquake_by_id", "SELECT * FROM earthquakes WHERE earthquake_id = $1", (2,))
+
+    prepare, first, second = mock_cursor.execute.call_args_list
+    assert "PREPARE" in repr(prepare.args[0])
+    assert "earthquake_id = $1" in repr(prepare.args[0])
+    assert "EXECUTE" in repr(first.args[0])
+    assert first.args[1] == (1,)
+    assert second.args[1] == (2,)
+
+
+def test_execute_prepared_without_params():
+    """Test a statement without parameters is executed without an argument list"""
+    mock_cursor = MagicMock()
+    mock_cursor.connection.prepared_statements = {"alert_levels"}
+
+    execute_prepared(mock_cursor, "alert_levels", "SELECT alert_type FROM alerts")
+
+    mock_cursor.execute.assert_called_once()
+    assert len(mock_cursor.execute.call_args.args) == 1
+
+
+def test_failed_prepare_is_retried():
+    """Test a statement whose PREPARE failed is prepared again on the next call"""
+    mock_cursor = MagicMock()
+    mock_cursor.connection.prepared_statements = set()
+    mock_cursor.execute.side_effect = [psycopg2.Error("failed"), None, None]
+
+    with pytest.raises(psycopg2.Error):
+        execute_prepared(mock_cursor, "earthquake_by_id", "SELECT $1", (1,))
+    execute_prepared(mock_cursor, "earthquake_by_id", "SELECT $1", (1,))
+
+    assert mock_cursor.execute.call_count == 3
+    assert mock_cursor.connection.prepared_statements == {"earthquake_by_id"}
+
+
+@pytest.mark.skipif(not os.getenv("DB_HOST"), reason="Needs a Postgres database")
+def test_execute_prepared_on_database():
+    """Test prepared statements run on a real connection and survive a rollback"""
+    conn = get_connection()
+    try:
+        db_cursor = get_cursor(conn)
+        execute_prepared(db_cursor, "add_numbers", "SELECT $1::int + $2::int AS total", (1, 2))
+        assert db_cursor.fetchone()["total"] == 3
+        conn.rollback()
+        execute_prepared(db_cursor, "add_numbers", "SELECT $1::int + $2::int AS total", (2, 3))
+        assert db_cursor.fetchone()["total"] == 5
+    finally:
+        conn.close()
+
+
+@patch('db.ThreadedConnectionPool')
+def test_get_pool_is_sized_from_environment(mock_pool, monkeypatch):
+    """Test the pool is created once, with DB_POOL_MIN to DB_POOL_MAX connections"""
+    monkeypatch.setenv("DB_POOL_MIN", "2")
+    monkeypatch.setenv("DB_POOL_MAX", "4")
+
+    assert get_pool() is get_pool()
+
+    mock_pool.assert_called_once()
+    assert mock_pool.call_args.args == (2, 4)
+    assert mock_pool.call_args.kwargs["cursor_factory"] is TimedCursor
+
+
+def test_pooled_connection_returns_connection():
+    """Test a connection is checked out for the block and put back afterwards"""
+    pool = MagicMock()
+    pool.getconn.return_value.closed = 0
+    use_pool(pool)
+
+    with pooled_connection() as conn:
+        assert conn is pool.getconn.return_value
+
+    pool.putconn.assert_called_once_with(conn, close=False)
+
+
+def test_pooled_connection_replaces_closed_connection():
+    """Test a pooled connection the server closed is discarded before it is used"""
+    closed, fresh = MagicMock(closed=2), MagicMock(closed=0)
+    pool = MagicMock()
+    pool.getconn.side_effect = [closed, fresh]
+    use_pool(pool)
+
+    with pooled_connection() as conn:
+        assert conn is fresh
+
+    pool.putconn.assert_any_call(closed, close=True)
+    pool.putconn.assert_called_with(fresh, close=False)
+
+
+def test_pooled_connection_discards_broken_connection():
+    """Test a connection that failed during the block is closed instead of returned"""
+    pool = MagicMock()
+    pool.getconn.return_value.closed = 0
+    use_pool(pool)
+
+    with pytest.raises(psycopg2.OperationalError):
+        with pooled_connection():
+            raise psycopg2.OperationalError("server closed the connection")
+
+    pool.putconn.assert_called_once_with(pool.getconn.return_value, close=True)
+
+
+def test_close_pool():
+    """Test closing the pool closes its connections and forgets it"""
+    pool = MagicMock()
+    use_pool(pool)
+
+    close_pool()
+
+    pool.closeall.assert_called_once()
+    assert POOL["pool"] is None
+
+
+def test_checkout_connection_waits_for_a_free_slot(monkeypatch):
+    """Test a checkout fails with PoolError once every connection stays in use past DB_POOL_TIMEOUT"""
+    monkeypatch.setenv("DB_POOL_TIMEOUT", "0.01")
+    pool = MagicMock()
+    pool.getconn.return_value.closed = 0
+    use_pool(pool)
+
+    held = checkout_connection()
+    with pytest.raises(PoolError):
+        checkout_connection()
+
+    return_connection(held)
+    assert checkout_connection() is pool.getconn.return_value
+
+
+def test_checkout_connection_frees_slot_when_getconn_fails():
+    """Test a failed checkout does not use up a slot"""
+    pool = MagicMock()
+    pool.getconn.side_effect = [psycopg2.OperationalError("down"), MagicMock(closed=0)]
+    use_pool(pool)
+
+    with pytest.raises(psycopg2.OperationalError):
+        checkout_connection()
+    checkout_connection()
+
+
+@patch('db.get_connection')
+def test_get_shared_connection_reuses_live_connection(mock_get_connection):
+    """Test a warm invocation pings the cached connection instead of reconnecting"""
+    mock_get_connection.return_value.closed = 0
+
+    first = get_shared_connection()
+    second = get_shared_connection()
+
+    assert first is second
+    mock_get_connection.assert_called_once()
+    first.cursor.return_value.__enter__.return_value.execute.assert_called_once_with("SELECT 1")
+    assert first.autocommit is False
+    assert DB_STATS["reused_connection"] is True
+
+
+@patch('db.get_connection')
+def test_get_shared_connection_replaces_stale_connection(mock_get_connection):
+    """Test a cached connection that fails the ping is closed and replaced"""
+    stale, fresh = MagicMock(closed=0), MagicMock(closed=0)
+    stale.cursor.return_value.__enter__.return_value.execute.side_effect = psycopg2.OperationalError("gone")
+    mock_get_connection.side_effect = [stale, fresh]
+
+    get_shared_connection()
+    assert get_shared_connection() is fresh
+
+    stale.close.assert_called_once()
+    assert DB_STATS["reused_connection"] is False
+
+
+@patch('db.get_connection')
+def test_get_shared_connection_replaces_closed_connection(mock_get_connection):
+    """Test a connection the server closed is replaced without a ping"""
+    closed, fresh = MagicMock(closed=2), MagicMock(closed=0)
+    mock_get_connection.side_effect = [closed, fresh]
+
+    get_shared_connection()
+    assert get_shared_connection() is fresh
+    closed.cursor.assert_not_called()
+
+
+def test_transaction_commits_once_when_nested(mock_connection):
+    """Test nested transaction blocks commit once, at the end of the outermost block"""
+    with transaction(mock_connection):
+        with transaction(mock_connection):
+            pass
+        mock_connection.commit.assert_not_called()
+
+    mock_connection.commit.assert_called_once()
+
+
+def test_transaction_rolls_back_on_error(mock_connection):
+    """Test a failing block is rolled back, leaving the connection usable for the next run"""
+    with pytest.raises(ValueError):
+        with transaction(mock_connection):
+            with transaction(mock_connection):
+                raise ValueError("failed")
+
+    mock_connection.rollback.assert_called_once()
+    mock_connection.commit.assert_not_called()
+
+
+@pytest.mark.skipif(not os.getenv("DB_HOST"), reason="Needs a Postgres database")
+def test_statement_timeout_cancels_long_queries(monkeypatch):
+    """Test the session statement timeout cancels a query that runs past it"""
+    monkeypatch.setenv("DB_STATEMENT_TIMEOUT_MS", "100")
+    conn = get_connection()
+    try:
+        with pytest.raises(psycopg2.extensions.QueryCanceledError):
+            get_cursor(conn).execute("SELECT pg_sleep(1)")
+    finally:
+        conn.close()